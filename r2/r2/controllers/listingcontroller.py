@@ -131,6 +131,8 @@ class ListingController(RedditController):
             builder_cls = IDBuilder
         elif isinstance(self.query_obj, (queries.CachedResults, queries.MergedCachedResults)):
             builder_cls = IDBuilder
+        elif hasattr(self.query_obj, 'iter_after'):
+            builder_cls = IDBuilder
 
         b = builder_cls(self.query_obj,
                         num = self.num,
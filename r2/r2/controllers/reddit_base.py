@@ -27,7 +27,7 @@ from pylons.i18n.translation import LanguageError
 from r2.lib.base import BaseController, proxyurl
 from r2.lib import pages, utils, filters, amqp
 from r2.lib.utils import http_utils, UniqueIterator, ip_and_slash16
-from r2.lib.cache import LocalCache, make_key, MemcachedError
+from r2.lib.cache import LocalCache, make_key, make_keyer, MemcachedError
 import random as rand
 from r2.models.account import valid_cookie, FakeAccount, valid_feed
 from r2.models.subreddit import Subreddit
@@ -478,6 +478,8 @@ def base_listing(fn):
     return paginated_listing()(fn)
 
 
+_request_keyer = make_keyer('request_key_')
+
 class MinimalController(BaseController):
 
     allow_stylesheets = False
@@ -491,17 +493,16 @@ class MinimalController(BaseController):
         except CookieError:
             cookies_key = ''
 
-        return make_key('request_key_',
-                        c.lang,
-                        c.content_langs,
-                        request.host,
-                        c.cname,
-                        request.fullpath,
-                        c.over18,
-                        c.firsttime,
-                        c.extension,
-                        c.render_style,
-                        cookies_key)
+        return _request_keyer(c.lang,
+                              c.content_langs,
+                              request.host,
+                              c.cname,
+                              request.fullpath,
+                              c.over18,
+                              c.firsttime,
+                              c.extension,
+                              c.render_style,
+                              cookies_key)
 
     def cached_response(self):
         return c.response
@@ -24,38 +24,59 @@ from r2.lib.db.sorts import epoch_seconds
 from r2.lib.db.thing import Query
 from r2.lib.db.queries import CachedResults
 from r2.lib.db.operators import timeago
+from r2.lib.cache import sgm
 
 from pylons import g
 from time import time
+from array import array
+import heapq
+from itertools import izip, imap
+from operator import neg
 
 max_items = 150 # the number of links to request from the hot page
                 # query when the precomputer is disabled
 
-cpdef list get_hot(list srs, only_fullnames = True):
-    """Get the fullnames for the hottest normalised hottest links in a
-       subreddit. Use the query-cache to avoid some lookups if we
-       can."""
+# each subreddit's normalised hot list is cached on its own, so that
+# users with different sets of subscriptions share them
+hot_list_prefix = 'normalized_hot_sr_'
+
+cdef tuple _pack_hot_list(list hots, list fnames):
+    """Normalise a subreddit's hot list (which must be in hot order)
+       against its hottest link, and pack it as
+       (ehots, hots, fullnames), with the scores as array('d') strings"""
+    cdef double thot
+    cdef double hot
+    cdef int i
+
+    ehots = array('d')
+    if hots:
+        thot = max(hots[0], 1.0)
+        for i, hot in enumerate(hots):
+            ehots.append(1.0 if i == 0 else hot/thot)
+
+    return (ehots.tostring(), array('d', hots).tostring(), fnames)
+
+def _load_hot_lists(sr_ids):
+    """Build the packed normalised hot lists of the given subreddits.
+       Use the query-cache to avoid some lookups if we can."""
     cdef double oldest
     cdef int hot_page_age = g.HOT_PAGE_AGE
-    cdef int i
-    cdef double hot
-    cdef double thot # the top hotness on a given subreddit
-    cdef double ehot # the effective normalised hotness of a given link
     cdef double es
 
-    cdef list links
     cdef list queries
     cdef list cachedresults
+    cdef list hots
+    cdef list fnames
 
-    links = []
     queries = []
     cachedresults = []
 
+    srs = Subreddit._byID(sr_ids, return_dict = False)
     for sr in srs:
         q = sr.get_links('hot', 'all')
         if isinstance(q, CachedResults):
             cachedresults.append(q)
-        queries.append(q)
+        queries.append((sr._id, q))
 
     # fetch these all in one go
     CachedResults.fetch_multi(cachedresults)
@@ -63,51 +84,63 @@ cpdef list get_hot(list srs, only_fullnames = True):
     if hot_page_age:
         oldest = time() - 60*60*24*hot_page_age
 
-    for q in queries:
+    ret = {}
+    for sr_id, q in queries:
+        hots, fnames = [], []
 
         if isinstance(q, Query):
             if hot_page_age:
                 q._filter(Link.c._date > timeago('%d days' % hot_page_age))
             q._limit = max_items
-            for i, link in enumerate(q):
+            for link in q:
                 es = epoch_seconds(link._date)
                 if not hot_page_age or es > oldest:
-                    hot = link._hot
-                    if i == 0:
-                        thot = max(hot, 1.0)
-                        ehot = 1.0
-                    else:
-                        ehot = hot/thot
-                    links.append((ehot, hot, link._fullname))
+                    hots.append(link._hot)
+                    fnames.append(link._fullname)
 
         elif isinstance(q, CachedResults):
             # we're relying on an implementation detail of
-            # CachedResults here, where it's storing tuples that look
-            # exactly like the return-type we want, to make our
-            # sorting a bit cheaper
-
-            for i, (fname, hot, es) in enumerate(q.data[:max_items]):
+            # CachedResults here, where it's storing tuples of
+            # (fullname, hot, date)
+            for fname, hot, es in q.data[:max_items]:
                 if not hot_page_age or es > oldest:
-                    if i == 0:
-                        thot = max(hot, 1.0)
-                        ehot = 1.0
-                    else:
-                        ehot = hot/thot
-                    links.append((ehot, hot, fname))
+                    hots.append(hot)
+                    fnames.append(fname)
+
+        ret[sr_id] = _pack_hot_list(hots, fnames)
+
+    return ret
+
+def get_hot_lists(sr_ids):
+    """The packed normalised hot lists of the given subreddits, all
+       fetched from the cache in one round trip. Popular lists expire
+       under every app thread at once, so misses are single-flight:
+       each list is only rebuilt by one of them while the rest wait
+       for it."""
+    lists = sgm(g.cache, sr_ids, miss_fn = _load_hot_lists,
+                prefix = hot_list_prefix, time = g.page_cache_time,
+                single_flight = True, stats = g.stats)
+    return lists.values()
+
+def _iter_hot_list(tuple packed):
+    ehots, hots = array('d'), array('d')
+    ehots.fromstring(packed[0])
+    hots.fromstring(packed[1])
+    # negated so that heapq.merge gives us the hottest first
+    return izip(imap(neg, ehots), imap(neg, hots), packed[2])
+
+def merge_hot(lists):
+    """Lazily interleave packed hot lists in order of normalised
+       hotness, yielding (-ehot, -hot, fullname). Each list is already
+       sorted, so we only do as much work as the caller consumes."""
+    return heapq.merge(*[_iter_hot_list(l) for l in lists])
 
-    links.sort(reverse=True)
+cpdef list get_hot(list srs, only_fullnames = True):
+    """Get the fullnames for the hottest normalised hottest links in a
+       subreddit."""
+    links = merge_hot(get_hot_lists([sr._id for sr in srs]))
 
     if only_fullnames:
-        return map(_second, links)
+        return [fname for (nehot, nhot, fname) in links]
     else:
-        return links
-
-cpdef _second(tuple x):
-    return x[2]
-
-# memoized by our caller in normalized_hot.py
-cpdef list normalized_hot_cached(sr_ids):
-    """Fetches the hot lists for each subreddit, normalizes the
-       scores, and interleaves the results."""
-    srs = Subreddit._byID(sr_ids, return_dict = False)
-    return get_hot(srs, True)
+        return [(-nehot, -nhot, fname) for (nehot, nhot, fname) in links]
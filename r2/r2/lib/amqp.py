@@ -20,14 +20,15 @@
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
 
-from Queue import Queue
-from threading import local, Thread
+from Queue import Queue, Full, Empty
+from threading import local, Thread, Lock
 from datetime import datetime
 import os
 import sys
 import time
 import errno
 import socket
+import select
 import itertools
 import cPickle as pickle
 
@@ -139,6 +140,14 @@ connection_manager = ConnectionManager()
 DELIVERY_TRANSIENT = 1
 DELIVERY_DURABLE = 2
 
+def _make_message(body, message_id = None, delivery_mode = DELIVERY_DURABLE):
+    msg = amqp.Message(body,
+                       timestamp = datetime.now(),
+                       delivery_mode = delivery_mode)
+    if message_id:
+        msg.properties['message_id'] = message_id
+    return msg
+
 def _add_item(routing_key, body, message_id = None,
               delivery_mode = DELIVERY_DURABLE):
     """adds an item onto a queue. If the connection to amqp is lost it
@@ -148,11 +157,7 @@ def _add_item(routing_key, body, message_id = None,
         return
 
     chan = connection_manager.get_channel()
-    msg = amqp.Message(body,
-                       timestamp = datetime.now(),
-                       delivery_mode = delivery_mode)
-    if message_id:
-        msg.properties['message_id'] = message_id
+    msg = _make_message(body, message_id, delivery_mode)
 
     try:
         chan.basic_publish(msg,
@@ -165,10 +170,142 @@ def _add_item(routing_key, body, message_id = None,
         else:
             raise
 
+class Publisher(object):
+    """Publishes messages from a bounded in-memory backlog on `threads'
+       background threads, each with its own connection and channel.
+       Each thread publishes whatever has piled up (up to `batch_size'
+       messages) in one go, and with `confirm' does so in an AMQP
+       transaction, so that the batch is only done when the broker has
+       taken it. (amqplib speaks AMQP 0-8, which predates RabbitMQ's
+       confirm.select, so a tx.commit is our publisher confirm.)
+
+       Each thread has its own share of the backlog, and a routing key
+       always goes to the same thread, so that the messages for any one
+       queue are published in the order they were put (like the single
+       Worker did), e.g. a vote and then its reversal.
+
+       A batch that fails is retried once on a new connection; without
+       `confirm' that can publish some of its messages twice. When the
+       backlog is full, put() waits up to `put_timeout' seconds for
+       room and then drops the message rather than block the app."""
+    batch_size = 100
+
+    def __init__(self, threads = 1, backlog = 10000, confirm = False,
+                 put_timeout = 0):
+        self.n_threads = max(threads, 1)
+        self.confirm = confirm
+        self.put_timeout = put_timeout
+        self.queues = [Queue(max(backlog // self.n_threads, 1))
+                       for x in xrange(self.n_threads)]
+        self.threads = []
+        self.start_lock = Lock()
+        self.local = local()
+        self.dropped = 0
+
+    def start(self):
+        # app threads may all try this on their first put, and two
+        # threads draining one queue would publish it out of order
+        with self.start_lock:
+            for q in self.queues[len(self.threads):]:
+                t = Thread(target = self._run, args = (q,))
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+
+    def put(self, routing_key, body, message_id = None,
+            delivery_mode = DELIVERY_DURABLE):
+        if len(self.threads) < self.n_threads:
+            self.start()
+        item = (routing_key, body, message_id, delivery_mode, time.time())
+        q = self.queues[hash(routing_key) % self.n_threads]
+        try:
+            q.put(item, self.put_timeout > 0, self.put_timeout or None)
+        except Full:
+            g.stats.incr('amqp.publish.dropped_full')
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                log.error("amqp: publish backlog full, dropping message to "
+                          "%r (%d dropped so far)"
+                          % (routing_key, self.dropped))
+
+    def join(self):
+        for q in self.queues:
+            q.join()
+
+    def _run(self, q):
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                self._publish(batch)
+            except:
+                import traceback
+                print traceback.format_exc()
+            finally:
+                for item in batch:
+                    q.task_done()
+
+    def _publish(self, batch):
+        start = time.time()
+        g.stats.timing('amqp.publish.queued', start - batch[0][-1])
+
+        for attempt in (0, 1):
+            chan = connection_manager.get_channel(reconnect = attempt > 0)
+            try:
+                tx_chan = getattr(self.local, 'tx_chan', None)
+                if self.confirm and tx_chan is not chan:
+                    chan.tx_select()
+                    self.local.tx_chan = chan
+
+                for routing_key, body, message_id, delivery_mode, t in batch:
+                    chan.basic_publish(_make_message(body, message_id,
+                                                     delivery_mode),
+                                       exchange = amqp_exchange,
+                                       routing_key = routing_key)
+
+                if self.confirm:
+                    chan.tx_commit()
+            except (socket.error, IOError, amqp.AMQPException), e:
+                log.error("amqp: error publishing %d messages (%r)"
+                          % (len(batch), e))
+                g.stats.incr('amqp.publish.errors')
+                continue
+
+            g.stats.incr('amqp.publish.batches')
+            g.stats.incr('amqp.publish.messages', len(batch))
+            g.stats.timing('amqp.publish.flush', time.time() - start)
+            return
+
+        g.stats.incr('amqp.publish.dropped_error', len(batch))
+
+publisher = None
+if g.amqp_batch_publish:
+    publisher = Publisher(threads = g.amqp_publisher_threads,
+                          backlog = g.amqp_publish_backlog,
+                          confirm = g.amqp_publish_confirm,
+                          put_timeout = g.amqp_publish_timeout)
+
+def join():
+    """Wait for everything handed to add_item (and the worker) so far to
+       be done"""
+    worker.join()
+    if publisher:
+        publisher.join()
+
 def add_item(routing_key, body, message_id = None, delivery_mode = DELIVERY_DURABLE):
     if amqp_host and amqp_logging:
         log.debug("amqp: adding item %r to %r" % (body, routing_key))
 
+    if publisher and amqp_host:
+        publisher.put(routing_key, body, message_id = message_id,
+                      delivery_mode = delivery_mode)
+        return
+
     worker.do(_add_item, routing_key, body, message_id = message_id,
               delivery_mode = delivery_mode)
 
@@ -212,7 +349,138 @@ def consume_items(queue, callback, verbose=True):
             except KeyboardInterrupt:
                 break
     finally:
-        worker.join()
+        join()
+        if chan.is_open:
+            chan.close()
+
+def _buffered(chan):
+    """True if amqplib has already read more input than it's handled,
+       in which case the socket may have nothing left to select on"""
+    if chan.method_queue:
+        return True
+    conn = chan.connection
+    # frames that the connection has read but not yet dispatched
+    queue = getattr(getattr(conn, 'method_reader', None), 'queue', None)
+    if queue:
+        empty = getattr(queue, 'empty', None)
+        if empty is None or not empty():
+            return True
+    # and bytes read from the socket but not yet framed (the transport
+    # reads 64k at a time, so a burst of small messages ends up here)
+    return bool(getattr(conn.transport, '_read_buffer', None))
+
+def _wait_for_message(chan, timeout):
+    """chan.wait(), unless nothing arrives within `timeout' seconds, in
+       which case return False"""
+    # amqplib's wait() can't time out, so check the socket first (unless
+    # there's already input waiting to be handled)
+    if not _buffered(chan):
+        sock = chan.connection.transport.sock
+        readable, _, _ = select.select([sock], [], [], max(timeout, 0))
+        if not readable:
+            return False
+    chan.wait()
+    return True
+
+class _BatchChannel(object):
+    """Handed to consume_batches' callbacks in place of the channel, to
+       keep track of the messages they reject: those are gone from the
+       broker's point of view, and acking (or rejecting) them again
+       would get the channel closed"""
+    def __init__(self, chan):
+        self.chan = chan
+        self.rejected = set()
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.chan.basic_reject(delivery_tag, requeue)
+        self.rejected.add(delivery_tag)
+
+    def __getattr__(self, attr):
+        return getattr(self.chan, attr)
+
+def consume_batches(queue, callback, ack = True, limit = 100, max_wait = 1,
+                    verbose = True):
+    """Like handle_items, but with the broker pushing items to us
+       (basic.consume, with a basic.qos prefetch of two batches) rather
+       than us polling for them. A batch is handed to callback(items,
+       chan) when it reaches `limit' items or `max_wait' seconds after
+       its first item arrived, whichever is sooner, and is acked as a
+       whole afterwards. The size, age and processing time of each
+       batch are recorded in g.stats under amqp.<queue>."""
+    from pylons import c
+
+    chan = connection_manager.get_channel()
+    if ack:
+        # prefetch_count is a short
+        chan.basic_qos(0, min(limit * 2, 65535), False)
+
+    pending = []
+    chan.basic_consume(queue = queue, callback = pending.append,
+                       no_ack = not ack)
+
+    stat = 'amqp.' + queue
+    try:
+        while chan.callbacks:
+            try:
+                # wait as long as it takes for the first item...
+                while not pending and chan.callbacks:
+                    chan.wait()
+                if not pending:
+                    break
+                # ...and then only so long for the rest of the batch
+                deadline = time.time() + max_wait
+                while len(pending) < limit:
+                    if not _wait_for_message(chan, deadline - time.time()):
+                        break
+            except KeyboardInterrupt:
+                break
+
+            items = pending[:limit]
+            del pending[:limit]
+
+            g.reset_caches()
+            c.use_write_db = {}
+
+            if verbose:
+                print "%s: %d items (%d prefetched)" % (queue, len(items),
+                                                        len(pending))
+
+            g.stats.incr(stat + '.batches')
+            g.stats.incr(stat + '.items', len(items))
+            sent = items[0].properties.get('timestamp')
+            if sent:
+                lag = datetime.now() - sent
+                g.stats.timing(stat + '.lag',
+                               max(lag.days * 86400 + lag.seconds, 0))
+
+            start = time.time()
+            batch_chan = _BatchChannel(chan)
+            try:
+                callback(items, batch_chan)
+
+                if ack:
+                    # everything up to and including the last of these
+                    # that the callback didn't reject (but not anything
+                    # prefetched since)
+                    tags = [item.delivery_tag for item in items
+                            if item.delivery_tag not in batch_chan.rejected]
+                    if tags:
+                        chan.basic_ack(max(tags), multiple = True)
+
+                # flush any log messages printed by the callback
+                sys.stdout.flush()
+            except:
+                if ack:
+                    for item in items:
+                        # explicitly reject the items that we've not
+                        # processed
+                        if item.delivery_tag not in batch_chan.rejected:
+                            chan.basic_reject(item.delivery_tag,
+                                              requeue = True)
+                raise
+            g.stats.timing(stat + '.processing', time.time() - start)
+    finally:
+        join()
         if chan.is_open:
             chan.close()
 
@@ -220,9 +488,16 @@ def handle_items(queue, callback, ack = True, limit = 1, drain = False,
                  verbose=True, sleep_time = 1):
     """Call callback() on every item in a particular queue. If the
        connection to the queue is lost, it will die. Intended to be
-       used as a long-running process."""
+       used as a long-running process.
+
+       With g.amqp_consume_batches, long-running consumers (those that
+       don't `drain') are handed to consume_batches instead."""
     from pylons import c
 
+    if g.amqp_consume_batches and not drain:
+        return consume_batches(queue, callback, ack = ack, limit = limit,
+                               verbose = verbose)
+
     chan = connection_manager.get_channel()
     countdown = None
 
@@ -337,7 +612,7 @@ def dedup_queue(queue, rk = None, limit=None,
         for body in bodies:
             _add_item(rk, body, delivery_mode = delivery_mode)
 
-        worker.join()
+        join()
 
         chan.basic_ack(0, multiple=True)
 
@@ -358,4 +633,4 @@ def test_consume(test_q = 'test_q'):
 def test_produce(test_q = 'test_q', msg_body = 'hello, world!'):
     _test_setup()
     add_item(test_q, msg_body)
-    worker.join()
+    join()
@@ -33,6 +33,7 @@ from r2.lib.cache import HardCache, MemcacheChain, MemcacheChain, HardcacheChain
 from r2.lib.cache import CassandraCache, CassandraCacheChain, CacheChain, CL_ONE, CL_QUORUM
 from r2.lib.utils import thread_dump
 from r2.lib.db.stats import QueryStats
+from r2.lib.stats import Stats
 from r2.lib.translation import get_active_langs
 from r2.lib.lock import make_lock_factory
 from r2.lib.manager import db_manager
@@ -68,11 +69,20 @@ class Globals(object):
                  'sr_dropdown_threshold',
                  'comment_visits_period',
                   'min_membership_create_community',
+                 'trace_slow_request_ms',
+                 'rising_size',
+                 'sgm_negative_time',
+                 'usage_flush_interval',
+                 'amqp_publisher_threads',
+                 'amqp_publish_backlog',
                  ]
 
     float_props = ['min_promote_bid',
                    'max_promote_bid',
                    'usage_sampling',
+                   'trace_slow_sample_rate',
+                   'sql_annotation_stack_rate',
+                   'amqp_publish_timeout',
                    ]
 
     bool_props = ['debug', 'translator',
@@ -82,12 +92,21 @@ class Globals(object):
                   'uncompressedJS',
                   'enable_doquery',
                   'use_query_cache',
+                  'packed_query_cache',
+                  'incremental_time_listings',
+                  'incremental_rising',
+                  'sgm_single_flight',
+                  'permacache_cas',
+                  'trace_requests',
                   'write_query_queue',
                   'css_killswitch',
                   'db_create_tables',
                   'disallow_db_writes',
                   'exception_logging',
                   'amqp_logging',
+                  'amqp_consume_batches',
+                  'amqp_batch_publish',
+                  'amqp_publish_confirm',
                   'read_only_mode',
                   'frontpage_dart',
                   'allow_wiki_editing',
@@ -118,6 +137,9 @@ class Globals(object):
                                       'QUORUM': CL_QUORUM},
                     'cassandra_wcl': {'ONE':    CL_ONE,
                                       'QUORUM': CL_QUORUM},
+                    'sql_annotation': {'off':   'off',
+                                       'tag':   'tag',
+                                       'stack': 'stack'},
                     }
 
 
@@ -192,9 +214,13 @@ class Globals(object):
         if self.heavy_load_mode:
             self.read_only_mode = True
 
+        # process-local counters and timers
+        self.stats = Stats()
+
         if hasattr(signal, 'SIGUSR1'):
             # not all platforms have user signals
             signal.signal(signal.SIGUSR1, thread_dump)
+            signal.signal(signal.SIGUSR2, self.stats.dump)
 
         # initialize caches. Any cache-chains built here must be added
         # to cache_chains (closed around by reset_caches) so that they
@@ -207,7 +233,7 @@ class Globals(object):
         self.cache_chains = []
 
         self.memcache = CMemcache(self.memcaches, num_clients = num_mc_clients)
-        self.make_lock = make_lock_factory(self.memcache)
+        self.make_lock = make_lock_factory(self.memcache, stats = self.stats)
 
         if not self.cassandra_seeds:
             raise ValueError("cassandra_seeds not set in the .ini")
@@ -226,7 +252,9 @@ class Globals(object):
                                                              read_consistency_level = self.cassandra_rcl,
                                                              write_consistency_level = self.cassandra_wcl),
                                               memcache = perma_memcache,
-                                              lock_factory = self.make_lock)
+                                              lock_factory = self.make_lock,
+                                              cas = self.permacache_cas,
+                                              stats = self.stats)
 
         self.cache_chains.append(self.permacache)
 
@@ -392,6 +420,11 @@ class Globals(object):
             return
 
         dbm = db_manager.db_manager()
+        dbm.stats = self.stats
+        dbm.max_replica_lag = float(gc.get('db_max_replica_lag', 0))
+        # relative share of reads for each db, as name:weight
+        read_weights = dict(w.split(':') for w in
+                            self.to_iter(gc.get('db_read_weights', '')))
         db_param_names = ('name', 'db_host', 'db_user', 'db_pass', 'db_port',
                           'pool_size', 'max_overflow')
         for db_name in self.databases:
@@ -412,7 +445,8 @@ class Globals(object):
             ip = params['db_host']
             ip_loads = get_db_load(self.servicecache, ip)
             if ip not in ip_loads or ip_loads[ip][0] < 1000:
-                dbm.setup_db(db_name, g_override=self, **params)
+                dbm.setup_db(db_name, g_override=self,
+                             weight=read_weights.get(db_name, 1), **params)
             self.db_params[db_name] = params
 
         dbm.type_db = dbm.get_engine(gc['type_db'])
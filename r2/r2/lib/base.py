@@ -29,6 +29,7 @@ from r2.lib.filters import spaceCompress, _force_unicode
 from r2.lib.template_helpers import get_domain
 from utils import storify, string2js, read_http_date
 from r2.lib.log import log_exception
+from r2.lib import tracing
 
 import re, hashlib
 from urllib import quote
@@ -97,6 +98,8 @@ class BaseController(WSGIController):
                     meth + '_' + action
 
         c.response = Response()
+        if g.trace_requests:
+            c.trace = tracing.begin(request.fullpath)
         try:
             res = WSGIController.__call__(self, environ, start_response)
         except Exception as e:
@@ -107,8 +110,18 @@ class BaseController(WSGIController):
                     print "log_exception() freaked out: %r" % f
                     print "sorry for breaking the stack trace:"
             raise
+        finally:
+            if g.trace_requests:
+                self.finish_trace()
         return res
 
+    def finish_trace(self):
+        trace = tracing.end()
+        if trace and tracing.should_log(trace, g.trace_slow_request_ms,
+                                        g.trace_slow_sample_rate):
+            g.stats.incr('tracing.slow_requests')
+            tracing.log_trace(trace, g.trace_log)
+
     def pre(self): pass
     def post(self): pass
 
@@ -20,7 +20,9 @@
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
 from pylons import g
-from itertools import chain
+from itertools import chain, izip
+from array import array
+import struct
 from r2.lib.utils import tup, to36
 from r2.lib.db.sorts import epoch_seconds
 from r2.lib.cache import sgm
@@ -28,15 +30,24 @@ from r2.models.link import Link
 
 MAX_ITERATIONS = 20000
 
+# the number of comments that are appended to a link's tree delta
+# before it's folded back into the stored tree
+MAX_DELTA_SIZE = 100
+
 def comments_key(link_id):
+    # legacy (cids, comment_tree, depth, num_children) tuple, only
+    # read to migrate trees to the CommentTree format
     return 'comments_' + str(link_id)
 
+def tree_key(link_id):
+    return 'comment_tree_' + str(link_id)
+
+def tree_delta_key(link_id):
+    return 'comment_tree_delta_' + str(link_id)
+
 def lock_key(link_id):
     return 'comment_lock_' + str(link_id)
 
-def parent_comments_key(link_id):
-    return 'comments_parents_' + str(link_id)
-
 def sort_comments_key(link_id, sort):
     assert sort.startswith('_')
     return '%s%s' % (to36(link_id), sort)
@@ -46,6 +57,230 @@ def _get_sort_value(comment, sort):
         return epoch_seconds(comment._date)
     return getattr(comment, sort)
 
+class CommentTree(object):
+    """The shape of the comment tree of a link, stored as parallel
+       arrays indexed by the order in which the comments were added,
+       rather than as dicts keyed by comment id:
+
+         ids          =:= comment id at each position
+         parents      =:= position of the parent (ROOT for top-level
+                          comments, DELETED for removed ones)
+         depths       =:= depth of the comment (0 for top-level)
+         counts       =:= number of descendants
+         first_child  =:= position of the most recently added child
+         next_sibling =:= position of the previously added sibling
+
+       Adding a comment is an append plus an O(depth) walk up the
+       parents to update the descendant counts."""
+    ROOT = -1
+    DELETED = -2
+
+    _magic = 'CT'
+    _version = 1
+    _header = struct.Struct('<2sBBIi')
+
+    def __init__(self):
+        self.ids = array('l')
+        self.parents = array('l')
+        self.depths = array('l')
+        self.counts = array('l')
+        self.first_child = array('l')
+        self.next_sibling = array('l')
+        self.first_root = -1
+        self._index = None
+
+    def _arrays(self):
+        return (self.ids, self.parents, self.depths, self.counts,
+                self.first_child, self.next_sibling)
+
+    @property
+    def index(self):
+        """comment id -> position, built the first time it's needed"""
+        if self._index is None:
+            self._index = dict((cid, pos)
+                               for pos, (cid, parent)
+                               in enumerate(izip(self.ids, self.parents))
+                               if parent != self.DELETED)
+        return self._index
+
+    def __contains__(self, cid):
+        return cid in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return '<CommentTree(%d)>' % len(self.ids)
+
+    def cids(self):
+        """The ids of all comments in the tree, in the order they were
+           added"""
+        return [cid for cid, parent in izip(self.ids, self.parents)
+                if parent != self.DELETED]
+
+    def parent(self, cid):
+        parent = self.parents[self.index[cid]]
+        return self.ids[parent] if parent >= 0 else None
+
+    def depth(self, cid, default=None):
+        pos = self.index.get(cid)
+        return self.depths[pos] if pos is not None else default
+
+    def num_children(self, cid):
+        return self.counts[self.index[cid]]
+
+    def children(self, cid):
+        """The ids of the direct children of `cid' (or of the
+           top-level comments if it's None) in the order they were
+           added"""
+        pos = self.first_root if cid is None else self.first_child[self.index[cid]]
+        ret = []
+        while pos >= 0:
+            ret.append(self.ids[pos])
+            pos = self.next_sibling[pos]
+        ret.reverse()
+        return ret
+
+    def has_children(self, cid):
+        return self.first_child[self.index[cid]] >= 0
+
+    def add(self, cid, parent_id):
+        """Add a comment to the tree. Raises KeyError if its parent
+           isn't in the tree, and returns False if the comment already
+           was."""
+        index = self.index
+        if cid in index:
+            return False
+
+        parent = index[parent_id] if parent_id else self.ROOT
+        pos = len(self.ids)
+
+        self.ids.append(cid)
+        self.parents.append(parent)
+        self.depths.append(self.depths[parent] + 1 if parent >= 0 else 0)
+        self.counts.append(0)
+        self.first_child.append(-1)
+        if parent >= 0:
+            self.next_sibling.append(self.first_child[parent])
+            self.first_child[parent] = pos
+        else:
+            self.next_sibling.append(self.first_root)
+            self.first_root = pos
+        index[cid] = pos
+
+        iteration_count = 0
+        while parent >= 0:
+            if iteration_count > MAX_ITERATIONS:
+                raise Exception("bad comment tree (adding %s)" % cid)
+            self.counts[parent] += 1
+            parent = self.parents[parent]
+            iteration_count += 1
+
+        return True
+
+    def add_many(self, pairs):
+        """Add (comment_id, parent_id) pairs, returning the ones that
+           weren't already in the tree"""
+        return [(cid, parent_id) for (cid, parent_id) in pairs
+                if self.add(cid, parent_id)]
+
+    def remove(self, cid):
+        """Remove a comment with no children from the tree. Like the
+           old dict-based trees, the descendant counts of its parents
+           aren't changed. Returns True if it was removed."""
+        pos = self.index.get(cid)
+        if pos is None or self.first_child[pos] >= 0:
+            return False
+
+        parent = self.parents[pos]
+        if parent >= 0:
+            head = self.first_child[parent]
+        else:
+            head = self.first_root
+
+        if head == pos:
+            if parent >= 0:
+                self.first_child[parent] = self.next_sibling[pos]
+            else:
+                self.first_root = self.next_sibling[pos]
+        else:
+            prev = head
+            while self.next_sibling[prev] != pos:
+                prev = self.next_sibling[prev]
+            self.next_sibling[prev] = self.next_sibling[pos]
+
+        self.parents[pos] = self.DELETED
+        self.next_sibling[pos] = -1
+        del self.index[cid]
+        return True
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Build a tree from (comment_id, parent_id) pairs in any
+           order. Comments whose parents are missing are dropped."""
+        children = {}
+        for cid, parent_id in pairs:
+            children.setdefault(parent_id, []).append(cid)
+
+        tree = cls()
+        cur_level = [(cid, None) for cid in children.get(None, ())]
+        while cur_level:
+            next_level = []
+            for cid, parent_id in cur_level:
+                tree.add(cid, parent_id)
+                next_level.extend((child, cid)
+                                  for child in children.get(cid, ()))
+            cur_level = next_level
+        return tree
+
+    @classmethod
+    def from_legacy(cls, cids, comment_tree):
+        parents = {}
+        for parent, childs in comment_tree.iteritems():
+            for child in childs:
+                parents[child] = parent
+        return cls.from_pairs((cid, parents.get(cid)) for cid in cids
+                              if cid in parents)
+
+    def to_legacy(self):
+        """The old (cids, comment_tree, depth, num_children) tuple"""
+        cids = self.cids()
+        comment_tree = {}
+        for cid in cids:
+            parent = self.parent(cid)
+            comment_tree.setdefault(parent, []).append(cid)
+        depth = dict((cid, self.depth(cid)) for cid in cids)
+        num_children = dict((cid, self.num_children(cid)) for cid in cids)
+        return cids, comment_tree, depth, num_children
+
+    def to_string(self):
+        itemsize = self.ids.itemsize
+        parts = [self._header.pack(self._magic, self._version, itemsize,
+                                   len(self.ids), self.first_root)]
+        parts.extend(a.tostring() for a in self._arrays())
+        return ''.join(parts)
+
+    @classmethod
+    def from_string(cls, s):
+        magic, version, itemsize, count, first_root = cls._header.unpack_from(s)
+        tree = cls()
+        if magic != cls._magic or version != cls._version:
+            raise ValueError("not a comment tree (%r, %r)" % (magic, version))
+        if itemsize != tree.ids.itemsize:
+            raise ValueError("comment tree written with itemsize %d"
+                             % itemsize)
+
+        size = count * itemsize
+        pos = cls._header.size
+        for a in tree._arrays():
+            a.fromstring(s[pos:pos + size])
+            pos += size
+        if pos != len(s):
+            raise ValueError("corrupt comment tree (%d != %d)" % (pos, len(s)))
+
+        tree.first_root = first_root
+        return tree
+
 def add_comments(comments):
     comments = tup(comments)
 
@@ -63,75 +298,31 @@ def add_comments(comments):
                 link_id)
 
             # calculate it from scratch
-            link_comments(link_id, _update = True)
+            link_comment_tree(link_id, _update = True)
         update_comment_votes(coms)
 
 def add_comments_nolock(link_id, comments):
-    cids, comment_tree, depth, num_children = link_comments(link_id)
-
-    #dfs to find the list of parents for the new comment
-    def find_parents():
-        stack = [cid for cid in comment_tree[None]]
-        parents = []
-        while stack:
-            cur_cm = stack.pop()
-            if cur_cm == cm_id:
-                return parents
-            elif cur_cm in comment_tree:
-                #make cur_cm the end of the parents list
-                parents = parents[:depth[cur_cm]] + [cur_cm]
-                for child in comment_tree[cur_cm]:
-                    stack.append(child)
-
-    new_parents = {}
-    for comment in comments:
-        cm_id = comment._id
-        p_id = comment.parent_id
-
-        #make sure we haven't already done this before (which would happen
-        #if the tree isn't cached when you add a comment)
-        if comment._id in cids:
-            continue
-
-        #add to comment list
-        cids.append(comment._id)
-
-        #add to tree
-        comment_tree.setdefault(p_id, []).append(cm_id)
-
-        #add to depth
-        depth[cm_id] = depth[p_id] + 1 if p_id else 0
-
-        #update children
-        num_children[cm_id] = 0
-
-        #if this comment had a parent, find the parent's parents
-        if p_id:
-            new_parents[cm_id] = p_id
-            for p_id in find_parents():
-                num_children[p_id] += 1
-
-    # update our cache of children -> parents as well:
-    key = parent_comments_key(link_id)
-    r = g.permacache.get(key)
-
-    if not r:
-        r = _parent_dict_from_tree(comment_tree)
-
-    for cm_id, parent_id in new_parents.iteritems():
-#        print "Now, I set %s -> %s" % (cm_id, parent_id)
-        r[cm_id] = parent_id
-
-    for comment in comments:
-        cm_id = comment._id
-        if cm_id not in new_parents:
-            r[cm_id] = None
-#            print "And I set %s -> None" % cm_id
-
-    g.permacache.set(key, r)
-
-    g.permacache.set(comments_key(link_id),
-                     (cids, comment_tree, depth, num_children))
+    tree, delta = _get_tree_and_delta(link_id)
+    if tree is None:
+        # this recomputes it from the database (which will include
+        # these comments) and writes it out with an empty delta
+        tree, delta = link_comment_tree(link_id), []
+
+    # comments that are already in the tree (which would happen if the
+    # tree isn't cached when you add a comment) are skipped by add_many
+    added = tree.add_many((comment._id, comment.parent_id)
+                          for comment in comments)
+    if not added:
+        return
+
+    # rather than rewriting the whole tree for every comment, we
+    # append them to a small delta that's applied at load time, and
+    # only fold it back into the tree every MAX_DELTA_SIZE comments
+    delta.extend(added)
+    if len(delta) >= MAX_DELTA_SIZE:
+        _set_tree(link_id, tree)
+    else:
+        g.permacache.set(tree_delta_key(link_id), delta)
 
 def update_comment_votes(comments, write_consistency_level = None):
     from r2.models import CommentSortsCache
@@ -154,18 +345,11 @@ def update_comment_votes(comments, write_consistency_level = None):
 
 def delete_comment(comment):
     with g.make_lock(lock_key(comment.link_id)):
-        cids, comment_tree, depth, num_children = link_comments(comment.link_id)
+        tree = link_comment_tree(comment.link_id)
 
         # only completely remove comments with no children
-        if comment._id not in comment_tree:
-            if comment._id in cids:
-                cids.remove(comment._id)
-            if comment._id in depth:
-                del depth[comment._id]
-            if comment._id in num_children:
-                del num_children[comment._id]
-            g.permacache.set(comments_key(comment.link_id),
-                             (cids, comment_tree, depth, num_children))
+        if tree.remove(comment._id):
+            _set_tree(comment.link_id, tree)
 
         # update the link's comment count and schedule it for search reindexing
         link = Link._byID(comment.link_id, data = True)
@@ -173,13 +357,6 @@ def delete_comment(comment):
         from r2.lib.db.queries import changed
         changed(link)
 
-def _parent_dict_from_tree(comment_tree):
-    parents = {}
-    for parent, childs in comment_tree.iteritems():
-        for child in childs:
-            parents[child] = parent
-    return parents
-
 def _comment_sorter_from_cids(cids, sort):
     from r2.models import Comment
     comments = Comment._byID(cids, data = False, return_dict = False)
@@ -202,39 +379,26 @@ def _get_comment_sorter(link_id, sort):
     return sorter
 
 def link_comments_and_sort(link_id, sort):
-    from r2.models import Comment, CommentSortsCache
-
-    # This has grown sort of organically over time. Right now the
-    # cache of the comments tree consists in three keys:
-    # 1. The comments_key: A tuple of
-    #      (cids, comment_tree, depth, num_children)
-    #    given:
-    #      cids         =:= [comment_id]
-    #      comment_tree =:= dict(comment_id -> [comment_id])
-    #      depth        =:= dict(comment_id -> int depth)
-    #      num_children =:= dict(comment_id -> int num_children)
-    # 2. The parent_comments_key =:= dict(comment_id -> parent_id)
+    from r2.models import Comment
+
+    # The cache of the comments tree consists of:
+    # 1. The tree_key: a CommentTree, serialised with to_string()
+    # 2. The tree_delta_key: a list of (comment_id, parent_id) for
+    #    the comments added since the tree_key was last written
     # 3. The comments_sorts keys =:= dict(comment_id36 -> float).
     #    These are represented by a Cassandra model
     #    (CommentSortsCache) rather than a permacache key. One of
     #    these exists for each sort (hot, new, etc)
 
-    # performance hack: preload these into the LocalCache at the same
-    # time
-    g.permacache.get_multi([comments_key(link_id),
-                            parent_comments_key(link_id)])
-
-    cids, cid_tree, depth, num_children = link_comments(link_id)
+    tree = link_comment_tree(link_id)
+    cids = tree.cids()
 
     # load the sorter
     sorter = _get_comment_sorter(link_id, sort)
 
-    sorter_needed = []
     if cids and not sorter:
-        sorter_needed = cids
         g.log.debug("comment_tree.py: sorter (%s) cache miss for Link %s"
                     % (sort, link_id))
-        sorter = {}
 
     sorter_needed = [x for x in cids if x not in sorter]
     if cids and sorter_needed:
@@ -246,63 +410,68 @@ def link_comments_and_sort(link_id, sort):
 
         sorter.update(_comment_sorter_from_cids(sorter_needed, sort))
 
-    # load the parents
-    key = parent_comments_key(link_id)
-    parents = g.permacache.get(key)
-    if parents is None:
-        g.log.debug("comment_tree.py: parents cache miss for Link %s"
-                    % link_id)
-        parents = {}
-    elif cids and not all(x in parents for x in cids):
-        g.log.debug("Error in comment_tree: parents inconsistent for Link %s"
-                    % link_id)
-        parents = {}
-
-    if not parents:
-        with g.make_lock(lock_key(link_id)):
-            # reload from the cache so the sorter and parents are
-            # maximally consistent
-            r = g.permacache.get(comments_key(link_id))
-            cids, cid_tree, depth, num_children = r
+    return tree, sorter
 
-            key = parent_comments_key(link_id)
-            if not parents:
-                parents = _parent_dict_from_tree(cid_tree)
-                g.permacache.set(key, parents)
+def _get_tree_and_delta(link_id):
+    """Load the stored tree with its delta applied, or None if it
+       isn't stored or can't be read. Also returns the delta so that
+       it can be appended to."""
+    key, dkey = tree_key(link_id), tree_delta_key(link_id)
+    r = g.permacache.get_multi([key, dkey])
+    s, delta = r.get(key), r.get(dkey) or []
+    if not s:
+        return None, delta
 
-    return cids, cid_tree, depth, num_children, parents, sorter
+    try:
+        tree = CommentTree.from_string(s)
+        tree.add_many(delta)
+    except (ValueError, KeyError), e:
+        g.log.error("comment_tree.py: bad tree for Link %s (%r)"
+                    % (link_id, e))
+        return None, delta
+
+    return tree, delta
+
+def _set_tree(link_id, tree):
+    g.permacache.set(tree_key(link_id), tree.to_string())
+    g.permacache.set(tree_delta_key(link_id), [])
+
+def link_comment_tree(link_id, _update=False):
+    if not _update:
+        tree, delta = _get_tree_and_delta(link_id)
+        if tree is not None:
+            return tree
+
+    # This operation can take longer than most (note the inner
+    # locks) better to time out request temporarily than to deal
+    # with an inconsistent tree
+    with g.make_lock(lock_key(link_id), timeout=180):
+        legacy = None if _update else g.permacache.get(comments_key(link_id))
+        if legacy:
+            # migrate the old dict-based tree rather than going to
+            # the database
+            cids, comment_tree, depth, num_children = legacy
+            tree = CommentTree.from_legacy(cids, comment_tree)
+            _set_tree(link_id, tree)
+            return tree
+
+        tree, num_comments = _load_link_comments(link_id)
+        _set_tree(link_id, tree)
+
+        # update the link's comment count and schedule it for search
+        # reindexing
+        link = Link._byID(link_id, data = True)
+        link.num_comments = num_comments
+        link._commit()
+        from r2.lib.db.queries import changed
+        changed(link)
 
+    return tree
 
 def link_comments(link_id, _update=False):
-    key = comments_key(link_id)
-
-    r = g.permacache.get(key)
-
-    if r and not _update:
-        return r
-    else:
-        # This operation can take longer than most (note the inner
-        # locks) better to time out request temporarily than to deal
-        # with an inconsistent tree
-        with g.make_lock(lock_key(link_id), timeout=180):
-            r = _load_link_comments(link_id)
-            # rebuild parent dict
-            cids, cid_tree, depth, num_children, num_comments = r
-            r = r[:-1]  # Remove num_comments from r; we don't need to cache it.
-            g.permacache.set(parent_comments_key(link_id),
-                             _parent_dict_from_tree(cid_tree))
-
-            g.permacache.set(key, r)
-
-            # update the link's comment count and schedule it for search
-            # reindexing
-            link = Link._byID(link_id, data = True)
-            link.num_comments = num_comments
-            link._commit()
-            from r2.lib.db.queries import changed
-            changed(link)
-
-        return r
+    """The comment tree of a link in the old dict-based format of
+       (cids, comment_tree, depth, num_children)"""
+    return link_comment_tree(link_id, _update=_update).to_legacy()
 
 def _load_link_comments(link_id):
     from r2.models import Comment
@@ -312,43 +481,10 @@ def _load_link_comments(link_id):
                        optimize_rules=True,
                        data = True)
     comments = list(q)
-    cids = [c._id for c in comments]
-
-    #make a tree
-    comment_tree = {}
-    for cm in comments:
-        p_id = cm.parent_id
-        comment_tree.setdefault(p_id, []).append(cm._id)
-
-    #calculate the depths
-    depth = {}
-    level = 0
-    cur_level = comment_tree.get(None, ())
-    while cur_level:
-        next_level = []
-        for cm_id in cur_level:
-            depth[cm_id] = level
-            next_level.extend(comment_tree.get(cm_id, ()))
-        cur_level = next_level
-        level += 1
-
-    #calc the number of children
-    num_children = {}
-    for cm_id in cids:
-        num = 0
-        todo = [cm_id]
-        iteration_count = 0
-        while todo:
-            if iteration_count > MAX_ITERATIONS:
-                raise Exception("bad comment tree for link %s" % link_id)
-            more = comment_tree.get(todo.pop(0), ())
-            num += len(more)
-            todo.extend(more)
-            iteration_count += 1
-        num_children[cm_id] = num
+    tree = CommentTree.from_pairs((c._id, c.parent_id) for c in comments)
 
     num_comments = sum(1 for c in comments if not c._deleted)
-    return cids, comment_tree, depth, num_children, num_comments
+    return tree, num_comments
 
 # message conversation functions
 def messages_key(user_id):
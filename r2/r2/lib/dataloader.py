@@ -0,0 +1,112 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""Batching for the per-item lookups done while wrapping things.
+
+Builder.wrap_items and the add_props implementations each need a
+handful of lookups per item (votes, saves, hides, ...). Rather than each
+of them hitting the backend separately, they register the keys they'll
+want with the request's DataLoader via need(), and the first load() of a
+source (or load_all()) fetches everything that's outstanding for it in
+one call. Sources are plain functions taking a set of keys and returning
+{key: value}, registered by name with register_source().
+"""
+from __future__ import with_statement
+from collections import defaultdict
+
+from pylons import g, c
+
+sources = {}
+
+def register_source(name, fn):
+    sources[name] = fn
+
+def rel_source(rel_cls, **kw):
+    """A source for a tdb_cassandra relation, keyed on (thing1_id36,
+       thing2_id36) pairs and returning the relations that exist"""
+    def load(keys):
+        by_thing1 = defaultdict(list)
+        for thing1_id, thing2_id in keys:
+            by_thing1[thing1_id].append(thing2_id)
+
+        ret = {}
+        for thing1_id, thing2_ids in by_thing1.iteritems():
+            ret.update(rel_cls._fast_query(thing1_id, thing2_ids, **kw))
+        return ret
+    return load
+
+class DataLoader(object):
+    def __init__(self, stats = None):
+        self.stats = stats
+        self.pending = defaultdict(set)
+        self.results = defaultdict(dict)
+        self.fetched = defaultdict(set)
+        # name -> [calls, keys], for seeing the fan-out of a request
+        self.fanout = {}
+
+    def __repr__(self):
+        return '<DataLoader %r>' % (self.fanout,)
+
+    def need(self, name, keys):
+        """Register keys that will be loaded from `name' later"""
+        if name not in sources:
+            raise KeyError('no dataloader source %r' % name)
+        fetched = self.fetched[name]
+        self.pending[name].update(k for k in keys if k not in fetched)
+
+    def load(self, name, keys = ()):
+        """Return {key: value} for the keys found in `name', fetching
+           them along with any others pending for it if need be"""
+        keys = list(keys)
+        self.need(name, keys)
+        if self.pending[name]:
+            self._fetch(name)
+        results = self.results[name]
+        return dict((k, results[k]) for k in keys if k in results)
+
+    def load_all(self):
+        """Fetch everything that's pending, one call per source"""
+        for name in self.pending.keys():
+            if self.pending[name]:
+                self._fetch(name)
+
+    def _fetch(self, name):
+        keys = self.pending.pop(name)
+        if self.stats:
+            with self.stats.timer('dataloader.%s' % name):
+                found = sources[name](keys)
+            self.stats.incr('dataloader.%s.calls' % name)
+            self.stats.incr('dataloader.%s.keys' % name, len(keys))
+        else:
+            found = sources[name](keys)
+
+        self.results[name].update(found)
+        self.fetched[name].update(keys)
+
+        calls, nkeys = self.fanout.get(name, (0, 0))
+        self.fanout[name] = (calls + 1, nkeys + len(keys))
+
+def request_loader():
+    """The DataLoader for the current request"""
+    loader = getattr(c, 'dataloader', None)
+    if not isinstance(loader, DataLoader):
+        loader = c.dataloader = DataLoader(g.stats)
+    return loader
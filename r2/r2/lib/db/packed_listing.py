@@ -0,0 +1,303 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""A compact binary encoding for the listings stored by CachedResults.
+
+Legacy listings are pickled lists of (fullname, sort_col, ...) tuples
+sorted descending by their sort columns. A packed listing stores the
+same data column-wise in a single string:
+
+    header:   magic ('CR'), version, number of sort columns, number of
+              items, number of fullname prefixes
+    prefixes: the distinct fullname prefixes ('t3', 't1', ...), each
+              preceded by its length
+    kinds:    one byte per item, the index of its fullname prefix
+    ids:      one unsigned 64-bit integer per item (the id36 as a number)
+    columns:  for each sort column, one double per item
+
+Because every column has a fixed width, the sort key of any item can
+be read straight out of the buffer, so finding an insertion point is a
+bisect over the buffer rather than a full unpickle/sort/repickle.
+"""
+import struct
+
+from r2.lib.utils import to36
+
+MAGIC = 'CR'
+VERSION = 1
+
+_header = struct.Struct('<2sBBIB')
+_id = struct.Struct('<Q')
+_double = struct.Struct('<d')
+_width = 8
+
+def is_packed(value):
+    """True if `value' is a packed listing (rather than a legacy list
+       of tuples)"""
+    return isinstance(value, str) and value[:len(MAGIC)] == MAGIC
+
+class PackedListing(object):
+    """A mutable, list-like view of a packed listing. Indexing returns
+       the same (fullname, sort_col, ...) tuples as the legacy format,
+       but they're only built when asked for."""
+
+    def __init__(self, ncols, prefixes=(), kinds=None, ids=None, cols=None):
+        self.ncols = ncols
+        self.prefixes = list(prefixes)
+        self._prefix_index = dict((p, i) for i, p in enumerate(self.prefixes))
+        self.kinds = kinds if kinds is not None else bytearray()
+        self.ids = ids if ids is not None else bytearray()
+        self.cols = (cols if cols is not None
+                     else [bytearray() for x in xrange(ncols)])
+
+    @classmethod
+    def from_string(cls, s):
+        if not is_packed(s):
+            raise ValueError("not a packed listing")
+
+        magic, version, ncols, count, nprefixes = _header.unpack_from(s)
+        if version != VERSION:
+            raise ValueError("unknown packed listing version %d" % version)
+
+        pos = _header.size
+        prefixes = []
+        for x in xrange(nprefixes):
+            size = ord(s[pos])
+            prefixes.append(s[pos+1:pos+1+size])
+            pos += 1 + size
+
+        kinds = bytearray(s[pos:pos+count])
+        pos += count
+
+        size = count * _width
+        ids = bytearray(s[pos:pos+size])
+        pos += size
+
+        cols = []
+        for x in xrange(ncols):
+            cols.append(bytearray(s[pos:pos+size]))
+            pos += size
+
+        if pos != len(s):
+            raise ValueError("corrupt packed listing (%d != %d)"
+                             % (pos, len(s)))
+
+        return cls(ncols, prefixes, kinds, ids, cols)
+
+    @classmethod
+    def from_tuples(cls, tuples, ncols):
+        """Build a packed listing from legacy tuples, which must
+           already be sorted"""
+        ret = cls(ncols)
+        for t in tuples:
+            ret._splice(len(ret), t)
+        return ret
+
+    @classmethod
+    def load(cls, value, ncols):
+        """Build a packed listing from whatever is in the cache, be it
+           packed, a legacy list or nothing at all"""
+        if is_packed(value):
+            return cls.from_string(value)
+        return cls.from_tuples(value or [], ncols)
+
+    def tostring(self):
+        parts = [_header.pack(MAGIC, VERSION, self.ncols, len(self),
+                              len(self.prefixes))]
+        for p in self.prefixes:
+            parts.append(chr(len(p)))
+            parts.append(p)
+        parts.append(str(self.kinds))
+        parts.append(str(self.ids))
+        parts.extend(str(col) for col in self.cols)
+        return ''.join(parts)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._tuple(x) for x in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._tuple(i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._tuple(i)
+
+    def __repr__(self):
+        return '<PackedListing(%d cols, %d items)>' % (self.ncols, len(self))
+
+    def _tuple(self, i):
+        return (self.fullname(i),) + self.key(i)
+
+    def fullname(self, i):
+        thing_id, = _id.unpack_from(self.ids, i * _width)
+        return '%s_%s' % (self.prefixes[self.kinds[i]], to36(thing_id))
+
+    def fullnames(self):
+        """Iterate over the fullnames only, without building tuples"""
+        for i in xrange(len(self)):
+            yield self.fullname(i)
+
+    def key(self, i):
+        """The sort columns of item `i' as a tuple"""
+        offset = i * _width
+        return tuple(_double.unpack_from(col, offset)[0]
+                     for col in self.cols)
+
+    def bisect(self, key):
+        """Where an item with sort columns `key' would be inserted,
+           after any items that compare equal to it (as a stable
+           descending sort of the legacy tuples would do)"""
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _encode_name(self, fullname, create=False):
+        try:
+            prefix, id36 = fullname.split('_', 1)
+            thing_id = int(id36, 36)
+        except ValueError:
+            raise ValueError("can't pack fullname %r" % (fullname,))
+
+        return self._kind(prefix, create), thing_id
+
+    def _kind(self, prefix, create=False):
+        kind = self._prefix_index.get(prefix)
+        if kind is None and create:
+            if len(self.prefixes) >= 255 or len(prefix) > 255:
+                raise ValueError("too many prefixes to pack %r" % (prefix,))
+            kind = len(self.prefixes)
+            self.prefixes.append(prefix)
+            self._prefix_index[prefix] = kind
+        return kind
+
+    def index(self, fullname):
+        """The position of `fullname' in the listing, or -1. Searches
+           the packed ids directly."""
+        kind, thing_id = self._encode_name(fullname)
+        if kind is None:
+            return -1
+
+        packed = _id.pack(thing_id)
+        start = 0
+        while True:
+            pos = self.ids.find(packed, start)
+            if pos < 0:
+                return -1
+            if pos % _width == 0 and self.kinds[pos // _width] == kind:
+                return pos // _width
+            start = pos + 1
+
+    def _splice(self, i, t):
+        if len(t) != self.ncols + 1:
+            raise ValueError("expected %d sort columns, got %r"
+                             % (self.ncols, t))
+        kind, thing_id = self._encode_name(t[0], create=True)
+        try:
+            values = [_double.pack(v) for v in t[1:]]
+            packed_id = _id.pack(thing_id)
+        except struct.error, e:
+            raise ValueError("can't pack %r: %s" % (t, e))
+
+        offset = i * _width
+        self.kinds[i:i] = chr(kind)
+        self.ids[offset:offset] = packed_id
+        for col, value in zip(self.cols, values):
+            col[offset:offset] = value
+
+    def _remove(self, i):
+        offset = i * _width
+        del self.kinds[i]
+        del self.ids[offset:offset + _width]
+        for col in self.cols:
+            del col[offset:offset + _width]
+
+    def truncate(self, limit):
+        offset = limit * _width
+        del self.kinds[limit:]
+        del self.ids[offset:]
+        for col in self.cols:
+            del col[offset:]
+
+    def insert(self, tuples, limit=None):
+        """Insert (fullname, sort_col, ...) tuples in place, replacing
+           any existing entries for the same fullnames and keeping the
+           listing to at most `limit' items. Returns False if nothing
+           could have changed."""
+        if (limit is not None and len(self) >= limit
+            and all(tuple(t[1:]) < self.key(len(self) - 1) for t in tuples)):
+            return False
+
+        for t in tuples:
+            i = self.index(t[0])
+            if i >= 0:
+                self._remove(i)
+
+        for t in tuples:
+            self._splice(self.bisect(tuple(t[1:])), t)
+
+        if limit is not None and len(self) > limit:
+            self.truncate(limit)
+        return True
+
+    def delete(self, fullnames):
+        """Remove the given fullnames. Returns True if any were found"""
+        changed = False
+        for fullname in fullnames:
+            try:
+                i = self.index(fullname)
+            except ValueError:
+                continue
+            if i >= 0:
+                self._remove(i)
+                changed = True
+        return changed
+
+    def merge(self, other, limit=None):
+        """Merge the items of another packed listing into this one.
+           Only the sort keys are read from `other'; fullnames are
+           copied over as packed ids. Doesn't remove duplicates."""
+        if other.ncols != self.ncols:
+            raise ValueError("can't merge listings with different sorts")
+
+        for i in xrange(len(other)):
+            kind = self._kind(other.prefixes[other.kinds[i]], create=True)
+            offset = i * _width
+            packed_id = str(other.ids[offset:offset + _width])
+            pos = self.bisect(other.key(i))
+            dst = pos * _width
+            self.kinds[pos:pos] = chr(kind)
+            self.ids[dst:dst] = packed_id
+            for col, ocol in zip(self.cols, other.cols):
+                col[dst:dst] = ocol[offset:offset + _width]
+
+        if limit is not None and len(self) > limit:
+            self.truncate(limit)
@@ -1,18 +1,23 @@
-from r2.models import Account, Link, Comment, Trial, Vote, SaveHide
+from r2.models import Account, Link, Comment, Trial, Vote, VoteBatch, SaveHide
+from r2.models import VoteBatchError
 from r2.models import Message, Inbox, Subreddit, ModContribSR, ModeratorInbox
 from r2.lib.db.thing import Thing, Merge
+from r2.lib.db import operators
 from r2.lib.db.operators import asc, desc, timeago
 from r2.lib.db.sorts import epoch_seconds
+from r2.lib.db.packed_listing import PackedListing, is_packed
 from r2.lib.utils import fetch_things2, tup, UniqueIterator, set_last_modified
 from r2.lib import utils
 from r2.lib.solrsearch import DomainSearchQuery
 from r2.lib import amqp, sup, filters
+from r2.lib.dataloader import register_source
 from r2.lib.comment_tree import add_comments, update_comment_votes
 
 import cPickle as pickle
 
 from datetime import datetime
 import itertools
+import heapq
 
 from pylons import g
 query_cache = g.permacache
@@ -50,6 +55,14 @@ db_times = dict(all = None,
 # changes there)
 time_filtered_sorts = set(('top', 'controversial'))
 
+_window_seconds = {}
+def window_seconds(interval):
+    """The length in seconds of a time filter like '1 week'"""
+    if interval not in _window_seconds:
+        td = datetime.now(g.tz) - utils.timeago(interval)
+        _window_seconds[interval] = td.days * 86400 + td.seconds
+    return _window_seconds[interval]
+
 #we need to define the filter functions here so cachedresults can be pickled
 def filter_identity(x):
     return x
@@ -75,6 +88,23 @@ class CachedResults(object):
     def sort(self):
         return self.query._sort
 
+    @property
+    def window(self):
+        """For listings restricted to recent items (like the top links
+           this week), the length of that window in seconds"""
+        for r in self.query._rules:
+            if (isinstance(r, operators.gte)
+                and r.lval.name == '_date'
+                and isinstance(r.rval, timeago)):
+                return window_seconds(r.rval.interval)
+        return None
+
+    def _expired(self, data):
+        """The fullnames in data that have aged out of the listing's
+           window. Relies on the date being the last sort column."""
+        cutoff = epoch_seconds(datetime.now(g.tz)) - self.window
+        return set(x[0] for x in data if x[-1] < cutoff)
+
     def fetch(self, force=False):
         """Loads the query from the cache."""
         self.fetch_multi([self], force=force)
@@ -88,9 +118,37 @@ class CachedResults(object):
         cached = query_cache.get_multi([cr.iden for cr in unfetched],
                                        allow_local = not force)
         for cr in unfetched:
-            cr.data = cached.get(cr.iden) or []
+            cr.data = cr._load(cached.get(cr.iden))
             cr._fetched = True
 
+            # incrementally maintained time listings may hold items
+            # that have aged out since they were last written to
+            if cr.data and cr.can_insert_windowed():
+                expired = cr._expired(cr.data)
+                if expired:
+                    cr.data = [x for x in cr.data if x[0] not in expired]
+
+    def _load(self, value):
+        """Turn a stored value (either a packed listing or a legacy
+           list of tuples) into something list-like"""
+        if is_packed(value):
+            return PackedListing.from_string(value)
+        return value or []
+
+    def _dump(self, data):
+        """Turn a listing into the value to store, packing it if
+           g.packed_query_cache is on. Falls back to the legacy list
+           of tuples if the listing can't be packed."""
+        if g.packed_query_cache:
+            if isinstance(data, PackedListing):
+                return data.tostring()
+            try:
+                return PackedListing.from_tuples(data,
+                                                 len(self.sort_cols)).tostring()
+            except ValueError, e:
+                log.debug("Can't pack %r: %s" % (self, e))
+        return list(data)
+
     def make_item_tuple(self, item):
         """Given a single 'item' from the result of a query build the tuple
         that will be stored in the query cache. It is effectively the
@@ -126,24 +184,84 @@ class CachedResults(object):
                        if r.lval.name == '_date'):
                 # if no time-rule is specified, then it's 'all'
                 return True
-        return False
+        return self.can_insert_windowed()
+
+    def can_insert_windowed(self):
+        """True for time-filtered top and controversial listings that
+           are kept up to date from the vote stream rather than only
+           rewritten by mr_top. Items that age out of the window are
+           dropped whenever the listing is written to or read."""
+        if not g.incremental_time_listings:
+            return False
+        return (self.query._sort in ([desc('_score'), desc('_date')],
+                                     [desc('_controversy'), desc('_date')])
+                and self.window is not None)
 
     def can_delete(self):
         "True if a item can be removed from the listing, always true for now."
         return True
 
     def _mutate(self, fn, willread=True):
-        self.data = query_cache.mutate(self.iden, fn, default=[], willread=willread)
+        data = query_cache.mutate(self.iden, fn, default=[], willread=willread)
+        self.data = self._load(data)
         self._fetched=True
 
+    @classmethod
+    def _mutate_multi(cls, jobs):
+        """Apply a list of (CachedResults, mutation fn) with one
+           batched mutate. Several fns for the same listing are applied
+           in the order they're given."""
+        crs, fns = {}, {}
+        for cr, fn in jobs:
+            crs.setdefault(cr.iden, []).append(cr)
+            fns.setdefault(cr.iden, []).append(fn)
+
+        def _chain(chained):
+            def _mutate(data):
+                for fn in chained:
+                    data = fn(data)
+                return data
+            return _mutate
+
+        data = query_cache.mutate_multi(dict((iden, _chain(chained))
+                                             for iden, chained
+                                             in fns.iteritems()),
+                                        default=[])
+        for iden, same in crs.iteritems():
+            for cr in same:
+                cr.data = cr._load(data[iden])
+                cr._fetched = True
+
     def insert(self, items):
         """Inserts the item into the cached data. This only works
            under certain criteria, see can_insert."""
         self._insert_tuples([self.make_item_tuple(item) for item in tup(items)])
 
     def _insert_tuples(self, t):
+        self._mutate(self._insert_fn(t))
+
+    def _insert_fn(self, t):
+        windowed = self.can_insert_windowed()
+        if windowed:
+            expired = self._expired(t)
+            t = [x for x in t if x[0] not in expired]
+
         def _mutate(data):
-            data = data or []
+            if g.packed_query_cache:
+                try:
+                    listing = PackedListing.load(data, len(self.sort_cols))
+                    changed = (windowed
+                               and listing.delete(self._expired(listing)))
+                    if listing.insert(t, limit=precompute_limit) or changed:
+                        return listing.tostring()
+                    return data
+                except ValueError, e:
+                    log.debug("Can't pack %r: %s" % (self, e))
+
+            data = list(self._load(data))
+            if windowed:
+                expired = self._expired(data)
+                data = [x for x in data if x[0] not in expired]
 
             # short-circuit if we already know that no item to be
             # added qualifies to be stored. Since we know that this is
@@ -165,17 +283,51 @@ class CachedResults(object):
                 data = data[:precompute_limit]
             return data
 
-        self._mutate(_mutate)
+        return _mutate
 
     def delete(self, items):
         """Deletes an item from the cached data."""
+        self._mutate(self._delete_fn(items))
+
+    def _delete_fn(self, items):
         fnames = set(self.filter(x)._fullname for x in tup(items))
 
         def _mutate(data):
+            if is_packed(data):
+                listing = PackedListing.from_string(data)
+                if not listing.delete(fnames):
+                    return data
+                return self._dump(listing)
+
             data = data or []
             return filter(lambda x: x[0] not in fnames,
                           data)
 
+        return _mutate
+
+    def expire(self):
+        """Drop the items that have aged out of a time listing's
+           window"""
+        def _mutate(data):
+            listing = self._load(data)
+            expired = self._expired(listing)
+            if not expired:
+                return data
+            return self._dump([x for x in listing if x[0] not in expired])
+        self._mutate(_mutate)
+
+    def _reconcile(self, tuples):
+        """Like _replace, but for incrementally kept time listings:
+           items that mr_top didn't see (like links submitted since it
+           dumped its data) are kept rather than thrown away"""
+        def _mutate(data):
+            names = set(x[0] for x in tuples)
+            merged = list(tuples)
+            merged.extend(x for x in self._load(data) if x[0] not in names)
+            expired = self._expired(merged)
+            merged = [x for x in merged if x[0] not in expired]
+            merged.sort(reverse=True, key=lambda x: x[1:])
+            return self._dump(merged[:precompute_limit])
         self._mutate(_mutate)
 
     def _replace(self, tuples):
@@ -183,7 +335,7 @@ class CachedResults(object):
            contents of the query outright. This should be considered a
            private API"""
         def _mutate(data):
-            return tuples
+            return self._dump(tuples)
         self._mutate(_mutate, willread=False)
 
     def update(self):
@@ -191,7 +343,7 @@ class CachedResults(object):
            only run by hand."""
         self.data = [self.make_item_tuple(i) for i in self.query]
         self._fetched = True
-        query_cache.set(self.iden, self.data)
+        query_cache.set(self.iden, self._dump(self.data))
 
     def __repr__(self):
         return '<CachedResults %s %s>' % (self.query._rules, self.query._sort)
@@ -199,8 +351,23 @@ class CachedResults(object):
     def __iter__(self):
         self.fetch()
 
-        for x in self.data:
-            yield x[0]
+        if isinstance(self.data, PackedListing):
+            for fullname in self.data.fullnames():
+                yield fullname
+        else:
+            for x in self.data:
+                yield x[0]
+
+class _Reversed(object):
+    """Wraps a sort value so that it compares in descending order,
+       for desc sorts on values that we can't just negate"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __cmp__(self, other):
+        return cmp(other.value, self.value)
 
 class MergedCachedResults(object):
     """Given two CachedResults, merges their lists based on the sorts
@@ -219,28 +386,96 @@ class MergedCachedResults(object):
         # make sure they're all the same
         assert all(r.sort == self.sort for r in results[1:])
 
-        all_items = []
-        for cr in results:
-            all_items.extend(cr.data)
-        all_items.sort(cmp=self._thing_cmp)
-        self.data = all_items
-
-    def _thing_cmp(self, t1, t2):
-        for i, s in enumerate(self.sort):
-            # t1 and t2 are tuples of (fullname, *sort_cols), so we
-            # can get the value to compare right out of the tuple
-            v1, v2 = t1[i + 1], t2[i + 1]
-            if v1 != v2:
-                return cmp(v1, v2) if isinstance(s, asc) else cmp(v2, v1)
-        #they're equal
-        return 0
+        self._descending = [not isinstance(s, asc) for s in self.sort]
+
+    def _sort_key(self, t):
+        """The key that orders the tuple t of (fullname, *sort_cols)
+           ascending in the merged listing"""
+        key = []
+        for descending, v in zip(self._descending, t[1:]):
+            if descending:
+                v = -v if isinstance(v, (int, long, float)) else _Reversed(v)
+            key.append(v)
+        return tuple(key)
+
+    def _entries(self, n, data, lo = 0):
+        # ties are broken by the position of the listing and then of
+        # the item, the same as a stable sort of all of them would
+        for i in xrange(lo, len(data)):
+            t = data[i]
+            yield (self._sort_key(t), n, i, t)
+
+    def _bisect(self, data, key):
+        """The position in data (which is already in listing order) of
+           the first item that doesn't sort before key"""
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._sort_key(data[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _merge(self, starts = None):
+        # each constituent listing is already sorted, so a lazy k-way
+        # merge only computes keys for the items that are actually
+        # consumed
+        if starts is None:
+            starts = [0] * len(self.cached_results)
+        return heapq.merge(*[self._entries(n, cr.data, lo)
+                             for n, (cr, lo)
+                             in enumerate(zip(self.cached_results, starts))])
+
+    @property
+    def data(self):
+        return [entry[-1] for entry in self._merge()]
 
     def __repr__(self):
         return '<MergedCachedResults %r>' % (self.cached_results,)
 
     def __iter__(self):
-        for x in self.data:
-            yield x[0]
+        for entry in self._merge():
+            yield entry[-1][0]
+
+    def _find(self, fullname):
+        for cr in self.cached_results:
+            if isinstance(cr.data, PackedListing):
+                i = cr.data.index(fullname)
+                if i >= 0:
+                    return cr.data[i]
+            else:
+                for t in cr.data:
+                    if t[0] == fullname:
+                        return t
+
+    def iter_after(self, after):
+        """An iterator over the fullnames following `after' (or all
+           of them if it's None), seeking into each listing rather
+           than merging up to it"""
+        if not after:
+            return iter(self)
+
+        t = self._find(after)
+        if t is None:
+            return iter(())
+
+        key = self._sort_key(t)
+        starts = [self._bisect(cr.data, key)
+                  for cr in self.cached_results]
+        return self._iter_from(self._merge(starts), key, after)
+
+    def _iter_from(self, merged, key, after):
+        # skip the items that tie with `after' but come before it
+        for entry in merged:
+            if entry[-1][0] == after or entry[0] != key:
+                break
+        else:
+            return
+        if entry[0] != key:
+            yield entry[-1][0]
+        for entry in merged:
+            yield entry[-1][0]
 
     def update(self):
         for x in self.cached_results:
@@ -282,6 +517,39 @@ def _get_links(sr_id, sort, time):
 
     return res
 
+def get_time_listings(link, sr):
+    """The time-filtered top and controversial listings that a link is
+       still recent enough to appear in, if they're being kept
+       incrementally (see CachedResults.can_insert_windowed)"""
+    if not g.incremental_time_listings:
+        return []
+
+    age = epoch_seconds(datetime.now(g.tz)) - epoch_seconds(link._date)
+    domains = utils.UrlParser(link.url).domain_permutations()
+
+    results = []
+    for time in db_times.keys():
+        if time == 'all' or age >= window_seconds('1 %s' % time):
+            continue
+        for sort in time_filtered_sorts:
+            results.append(get_links(sr, sort, time))
+            for domain in domains:
+                results.append(get_domain_links(domain, sort, time))
+    return results
+
+def expire_time_listings(times = ('hour', 'day', 'week', 'month', 'year')):
+    """The sliding-window pass for incremental time listings: drop the
+       links that have aged out of every subreddit's time-filtered
+       listings, so that they don't sit in the stored value until the
+       listing is next voted into. Domain listings are left to be
+       trimmed as they're written to and by mr_top."""
+    for sr in fetch_things2(Subreddit._query(sort=asc('_date'))):
+        for time in times:
+            for sort in time_filtered_sorts:
+                q = _get_links(sr._id, sort, time)
+                if isinstance(q, CachedResults):
+                    q.expire()
+
 def get_spam_links(sr):
     q_l = Link._query(Link.c.sr_id == sr._id,
                       Link.c._spam == True,
@@ -546,6 +814,33 @@ def add_queries(queries, insert_items=None, delete_items=None, foreground=False)
         else:
             raise Exception("Cannot update query %r!" % (q,))
 
+def add_queries_multi(inserts=(), deletes=(), foreground=False):
+    """Like add_queries, but for lists of (query, items) to insert and
+       to delete, and all of the listings are updated with one batched
+       mutate of the query cache"""
+    if not g.write_query_queue:
+        return
+
+    jobs = []
+    for q, items in inserts:
+        if not q.can_insert():
+            raise Exception("Cannot update query %r!" % (q,))
+        jobs.append((q, q._insert_fn([q.make_item_tuple(item)
+                                      for item in tup(items)])))
+    for q, items in deletes:
+        if not q.can_delete():
+            raise Exception("Cannot update query %r!" % (q,))
+        jobs.append((q, q._delete_fn(items)))
+
+    if not jobs:
+        return
+
+    log.debug("Updating %d queries" % len(jobs))
+    if foreground:
+        CachedResults._mutate_multi(jobs)
+    else:
+        worker.do(CachedResults._mutate_multi, jobs)
+
 #can be rewritten to be more efficient
 def all_queries(fn, obj, *param_lists):
     """Given a fn and a first argument 'obj', calls the fn(obj, *params)
@@ -639,12 +934,17 @@ def new_subreddit(sr):
     amqp.add_item('new_subreddit', sr._fullname)
 
 
-def new_vote(vote, foreground=False):
+def _new_vote_queries(vote):
+    """The listings that need to be updated after a vote, as two
+       lists of (query, item): those to insert the item into and those
+       to delete it from"""
     user = vote._thing1
     item = vote._thing2
 
+    inserts, deletes = [], []
+
     if not isinstance(item, (Link, Comment)):
-        return
+        return inserts, deletes
 
     if vote.valid_thing and not item._spam and not item._deleted:
         sr = item.subreddit_slow
@@ -659,8 +959,9 @@ def new_vote(vote, foreground=False):
 
         if isinstance(item, Link):
             # don't do 'new', because that was done by new_link, and
-            # the time-filtered versions of top/controversial will be
-            # done by mr_top
+            # the time-filtered versions of top/controversial are
+            # only done here if they're incremental (otherwise mr_top
+            # does them)
             results.extend([get_links(sr, 'hot', 'all'),
                             get_links(sr, 'top', 'all'),
                             get_links(sr, 'controversial', 'all'),
@@ -670,22 +971,76 @@ def new_vote(vote, foreground=False):
                 for sort in ("hot", "top", "controversial"):
                     results.append(get_domain_links(domain, sort, "all"))
 
-        add_queries(results, insert_items = item, foreground=foreground)
+            results.extend(get_time_listings(item, sr))
+
+        inserts.extend((q, item) for q in results)
 
-    vote._fast_query_timestamp_touch(user)
-    
     if isinstance(item, Link):
         # must update both because we don't know if it's a changed
         # vote
         if vote._name == '1':
-            add_queries([get_liked(user)], insert_items = vote, foreground = foreground)
-            add_queries([get_disliked(user)], delete_items = vote, foreground = foreground)
+            inserts.append((get_liked(user), vote))
+            deletes.append((get_disliked(user), vote))
         elif vote._name == '-1':
-            add_queries([get_liked(user)], delete_items = vote, foreground = foreground)
-            add_queries([get_disliked(user)], insert_items = vote, foreground = foreground)
+            deletes.append((get_liked(user), vote))
+            inserts.append((get_disliked(user), vote))
         else:
-            add_queries([get_liked(user)], delete_items = vote, foreground = foreground)
-            add_queries([get_disliked(user)], delete_items = vote, foreground = foreground)
+            deletes.append((get_liked(user), vote))
+            deletes.append((get_disliked(user), vote))
+
+    return inserts, deletes
+
+def new_vote(vote, foreground=False):
+    if not isinstance(vote._thing2, (Link, Comment)):
+        return
+
+    inserts, deletes = _new_vote_queries(vote)
+
+    vote._fast_query_timestamp_touch(vote._thing1)
+
+    for q, item in inserts:
+        add_queries([q], insert_items = item, foreground = foreground)
+    for q, item in deletes:
+        add_queries([q], delete_items = item, foreground = foreground)
+
+    if g.incremental_rising:
+        from r2.lib.rising import update_rising
+        update_rising([vote._thing2])
+
+def new_votes(votes, foreground=False):
+    """Like new_vote for a batch of votes, but each affected listing is
+       only updated once with all of the items from the batch"""
+    votes = [v for v in votes if isinstance(v._thing2, (Link, Comment))]
+
+    touched = {}
+    for vote in votes:
+        touched[(vote.__class__, vote._thing1._id)] = vote
+    for vote in touched.itervalues():
+        vote._fast_query_timestamp_touch(vote._thing1)
+
+    if g.incremental_rising:
+        from r2.lib.rising import update_rising
+        links = dict((v._thing2._fullname, v._thing2) for v in votes)
+        update_rising(links.values())
+
+    if not g.write_query_queue:
+        return
+
+    def _group(jobs, by_iden):
+        for q, item in jobs:
+            if q.iden in by_iden:
+                by_iden[q.iden][1].append(item)
+            else:
+                by_iden[q.iden] = (q, [item])
+
+    inserts, deletes = {}, {}
+    for vote in votes:
+        vote_inserts, vote_deletes = _new_vote_queries(vote)
+        _group(vote_inserts, inserts)
+        _group(vote_deletes, deletes)
+
+    add_queries_multi(inserts.values(), deletes.values(),
+                      foreground = foreground)
 
 def new_message(message, inbox_rels):
     from r2.lib.comment_tree import add_message
@@ -818,10 +1173,12 @@ def unban(things):
                        get_links(sr, 'controversial', 'all'),
                        ]
 
-            # the time-filtered listings will have to wait for the
-            # next mr_top run
-
+            # unless they're incremental, the time-filtered listings
+            # will have to wait for the next mr_top run
             add_queries(results, insert_items = links)
+            for link in links:
+                add_queries(get_time_listings(link, sr),
+                            insert_items = link)
 
         if comments:
             add_queries([get_spam_comments(sr)], delete_items = comments)
@@ -1015,6 +1372,18 @@ def get_likes(user, items):
 
     return res
 
+def _load_likes(keys):
+    by_user = {}
+    for user, item in keys:
+        by_user.setdefault(user, []).append(item)
+
+    ret = {}
+    for user, items in by_user.iteritems():
+        ret.update(get_likes(user, items))
+    return ret
+
+register_source('likes', _load_likes)
+
 def handle_vote(user, thing, dir, ip, organic, cheater=False, foreground=False):
     from r2.lib.db import tdb_sql
     from sqlalchemy.exc import IntegrityError
@@ -1027,6 +1396,72 @@ def handle_vote(user, thing, dir, ip, organic, cheater=False, foreground=False):
     if isinstance(thing, Link):
         new_vote(v, foreground=foreground)
 
+    _vote_modified(user, thing, dir)
+
+def handle_votes(votes, foreground=False):
+    """Like handle_vote, but for a batch of (user, thing, dir, ip,
+       organic, cheater) tuples. Only the last of a user's votes on a
+       given thing is recorded, score and karma changes are applied
+       once per thing and per author, and each affected listing is
+       mutated once. Returns the (vote, exception) pairs that failed."""
+    from r2.lib.db import tdb_sql
+    from sqlalchemy.exc import IntegrityError
+
+    # only the final state of each user's vote on each thing matters
+    latest = {}
+    for vote in votes:
+        user, thing = vote[:2]
+        latest[(user._id, thing._fullname)] = vote
+    votes = [vote for vote in votes
+             if latest[(vote[0]._id, vote[1]._fullname)] is vote]
+
+    # populate the cache with any existing votes with one lookup per
+    # user, so that Vote.vote doesn't have to go to the db for each
+    by_user = {}
+    for vote in votes:
+        user, thing = vote[:2]
+        by_user.setdefault(user._id, (user, []))[1].append(thing)
+    for user, things in by_user.itervalues():
+        Vote._fast_query(user, things, ['-1', '0', '1'])
+
+    batch = VoteBatch()
+    link_votes = []
+    failed = []
+    for vote in votes:
+        user, thing, dir, ip, organic, cheater = vote
+        try:
+            v = Vote.vote(user, thing, dir, ip, organic, cheater = cheater,
+                          batch = batch)
+        except (tdb_sql.CreationError, IntegrityError):
+            g.log.error("duplicate vote for: %s" % str((user, thing, dir)))
+            continue
+        except Exception, e:
+            failed.append((vote, e))
+            continue
+
+        if isinstance(thing, Link):
+            link_votes.append(v)
+
+        _vote_modified(user, thing, dir)
+
+    # the listings have to be updated after the scores are. The votes
+    # themselves are already committed, so this mustn't fail the
+    # batch: on redelivery they'd look unchanged and their score
+    # changes would never be applied. Whatever fails is retried once
+    # and then dropped.
+    try:
+        batch.flush()
+    except VoteBatchError:
+        try:
+            batch.flush()
+        except VoteBatchError, e:
+            g.log.error("handle_votes: dropping vote changes: %s" % e)
+    new_votes(link_votes, foreground=foreground)
+
+    return failed
+
+def _vote_modified(user, thing, dir):
+    if isinstance(thing, Link):
         #update the modified flags
         if user._id == thing.author_id:
             set_last_modified(user, 'overview')
@@ -1105,8 +1540,53 @@ def process_votes_multi(qname, limit=100):
 
     amqp.handle_items(qname, _handle_vote, limit = limit)
 
+def process_votes_batch(qname, limit=100):
+    """Like process_votes_multi, but the whole batch is handed to
+       handle_votes so that its score, karma and listing updates are
+       coalesced"""
+    def _handle_votes(msgs, chan):
+        loaded = []
+        for msg in msgs:
+            loaded.append((msg, pickle.loads(msg.body)))
+
+        voters = Account._byID(set(r[0] for msg, r in loaded),
+                               data=True, return_dict=True)
+        votees = Thing._by_fullname(set(r[1] for msg, r in loaded),
+                                    data=True, return_dict=True)
+
+        votes = []
+        msgs_by_vote = {}
+        comments = {}
+        for msg, r in loaded:
+            uid, tid, dir, ip, organic, cheater = r
+            voter, votee = voters[uid], votees[tid]
+            if isinstance(votee, Comment):
+                comments[votee._id] = votee
+
+            if not isinstance(votee, (Link, Comment)):
+                # I don't know how, but somebody is sneaking in votes
+                # for subreddits
+                continue
+
+            vote = (voter, votee, dir, ip, organic, cheater)
+            votes.append(vote)
+            msgs_by_vote.setdefault((uid, tid), []).append(msg)
+
+        print 'Processing %d votes on %d things' % (len(votes), len(votees))
+        for vote, e in handle_votes(votes, foreground=False):
+            key = (vote[0]._id, vote[1]._fullname)
+            for msg in msgs_by_vote[key]:
+                print 'Rejecting %r:%r because of %r' % (msg.delivery_tag,
+                                                         vote, e)
+                chan.basic_reject(msg.delivery_tag, requeue=True)
+
+        update_comment_votes(comments.values())
+
+    amqp.handle_items(qname, _handle_votes, limit = limit)
+
 process_votes = process_votes_single
 
+
 try:
     from r2admin.lib.admin_queries import *
 except ImportError:
@@ -30,7 +30,8 @@ from pycassa.system_manager import SystemManager, UTF8_TYPE
 
 from r2.lib.utils import tup, Storage
 from r2.lib.db.sorts import epoch_seconds
-from r2.lib import cache
+from r2.lib import cache, tracing
+from time import time
 from uuid import uuid1
 from itertools import chain
 import cPickle as pickle
@@ -298,10 +299,13 @@ class ThingBase(object):
             # refetch for more of them. This could be important with
             # large Views, for instance
 
+            start = time()
             if properties is None:
                 rows = cls._cf.multiget(l_ids, column_count=max_column_count)
             else:
                 rows = cls._cf.multiget(l_ids, columns = willask_properties)
+            tracing.record('cassandra', cls._cf_name + '.get', len(l_ids),
+                           start)
 
             l_ret = {}
             for t_id, row in rows.iteritems():
@@ -314,7 +318,9 @@ class ThingBase(object):
             return l_ret
 
         ret = cache.sgm(thing_cache, ids, lookup, prefix=cls._cache_prefix(),
-                        found_fn=reject_bad_partials)
+                        found_fn=reject_bad_partials,
+                        single_flight=g.sgm_single_flight,
+                        negative_time=g.sgm_negative_time, stats=g.stats)
 
         if is_single and not ret:
             raise NotFound("<%s %r>" % (cls.__name__,
@@ -511,6 +517,7 @@ class ThingBase(object):
 
         # actually write out the changes to the CF
         wcl = self._wcl(write_consistency_level)
+        start = time()
         with self._cf.batch(write_consistency_level = wcl) as b:
             if updates:
                 for k, v in updates.iteritems():
@@ -519,6 +526,8 @@ class ThingBase(object):
                              ttl=self._column_ttls.get(k, self._ttl))
             if self._deletes:
                 b.remove(self._id, self._deletes)
+        tracing.record('cassandra', self._cf_name + '.commit', 1, start,
+                       self._id)
 
         self._orig.update(self._dirties)
         self._column_ttls.clear()
@@ -688,8 +697,11 @@ class Relation(ThingBase):
     def _destroy(self, write_consistency_level = None):
         # only implemented on relations right now, but at present
         # there's no technical reason for this
+        start = time()
         self._cf.remove(self._id,
                         write_consistency_level = self._wcl(write_consistency_level))
+        tracing.record('cassandra', self._cf_name + '.remove', 1, start,
+                       self._id)
         self._on_destroy()
         thing_cache.delete(self._cache_key())
 
@@ -899,6 +911,7 @@ class View(ThingBase):
         # there is a default set on either the row or the column
         default_ttl = None if ttl is None else self._ttl
 
+        start = time()
         with cls._cf.batch(write_consistency_level = cls._wcl(write_consistency_level)) as b:
             # with some quick tweaks we could have a version that
             # operates across multiple row keys, but this is not it
@@ -907,6 +920,8 @@ class View(ThingBase):
                 b.insert(row_key,
                          {k: v},
                          ttl = cls._default_ttls.get(k, default_ttl))
+        tracing.record('cassandra', cls._cf_name + '.set_values', 1, start,
+                       row_key)
 
         # can we be smarter here?
         thing_cache.delete(cls._cache_key_id(row_key))
@@ -28,8 +28,11 @@ import sqlalchemy as sa
 from sqlalchemy.databases import postgres
 
 from r2.lib.utils import storage, storify, iters, Results, tup, TransSet
+from r2.lib.utils import in_chunks
 import operators
 from pylons import g, c
+from r2.lib import tracing
+from time import time
 dbm = g.dbm
 
 import logging
@@ -289,30 +292,88 @@ def get_write_table(tables):
 
 import re, traceback, cStringIO as StringIO
 _spaces = re.compile('[\s]+')
-def add_request_info(select):
-    from pylons import request
-    from r2.lib import filters
-    def sanitize(txt):
-        return _spaces.sub(' ', txt).replace("/", "|").replace("-", "_").replace(';', "").replace("*", "").replace(r"/", "")
+def _sanitize(txt):
+    return _spaces.sub(' ', txt).replace("/", "|").replace("-", "_").replace(';', "").replace("*", "").replace(r"/", "")
+
+def _stack_info():
     s = StringIO.StringIO()
     traceback.print_stack( file = s)
     tb = s.getvalue()
     if tb:
         tb = tb.split('\n')[0::2]
         tb = [x.split('/')[-1] for x in tb if "/r2/" in x]
-        tb = '\n'.join(tb[-15:-2])
-    try:
-        if (hasattr(request, 'path') and
+        # leave out add_request_info, _stack_info and our caller
+        tb = '\n'.join(tb[-16:-3])
+    return tb
+
+def _request_tag():
+    """The controller, action, path and ip of the current request, built
+       once per request and kept on c"""
+    from pylons import request
+    from r2.lib import filters
+
+    tag = getattr(c, 'sql_request_tag', None)
+    if tag:
+        return tag
+
+    if not (hasattr(request, 'path') and
             hasattr(request, 'ip') and
             hasattr(request, 'user_agent')):
-            comment = '/*\n%s\n%s\n%s\n*/' % (
-                tb or "", 
-                filters._force_utf8(sanitize(request.fullpath)),
-                sanitize(request.ip))
-            return select.prefix_with(comment)
-    except UnicodeDecodeError:
-        pass
+        return None
+
+    routes = request.environ.get('pylons.routes_dict', {})
+    tag = '%s.%s\n%s\n%s' % (
+        _sanitize(str(routes.get('controller', ''))),
+        _sanitize(str(routes.get('action', ''))),
+        filters._force_utf8(_sanitize(request.fullpath)),
+        _sanitize(request.ip))
+    c.sql_request_tag = tag
+    return tag
+
+def _want_stack():
+    """Whether to pay for a stack walk on this query: always in 'stack'
+       mode, otherwise for a sampled fraction of queries, and for every
+       query once the request has been running longer than a slow
+       request would be (so that slow traces carry their callers)"""
+    if g.sql_annotation == 'stack':
+        return True
+    if (g.sql_annotation_stack_rate > 0 and
+        random.random() < g.sql_annotation_stack_rate):
+        return True
+    trace = tracing.current()
+    return (trace is not None and
+            (time() - trace.start) * 1000. >= g.trace_slow_request_ms)
+
+def request_comment():
+    """A comment saying which request (and, if _want_stack(), which
+       code) is issuing a query, so that it can be attributed in
+       pg_stat_activity and the query logs, or None.
+       g.sql_annotation picks how much is captured: 'off', 'tag' (the
+       request's controller, action, path and ip) or 'stack' (that plus
+       the r2 frames of the stack)"""
+    if g.sql_annotation == 'off':
+        return None
 
+    try:
+        tag = _request_tag()
+        if tag is None:
+            return None
+        if _want_stack():
+            g.stats.incr('sql.annotated_stack')
+            comment = '/*\n%s\n%s\n*/' % (_stack_info() or "", tag)
+        else:
+            comment = '/*\n%s\n*/' % tag
+        g.stats.incr('sql.annotated')
+        return comment
+    except (UnicodeDecodeError, TypeError):
+        # TypeError: there's no request (or c) registered in this thread
+        return None
+
+def add_request_info(select):
+    """Prefix `select' with request_comment()"""
+    comment = request_comment()
+    if comment:
+        return select.prefix_with(comment)
     return select
 
 
@@ -506,6 +567,59 @@ def incr_data_prop(table, type_id, thing_id, prop, amount):
                  values={t.c.value : sa.cast(t.c.value, sa.Float) + amount})
     u.execute()
 
+# The most ids looked up by one statement in fetch_rows(). Smaller lists
+# are padded up to a power of two (by repeating the last id), so each
+# table only ever needs a handful of statement shapes; the SQL for each
+# is built and compiled once and then reused, which also means that
+# postgres sees the same statement text every time.
+fetch_chunk_size = 512
+_fetch_sql = {}
+
+def _padded_size(n):
+    size = 1
+    while size < n:
+        size *= 2
+    return size
+
+def _fetch_sql_for(key, size, make_select):
+    sql = _fetch_sql.get((key, size))
+    if sql is None:
+        if size == 1:
+            params = sa.bindparam('id0')
+        else:
+            params = [sa.bindparam('id%d' % i) for i in xrange(size)]
+        select = make_select(params)
+        sql = _fetch_sql[(key, size)] = str(select.compile(bind = select.bind))
+    return sql
+
+def fetch_rows(engine, key, make_select, ids):
+    """The rows selected by make_select(params) for all of `ids'.
+       `params' is a bindparam (for one id) or a list of them (for the
+       right-hand side of an IN), and `key' identifies the statement
+       that make_select builds so that its SQL can be reused"""
+    comment = request_comment()
+    # the SQL is run as-is by the DBAPI, which wants %s escaped
+    comment = comment.replace('%', '%%') + ' ' if comment else ''
+
+    rows = []
+    for chunk in in_chunks(ids, size = fetch_chunk_size):
+        size = _padded_size(len(chunk))
+        sql = _fetch_sql_for(key, size, make_select)
+        params = dict(('id%d' % i, chunk[min(i, len(chunk) - 1)])
+                      for i in xrange(size))
+        try:
+            rows.extend(engine.execute(comment + sql, params).fetchall())
+        except Exception, e:
+            dbm.mark_dead(engine)
+            # this thread must die so that others may live
+            raise
+    return rows
+
+def _in(col, params):
+    if isinstance(params, list):
+        return col.in_(params)
+    return col == params
+
 def fetch_query(table, id_col, thing_id):
     """pull the columns from the thing/data tables for a list or single
     thing_id"""
@@ -514,15 +628,12 @@ def fetch_query(table, id_col, thing_id):
     if not isinstance(thing_id, iters):
         single = True
         thing_id = (thing_id,)
-    
-    s = sa.select([table], sa.or_(*[id_col == tid
-                                    for tid in thing_id]))
-    try:
-        r = add_request_info(s).execute().fetchall()
-    except Exception, e:
-        dbm.mark_dead(table.bind)
-        # this thread must die so that others may live
-        raise
+
+    def make_select(params):
+        return sa.select([table], _in(id_col, params))
+
+    r = fetch_rows(table.bind, (table, id_col.name), make_select,
+                   list(thing_id))
     return (r, single)
 
 #TODO specify columns to return?
@@ -577,6 +688,79 @@ def get_thing(type_id, thing_id):
             res[row.thing_id] = stor
     return res
 
+def get_thing_and_data(type_id, thing_ids):
+    """get_thing() and get_thing_data() for a list of thing_ids in one
+    round trip, as a dict of thing_id -> thing and one of thing_id ->
+    data. Things without any data get an empty storage."""
+    thing_table, data_table = get_thing_table(type_id)
+
+    def make_select(params):
+        return sa.select([thing_table,
+                          data_table.c.key,
+                          data_table.c.value,
+                          data_table.c.kind],
+                         _in(thing_table.c.thing_id, params),
+                         from_obj = [thing_table.outerjoin(
+                             data_table,
+                             data_table.c.thing_id == thing_table.c.thing_id)])
+
+    rows = fetch_rows(thing_table.bind, (thing_table, data_table),
+                      make_select, list(thing_ids))
+
+    things = {}
+    datas = {}
+    for row in rows:
+        if row.thing_id not in things:
+            things[row.thing_id] = storage(ups = row.ups,
+                                           downs = row.downs,
+                                           date = row.date,
+                                           deleted = row.deleted,
+                                           spam = row.spam)
+            datas[row.thing_id] = storage()
+        if row.key is not None:
+            datas[row.thing_id][row.key] = db2py(row.value, row.kind)
+    return things, datas
+
+def benchmark_fetch(type_name = 'link', sizes = (1, 10, 100, 1000), n = 20):
+    """Compare fetch_query() with the OR-clause select that it replaced,
+    fetching the things with ids 1..size of `type_name' `n' times for
+    each size. 'build' is the cost of making the statement's SQL (which
+    fetch_query only pays once per shape), 'fetch' includes the query."""
+    import time
+    thing_table = get_thing_table(types_name[type_name].type_id)[0]
+    id_col = thing_table.c.thing_id
+
+    def or_select(ids):
+        return sa.select([thing_table], sa.or_(*[id_col == tid
+                                                 for tid in ids]))
+
+    def or_build(ids):
+        return str(or_select(ids).compile())
+
+    def or_fetch(ids):
+        return or_select(ids).execute().fetchall()
+
+    def in_build(ids):
+        return [_fetch_sql_for((thing_table, id_col.name),
+                               _padded_size(len(chunk)),
+                               lambda params: sa.select([thing_table],
+                                                        _in(id_col, params)))
+                for chunk in in_chunks(ids, size = fetch_chunk_size)]
+
+    def in_fetch(ids):
+        return fetch_query(thing_table, id_col, ids)[0]
+
+    for size in sizes:
+        ids = range(1, size + 1)
+        for name, fn in (('or build', or_build), ('in build', in_build),
+                         ('or fetch', or_fetch), ('in fetch', in_fetch)):
+            t = time.time()
+            for x in xrange(n):
+                fn(ids)
+            t = time.time() - t
+            print ("%4d ids, %s: %d in %5.3f seconds (%7.3f ms each)"
+                   % (size, name, n, t, 1000 * t / n))
+
 def set_rel_data(rel_type_id, thing_id, **vals):
     table = get_rel_table(rel_type_id, action = 'write')[3]
     return set_data(table, rel_type_id, thing_id, **vals)
@@ -25,6 +25,7 @@ from __future__ import with_statement
 import new, sys, sha
 from datetime import datetime
 from copy import copy, deepcopy
+from functools import partial
 
 import operators
 import tdb_sql as tdb
@@ -33,6 +34,7 @@ from .. utils import iters, Results, tup, to36, Storage, timefromnow
 from .. utils import iters, Results, tup, to36, Storage, thing_utils, timefromnow
 from r2.config import cache
 from r2.lib.cache import sgm
+from r2.lib.sgm import load_missing, is_not_found
 from r2.lib.log import log_text
 from pylons import g
 
@@ -195,6 +197,8 @@ class DataThing(object):
     def _other_self(self):
         """Load from the cached version of myself. Skip the local cache."""
         l = cache.get(self._cache_key(), allow_local = False)
+        if is_not_found(l):
+            return
         if l and l._id != self._id:
             g.log.error("thing.py: Doppleganger on read: got %s for %s",
                         (l, self))
@@ -274,6 +278,17 @@ class DataThing(object):
         need = tup(need)
         need_ids = [n._id for n in need]
         datas = cls._get_data(cls._type_id, need_ids)
+        to_save = cls._apply_data(need, datas, check_essentials)
+
+        prefix = thing_prefix(cls.__name__)
+
+        #write the data to the cache
+        cache.set_multi(to_save, prefix=prefix)
+
+    @classmethod
+    def _apply_data(cls, need, datas, check_essentials=True):
+        """Fill in the data of each of `need' from `datas' (as returned
+           by _get_data), returning them as a dict by id"""
         to_save = {}
         try:
             essentials = object.__getattribute__(cls, "_essentials")
@@ -295,10 +310,7 @@ class DataThing(object):
             i._asked_for_data = True
             to_save[i._id] = i
 
-        prefix = thing_prefix(cls.__name__)
-
-        #write the data to the cache
-        cache.set_multi(to_save, prefix=prefix)
+        return to_save
 
     def _load(self, check_essentials=True):
         self._load_multi(self, check_essentials)
@@ -354,45 +366,9 @@ class DataThing(object):
     def _byID(cls, ids, data=False, return_dict=True, extra_props=None,
               stale=False, check_essentials=True):
         ids, single = tup(ids, True)
-        prefix = thing_prefix(cls.__name__)
-
-        if not all(x <= tdb.MAX_THING_ID for x in ids):
-            raise NotFound('huge thing_id in %r' % ids)
-
-        def items_db(ids):
-            items = cls._get_item(cls._type_id, ids)
-            for i in items.keys():
-                items[i] = cls._build(i, items[i])
-
-            return items
 
-        bases = sgm(cache, ids, items_db, prefix, stale=stale)
-
-        #check to see if we found everything we asked for
-        for i in ids:
-            if i not in bases:
-                missing = [i for i in ids if i not in bases]
-                raise NotFound, '%s %s' % (cls.__name__, missing)
-            if bases[i] and bases[i]._id != i:
-                g.log.error("thing.py: Doppleganger on byID: %s got %s for %s" %
-                            (cls.__name__, bases[i]._id, i))
-                bases[i] = items_db([i]).values()[0]
-                bases[i]._cache_myself()
-
-
-        if data:
-            need = []
-            for v in bases.itervalues():
-                v._asked_for_data = True
-                if not v._loaded:
-                    need.append(v)
-            if need:
-                cls._load_multi(need, check_essentials)
-### The following is really handy for debugging who's forgetting data=True:
-#       else:
-#           for v in bases.itervalues():
-#                if v._id in (1, 2, 123):
-#                    raise ValueError
+        bases = byID_multi({cls: ids}, data=data, stale=stale,
+                           check_essentials=check_essentials)[cls]
 
         #e.g. add the sort prop
         if extra_props:
@@ -450,10 +426,14 @@ class DataThing(object):
                     raise NotFound
 
         # lookup ids for each type
-        identified = {}
-        for real_type, thing_ids in table.iteritems():
-            i = real_type._byID(thing_ids, **kw)
-            identified[real_type] = i
+        if set(kw) <= set(('data', 'stale', 'check_essentials')):
+            # one cache round trip for all of the types
+            identified = byID_multi(table, **kw)
+        else:
+            identified = {}
+            for real_type, thing_ids in table.iteritems():
+                i = real_type._byID(thing_ids, **kw)
+                identified[real_type] = i
 
         # interleave types in original order of the name
         res = []
@@ -494,11 +474,95 @@ class DataThing(object):
     def _get_item(*a, **kw):
         raise NotImplementedError
 
+    # like _get_item, but also returns the data of the items, in one trip
+    # to the db. Not every kind of DataThing can do this.
+    _get_item_and_data = None
+
     def _create(self):
         base_props = (getattr(self, prop) for prop in self._base_props)
         self._id = self._make_fn(self._type_id, *base_props)
         self._created = True
 
+def byID_multi(ids_by_cls, data=False, stale=False, check_essentials=True):
+    """Look up things of several classes at once: one get_multi
+       against the cache for all of them, then one query per class for
+       whatever wasn't cached. Takes and returns dicts keyed by class,
+       of lists of ids and of {id: thing} respectively."""
+    keys = {}
+    for cls, ids in ids_by_cls.iteritems():
+        if not all(x <= tdb.MAX_THING_ID for x in ids):
+            raise NotFound('huge thing_id in %r' % ids)
+
+        prefix = thing_prefix(cls.__name__)
+        for i in ids:
+            keys[prefix + str(i)] = (cls, i)
+
+    found = dict((cls, {}) for cls in ids_by_cls)
+    if not keys:
+        return found
+
+    if stale:
+        cached = cache.get_multi(keys.keys(), stale=stale)
+    else:
+        cached = cache.get_multi(keys.keys())
+
+    missing = {}
+    for key, (cls, i) in keys.iteritems():
+        if key not in cached:
+            missing.setdefault(cls, []).append(i)
+        elif not is_not_found(cached[key]):
+            found[cls][i] = cached[key]
+
+    def items_db(cls, ids):
+        if data and cls._get_item_and_data:
+            # these are going to need their data anyway, so get it
+            # along with them and cache them loaded
+            items, datas = cls._get_item_and_data(cls._type_id, ids)
+            for i in items.keys():
+                items[i] = cls._build(i, items[i])
+            cls._apply_data(items.values(), datas, check_essentials)
+            return items
+
+        items = cls._get_item(cls._type_id, ids)
+        for i in items.keys():
+            items[i] = cls._build(i, items[i])
+        return items
+
+    for cls, ids in missing.iteritems():
+        found[cls].update(load_missing(cache, ids, partial(items_db, cls),
+                                       prefix=thing_prefix(cls.__name__),
+                                       single_flight=g.sgm_single_flight,
+                                       negative_time=g.sgm_negative_time,
+                                       stats=g.stats))
+
+    for cls, bases in found.iteritems():
+        #check to see if we found everything we asked for
+        for i in ids_by_cls[cls]:
+            if i not in bases:
+                not_found = [i for i in ids_by_cls[cls] if i not in bases]
+                raise NotFound, '%s %s' % (cls.__name__, not_found)
+            if bases[i] and bases[i]._id != i:
+                g.log.error("thing.py: Doppleganger on byID: %s got %s for %s" %
+                            (cls.__name__, bases[i]._id, i))
+                bases[i] = items_db(cls, [i]).values()[0]
+                bases[i]._cache_myself()
+
+        if data:
+            need = []
+            for v in bases.itervalues():
+                v._asked_for_data = True
+                if not v._loaded:
+                    need.append(v)
+            if need:
+                cls._load_multi(need, check_essentials)
+### The following is really handy for debugging who's forgetting data=True:
+#       else:
+#           for v in bases.itervalues():
+#                if v._id in (1, 2, 123):
+#                    raise ValueError
+
+    return found
+
 class ThingMeta(type):
     def __init__(cls, name, bases, dct):
         if name == 'Thing' or hasattr(cls, '_nodb') and cls._nodb: return
@@ -528,6 +592,7 @@ class Thing(DataThing):
     _get_data = staticmethod(tdb.get_thing_data)
     _set_data = staticmethod(tdb.set_thing_data)
     _get_item = staticmethod(tdb.get_thing)
+    _get_item_and_data = staticmethod(tdb.get_thing_and_data)
     _incr_data = staticmethod(tdb.incr_thing_data)
     _type_prefix = 't'
 
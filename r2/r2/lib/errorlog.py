@@ -0,0 +1,235 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""Consumer-side handling of the exceptions that r2.lib.log sends to
+log_q: fingerprinting, formatting and (for scripts/log_q.py's aggregate
+mode) in-memory aggregation.
+
+During an outage every app server sends the same handful of exceptions
+as fast as it can serve requests. An ExceptionAggregator fingerprints
+each one once, counts them per fingerprint per minute, keeps only a few
+exemplar occurrences of each and writes the summaries out in batches,
+so that the cost of a flush depends on the number of distinct
+exceptions rather than on the number of messages.
+"""
+from pylons import g
+from r2.lib import emailer
+from md5 import md5
+from time import time as now
+
+# distinct fingerprints tracked per flush; anything past this is lumped
+# in with OVERFLOW
+max_fingerprints = 500
+OVERFLOW = "fingerprint_overflow"
+
+def add_timestamps(d):
+    d['hms'] = d['time'].strftime("%H:%M:%S")
+
+    d['occ'] = "<%s:%s, pid=%-5s, %s>" % (d['host'], d['port'], d['pid'],
+                                  d['time'].strftime("%Y-%m-%d %H:%M:%S"))
+
+def limited_append(l, item):
+    if len(l) >= 25:
+        l.pop(12)
+    l.append(item)
+
+def exception_str(d):
+    return "%s: %s" % (d['exception_type'], d['exception_desc'])
+
+def pretty_traceback(tb):
+    pretty_lines = []
+    for filename, lineno, funcname, text in tb:
+        pretty_lines.append ("%s:%s: %s()" % (filename, lineno, funcname))
+        pretty_lines.append ("    %s" % text)
+    return pretty_lines
+
+def fingerprint(d):
+    """A stable name for the kind of exception described by `d'. Known
+       kinds of infrastructure trouble get fixed names; anything else is
+       the hash of its type and the files and functions in its
+       traceback (but not their line numbers)"""
+    exc_desc = d['exception_desc']
+    exc_type = d['exception_type']
+
+    key_material = [exc_type]
+
+    make_lock_seen = False
+    cassandra_seen = False
+
+    for filename, lineno, funcname, text in d['traceback']:
+        if text is not None and (text.startswith("with g.make_lock(") or
+                                 text.startswith("with make_lock(")):
+            make_lock_seen = True
+        lower = filename.lower()
+        if '/cassandra/' in lower or '/pycassa/' in lower:
+            cassandra_seen = True
+        key_material.append("%s %s " % (filename, funcname))
+
+    if exc_desc.startswith("QueuePool limit of size"):
+        return "QueuePool_overflow"
+    elif exc_desc.startswith("error 2 from memcached_get: HOSTNAME "):
+        return "memcache_suckitude"
+    elif exc_type == "TimeoutExpired" and make_lock_seen:
+        return "make_lock_timeout"
+    elif exc_desc.startswith("(OperationalError) FATAL: the database " +
+                             "system is in recovery mode"):
+        return "recovering_db"
+    elif exc_desc.startswith("(OperationalError) could not connect " +
+                             "to server"):
+        return "unconnectable_db"
+    elif exc_desc.startswith("(OperationalError) server closed the " +
+                             "connection unexpectedly"):
+        return "flaky_db_op"
+    elif cassandra_seen:
+        return "something's wrong with cassandra"
+    else:
+        return md5("".join(key_material)).hexdigest()
+
+def new_exception_news(nickname, d):
+    news = ("A new kind of thing just happened! " +
+            "I'm going to call it a %s\n\n" % nickname)
+
+    news += "Where and when: %s\n\n" % d['occ']
+    news += "Traceback:\n"
+    news += "\n".join(pretty_traceback(d['traceback']))
+    news += exception_str(d)
+    news += "\n"
+    return news
+
+def fixed_exception_news(nickname):
+    news = "This was marked as fixed: %s\n" % nickname
+    news += "But it just occurred, so I'm marking it new again."
+    return news
+
+class ExceptionAggregator(object):
+    def __init__(self, randword, streamlog = None, flush_interval = 60,
+                 exemplars = 3):
+        """`randword' names new kinds of exceptions, `streamlog' (if
+           given) is passed a one-line summary of each fingerprint on
+           every flush, and `exemplars' is how many occurrences of each
+           fingerprint are kept per flush"""
+        self.randword = randword
+        self.streamlog = streamlog
+        self.flush_interval = flush_interval
+        self.exemplars = exemplars
+        self.reset()
+
+    def reset(self):
+        # (day, fingerprint) -> dict(count, first, occurrences). The
+        # day is the one the exception happened on rather than the one
+        # it's flushed on, so a flush straddling midnight charges each
+        # exception to the right daily error- entry
+        self.seen = {}
+        self.fingerprints = set()
+        # 'YYYY/MM/DD_HH:MM-fingerprint' -> count
+        self.per_minute = {}
+        self.started = now()
+
+    def add(self, d):
+        add_timestamps(d)
+
+        fp = fingerprint(d)
+        if (fp not in self.fingerprints
+            and len(self.fingerprints) >= max_fingerprints):
+            fp = OVERFLOW
+        self.fingerprints.add(fp)
+
+        day = d['time'].strftime("%Y/%m/%d")
+        s = self.seen.get((day, fp))
+        if s is None:
+            s = self.seen[(day, fp)] = dict(count = 0, first = d,
+                                            occurrences = [])
+        s['count'] += 1
+        if len(s['occurrences']) < self.exemplars:
+            s['occurrences'].append(d['occ'])
+
+        k = "%s-%s" % (d['time'].strftime("%Y/%m/%d_%H:%M"), fp)
+        self.per_minute[k] = self.per_minute.get(k, 0) + 1
+
+        return fp
+
+    def due(self):
+        return now() - self.started >= self.flush_interval
+
+    def flush(self):
+        """Merge everything seen since the last flush into the error
+           log in the hardcache, with one round trip per kind of key"""
+        if not self.seen:
+            self.reset()
+            return
+
+        fps = list(self.fingerprints)
+        err_ids = dict((key, "%s-%s" % key) for key in self.seen)
+
+        nicknames = g.hardcache.get_multi(fps, prefix = "error_nickname-")
+        statuses = g.hardcache.get_multi(fps, prefix = "error_status-")
+        existing = g.hardcache.get_multi(err_ids.values(), prefix = "error-")
+
+        new_nicknames = {}
+        new_statuses = {}
+        errors = {}
+
+        for key in sorted(self.seen):
+            day, fp = key
+            s = self.seen[key]
+            first = s['first']
+
+            nickname = nicknames.get(fp)
+            if nickname is None:
+                nickname = '"%s" Exception' % self.randword().capitalize()
+                emailer.nerds_email(new_exception_news(nickname, first),
+                                    "Exception Watcher")
+                nicknames[fp] = new_nicknames[fp] = nickname
+                new_statuses[fp] = "new"
+            elif statuses.get(fp) == "fixed" and fp not in new_statuses:
+                emailer.nerds_email(fixed_exception_news(nickname),
+                                    "Exception Watcher")
+                new_statuses[fp] = "new"
+
+            err = existing.get(err_ids[key])
+            if not err:
+                err = dict(exception = exception_str(first),
+                           traceback = first['traceback'],
+                           occurrences = [])
+            err['times_seen'] = err.get('times_seen', 0) + s['count']
+            for occ in s['occurrences']:
+                limited_append(err['occurrences'], occ)
+            errors[err_ids[key]] = err
+
+            if self.streamlog:
+                self.streamlog("%s [X] %-70s x%d" % (first['hms'], nickname,
+                                                     s['count']))
+
+        g.hardcache.set_multi(new_nicknames, prefix = "error_nickname-",
+                              time = 86400 * 365)
+        g.hardcache.set_multi(new_statuses, prefix = "error_status-",
+                              time = 86400)
+        g.hardcache.set_multi(errors, prefix = "error-", time = 7 * 86400)
+        g.hardcache.accrue_multi(self.per_minute, prefix = "error_rate-",
+                                 time = 86400)
+
+        self.reset()
+
+    def maybe_flush(self):
+        if self.due():
+            self.flush()
+            return True
+        return False
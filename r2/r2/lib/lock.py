@@ -21,11 +21,12 @@
 ################################################################################
 
 from __future__ import with_statement
-from time import sleep
-from datetime import datetime
-from threading import local
+from time import sleep, time
+from threading import local, Lock, Event
 from traceback import format_stack
 import os
+import re
+import random
 import socket
 
 # thread-local storage for detection of recursive locks
@@ -34,14 +35,60 @@ locks = local()
 reddit_host = socket.gethostname()
 reddit_pid  = os.getpid()
 
+# bounds (in seconds) of the jittered exponential backoff between
+# attempts to grab a contended lock
+min_backoff = .005
+max_backoff = .5
+
+# key -> Event for the locks held by threads in this process, so that
+# other threads here waiting on the same key can be woken as soon as
+# it's released rather than polling memcached
+_local_holders = {}
+_local_holders_lock = Lock()
+
+# the number of times each exact key has been contended, capped at
+# max_tracked_keys entries so it can't grow without bound
+contended_keys = {}
+max_tracked_keys = 1000
+
 class TimeoutExpired(Exception): pass
 
+_family_re = re.compile(r'(_[0-9a-z]*[0-9][0-9a-z]*)+$')
+def lock_family(key):
+    """Collapse the ids out of a lock key so that contention can be
+       counted per kind of lock: 'comment_lock_1234' and
+       'comment_lock_5678' are both 'comment_lock', and
+       'memoize_lock(...)' is 'memoize_lock'"""
+    if '(' in key:
+        return key[:key.index('(')]
+    return _family_re.sub('', key) or key
+
+def hottest_locks(num=20):
+    """The most contended exact lock keys seen by this process"""
+    return sorted(contended_keys.iteritems(), key=lambda x: x[1],
+                  reverse=True)[:num]
+
+def _track_contention(key):
+    if key not in contended_keys and len(contended_keys) >= max_tracked_keys:
+        # forget the least contended half
+        keep = hottest_locks(max_tracked_keys / 2)
+        contended_keys.clear()
+        contended_keys.update(keep)
+    contended_keys[key] = contended_keys.get(key, 0) + 1
+
 class MemcacheLock(object):
     """A simple global lock based on the memcache 'add' command. We
     attempt to grab a lock by 'adding' the lock name. If the response
-    is True, we have the lock. If it's False, someone else has it."""
+    is True, we have the lock. If it's False, someone else has it.
+
+    While waiting we back off exponentially (with jitter) between
+    attempts. If `fencing' is set, each acquisition also gets a
+    monotonically increasing `token' from memcached that can be handed
+    to the storage being protected to reject writes from a holder whose
+    lock has expired."""
 
-    def __init__(self, key, cache, time = 30, timeout = 30, verbose=True):
+    def __init__(self, key, cache, time = 30, timeout = 30, verbose=True,
+                 stats = None, fencing = False):
         # get a thread-local set of locks that we own
         self.locks = locks.locks = getattr(locks, 'locks', set())
 
@@ -51,19 +98,80 @@ class MemcacheLock(object):
         self.timeout = timeout
         self.have_lock = False
         self.verbose = verbose
+        self.stats = stats
+        self.fencing = fencing
+        self.token = None
 
-    def __enter__(self):
-        start = datetime.now()
-
+    def _add(self):
         my_info = (reddit_host, reddit_pid, ''.join(format_stack()))
+        return self.cache.add(self.key, my_info, time = self.time)
+
+    def _acquired(self):
+        #tell this thread we have this lock so we can avoid deadlocks
+        #of requests for the same lock in the same thread
+        self.locks.add(self.key)
+        self.have_lock = True
+
+        with _local_holders_lock:
+            _local_holders[self.key] = Event()
+
+        if self.fencing:
+            fence_key = 'fence_' + self.key
+            self.cache.add(fence_key, 0)
+            self.token = self.cache.incr(fence_key)
+
+    def try_acquire(self):
+        """Try to grab the lock once without waiting. Returns True if
+           we have it (including if this thread already did)"""
+        if self.key in self.locks:
+            return True
+
+        if self._add():
+            self._acquired()
+            self._count('acquired')
+            return True
 
+        self._count('busy')
+        return False
+
+    def _count(self, what):
+        if self.stats:
+            self.stats.incr('lock.%s.%s' % (lock_family(self.key), what))
+
+    def _wait(self, delay):
+        with _local_holders_lock:
+            released = _local_holders.get(self.key)
+
+        if released is not None:
+            # held by another thread in this process, so we'll be
+            # told when it's let go of
+            released.wait(delay)
+        else:
+            sleep(delay)
+
+    def __enter__(self):
         #if this thread already has this lock, move on
         if self.key in self.locks:
             return
 
+        start = time()
+
+        if self._add():
+            self._acquired()
+            self._count('acquired')
+            return
+
+        # it's contended
+        _track_contention(self.key)
+        self._count('contended')
+        attempts = 0
+        backoff = min_backoff
+
         #try and fetch the lock, looping until it's available
-        while not self.cache.add(self.key, my_info, time = self.time):
-            if (datetime.now() - start).seconds > self.timeout:
+        while True:
+            elapsed = time() - start
+            if elapsed > self.timeout:
+                self._count('timeout')
                 if self.verbose:
                     info = self.cache.get(self.key)
                     if info:
@@ -77,20 +185,38 @@ class MemcacheLock(object):
                     msg = "Timed out waiting for %s" % self.key
                 raise TimeoutExpired(msg)
 
-            sleep(.01)
+            delay = min(random.uniform(backoff / 2, backoff),
+                        self.timeout - elapsed)
+            self._wait(max(delay, 0))
+            backoff = min(backoff * 2, max_backoff)
+            attempts += 1
 
-        #tell this thread we have this lock so we can avoid deadlocks
-        #of requests for the same lock in the same thread
-        self.locks.add(self.key)
-        self.have_lock = True
+            if self._add():
+                break
 
-    def __exit__(self, type, value, tb):
+        self._acquired()
+        if self.stats:
+            family = lock_family(self.key)
+            self.stats.timing('lock.%s.wait' % family, time() - start)
+            self.stats.incr('lock.%s.attempts' % family, attempts)
+
+    def release(self):
         #only release the lock if we gained it in the first place
         if self.have_lock:
             self.cache.delete(self.key)
             self.locks.remove(self.key)
+            self.have_lock = False
+
+            with _local_holders_lock:
+                released = _local_holders.pop(self.key, None)
+            if released is not None:
+                released.set()
+
+    def __exit__(self, type, value, tb):
+        self.release()
 
-def make_lock_factory(cache):
+def make_lock_factory(cache, stats = None):
     def factory(key, **kw):
+        kw.setdefault('stats', stats)
         return MemcacheLock(key, cache, **kw)
     return factory
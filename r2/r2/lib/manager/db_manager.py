@@ -21,14 +21,98 @@
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
 import sqlalchemy as sa
+from sqlalchemy.interfaces import ConnectionProxy
 import logging, traceback
 import time, random
+import threading
+
+from r2.lib import tracing
 
 logger = logging.getLogger('dm_manager')
 logger.addHandler(logging.StreamHandler())
 
+def _verb(statement):
+    # skip the comment that tdb_sql.add_request_info prefixes
+    if statement.startswith('/*'):
+        statement = statement[statement.find('*/') + 2:]
+    words = statement.split(None, 1)
+    return words[0].lower() if words else ''
+
+class EngineLoad(object):
+    """This process's view of how busy an engine is: how many statements
+       it has running on it, and a moving average of how long they've
+       been taking. The count is kept under a lock, since a lost update
+       would throw it off for good; reads of it aren't locked."""
+    # how much each new statement moves the average
+    alpha = 0.1
+    # the average decays towards zero when there are no new samples, so
+    # that an engine that was slow once gets tried again eventually
+    half_life = 10.
+
+    def __init__(self, name, weight = 1.):
+        self.name = name
+        self.weight = weight
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latency = 0.
+        self.sampled = 0.
+        # replication lag in seconds, when it was last checked
+        self.lag = None
+        self.lag_checked = 0.
+
+    def __repr__(self):
+        return '<EngineLoad %s w=%s in_flight=%d latency=%.1fms lag=%r>' % (
+            self.name, self.weight, self.in_flight,
+            self.current_latency() * 1000., self.lag)
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finish(self, elapsed):
+        with self.lock:
+            self.in_flight -= 1
+            self.latency = (self.current_latency() +
+                            self.alpha * (elapsed - self.current_latency()))
+            self.sampled = time.time()
+
+    def current_latency(self):
+        if not self.sampled:
+            return self.latency
+        age = time.time() - self.sampled
+        return self.latency * 0.5 ** (age / self.half_life)
+
+    def score(self):
+        """Lower is better: roughly the expected wait for one more
+           statement. (Weights are applied when picking which engines to
+           compare, not here, so that they don't count twice.)"""
+        # the 1ms floor keeps idle engines' in-flight counts meaningful
+        return (self.current_latency() + 0.001) * (self.in_flight + 1)
+
+class TracingProxy(ConnectionProxy):
+    """Records every statement with the request tracer, and with the
+       engine's EngineLoad if it has one"""
+    def __init__(self, name, load = None):
+        self.name = name
+        self.load = load
+
+    def cursor_execute(self, execute, cursor, statement, parameters,
+                       context, executemany):
+        load = self.load
+        if load is not None:
+            load.start()
+        start = time.time()
+        try:
+            return execute(cursor, statement, parameters, context)
+        finally:
+            if load is not None:
+                load.finish(time.time() - start)
+            tracing.record('sql', '%s.%s' % (self.name, _verb(statement)),
+                           len(parameters) if executemany else 1,
+                           start, statement)
+
 def get_engine(name, db_host='', db_user='', db_pass='', db_port='5432',
-               pool_size = 5, max_overflow = 5):
+               pool_size = 5, max_overflow = 5, load = None):
     db_port = int(db_port)
 
     host = db_host if db_host else '' 
@@ -39,10 +123,23 @@ def get_engine(name, db_host='', db_user='', db_pass='', db_port='5432',
             host = "%s@%s:%s" % (db_user, db_host,db_port)
     return sa.create_engine('postgres://%s/%s' % (host, name),
                             strategy='threadlocal',
+                            proxy = TracingProxy(name, load),
                             pool_size = int(pool_size),
                             max_overflow = int(max_overflow))
 
+def _engine_of(table):
+    # the things and relations that tdb_sql reads from come as tuples
+    # of tables that all live on the same engine
+    if isinstance(table, tuple):
+        table = table[0]
+    return table.bind
+
 class db_manager:
+    # seconds before an engine marked dead is offered reads again
+    dead_retry = 30
+    # seconds between checks of a replica's replication lag
+    lag_check_interval = 30
+
     def __init__(self):
         self.type_db = None
         self.relation_type_db = None
@@ -51,6 +148,14 @@ class db_manager:
         self._engines = {}
         self.avoid_master_reads = {}
         self.dead = {}
+        # engine -> EngineLoad
+        self.load = {}
+        # replicas further behind than this many seconds don't get
+        # reads (if there's any alternative); 0 turns lag checks off
+        self.max_replica_lag = 0
+        # something with incr(key), like r2.lib.stats.Stats, that's told
+        # about routing decisions
+        self.stats = None
 
     def add_thing(self, name, thing_dbs, avoid_master = False, **kw):
         """thing_dbs is a list of database engines. the first in the
@@ -63,9 +168,11 @@ class db_manager:
         self._relations[name] = (type1, type2, relation_dbs)
         self.avoid_master_reads[name] = avoid_master
 
-    def setup_db(self, db_name, g_override=None, **params):
-        engine = get_engine(**params)
+    def setup_db(self, db_name, g_override=None, weight=1., **params):
+        load = EngineLoad(db_name, float(weight))
+        engine = get_engine(load = load, **params)
         self._engines[db_name] = engine
+        self.load[engine] = load
         self.test_engine(engine, g_override)
 
     def things_iter(self):
@@ -105,11 +212,84 @@ class db_manager:
     def get_engines(self, names):
         return [self._engines[name] for name in names if name in self._engines]
 
+    def _incr(self, key):
+        if self.stats is not None:
+            self.stats.incr(key)
+
+    def replica_lag(self, engine):
+        """How far (in seconds) `engine' is behind its master, checked
+           at most every lag_check_interval seconds. None for masters,
+           and when it can't be told."""
+        load = self.load.get(engine)
+        if load is None:
+            return None
+        now = time.time()
+        if now - load.lag_checked >= self.lag_check_interval:
+            load.lag_checked = now
+            try:
+                load.lag = engine.execute(
+                    "select extract(epoch from now() - "
+                    "pg_last_xact_replay_timestamp())").scalar()
+            except Exception:
+                # e.g. a postgres from before 9.0
+                load.lag = None
+        return load.lag
+
+    def _usable(self, engine):
+        load = self.load.get(engine)
+        if load is not None and load.weight <= 0:
+            # a weight of 0 drains an engine
+            return False
+        died = self.dead.get(engine)
+        if died is not None and time.time() - died < self.dead_retry:
+            return False
+        if self.max_replica_lag:
+            lag = self.replica_lag(engine)
+            if lag is not None and lag > self.max_replica_lag:
+                self._incr('db_route.lagged')
+                return False
+        return True
+
+    def _weighted_choice(self, tables):
+        loads = [self.load.get(_engine_of(t)) for t in tables]
+        weights = [l.weight if l else 1. for l in loads]
+        r = random.random() * sum(weights)
+        for t, w in zip(tables, weights):
+            r -= w
+            if r < 0:
+                return t
+        return tables[-1]
+
+    def _score(self, table):
+        load = self.load.get(_engine_of(table))
+        return load.score() if load else 0.
+
     def get_read_table(self, tables):
-        from r2.lib.services import AppServiceMonitor
+        """Pick which of `tables' (copies of the same table on
+           different engines) to read from. Engines that were recently
+           marked dead or that are too far behind in replication are
+           skipped unless there's nothing else; of the rest, two are
+           picked at random in proportion to their weights and the one
+           with less latency and fewer statements in flight wins."""
         # short-cut for only one element
         if len(tables) == 1:
             return tables[0]
 
-        return  random.choice(list(tables))
+        candidates = [t for t in tables if self._usable(_engine_of(t))]
+        if not candidates:
+            self._incr('db_route.none_usable')
+            candidates = list(tables)
+
+        if len(candidates) == 1:
+            choice = candidates[0]
+        else:
+            first = self._weighted_choice(candidates)
+            rest = [t for t in candidates if t is not first]
+            second = self._weighted_choice(rest) if rest else first
+            choice = min(first, second, key = self._score)
+
+        load = self.load.get(_engine_of(choice))
+        if load is not None:
+            self._incr('db_route.' + load.name)
+        return choice
 
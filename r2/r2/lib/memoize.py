@@ -19,11 +19,15 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2010
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
+from __future__ import with_statement
 from hashlib import md5
+from time import time as _time
+import sys
+import threading
 
 from r2.config import cache
 from r2.lib.filters import _force_utf8
-from r2.lib.cache import NoneResult, make_key
+from r2.lib.cache import NoneResult, make_key, make_keyer
 from r2.lib.lock import make_lock_factory
 from pylons import g
 
@@ -32,13 +36,14 @@ make_lock = g.make_lock
 def memoize(iden, time = 0):
     def memoize_fn(fn):
         from r2.lib.memoize import NoneResult
+        keyer = make_keyer(iden)
         def new_fn(*a, **kw):
 
             #if the keyword param _update == True, the cache will be
             #overwritten no matter what
             update = kw.pop('_update', False)
 
-            key = make_key(iden, *a, **kw)
+            key = keyer(*a, **kw)
 
             res = None if update else cache.get(key)
 
@@ -66,6 +71,108 @@ def memoize(iden, time = 0):
         return new_fn
     return memoize_fn
 
+class _Flight(object):
+    """A computation that other threads in this process can wait on"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+# key -> _Flight for the computations running in this process
+_flights = {}
+_flights_lock = threading.Lock()
+
+def _single_flight(key, fn):
+    """Run fn(), unless another thread in this process is already
+       running it for the same key, in which case wait for theirs"""
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        return flight.wait()
+
+    try:
+        flight.result = fn()
+    except:
+        flight.error = sys.exc_info()
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+    return flight.result
+
+def stale_memoize(iden, soft_time, time = 0, refresh_time = 30):
+    """Like memoize, but without the global lock. Values are kept in
+       the cache for `time' seconds, but are only considered fresh for
+       `soft_time'. After that, the first caller (across all processes,
+       via an add() of a short lease key) recomputes the value while
+       everyone else keeps being served the stale one. Concurrent
+       misses within a process share a single computation.
+
+       Hits, stale hits, misses and recompute times are recorded in
+       g.stats under 'memoize.<iden>'."""
+    stats_key = 'memoize.%s' % iden
+    # the cached values aren't compatible with memoize's, so don't
+    # share keys with it
+    keyer = make_keyer('stale.' + iden)
+
+    def memoize_fn(fn):
+        def recompute(key, a, kw):
+            start = _time()
+            res = fn(*a, **kw)
+            g.stats.timing(stats_key + '.recompute', _time() - start)
+            if res is None:
+                res = NoneResult
+            cache.set(key, (_time() + soft_time, res), time = time)
+            return res
+
+        def new_fn(*a, **kw):
+            update = kw.pop('_update', False)
+
+            key = keyer(*a, **kw)
+
+            entry = None if update else cache.get(key)
+
+            if entry is None:
+                g.stats.incr(stats_key + '.miss')
+                res = _single_flight(key, lambda: recompute(key, a, kw))
+            else:
+                soft_expiry, res = entry
+                if soft_expiry > _time():
+                    g.stats.incr(stats_key + '.hit')
+                elif g.memcache.add('memoize_refresh(%s)' % key, 1,
+                                    time = refresh_time):
+                    # we won the right to refresh it, everyone else
+                    # gets the stale value in the meantime
+                    g.stats.incr(stats_key + '.refresh')
+                    try:
+                        res = _single_flight(key,
+                                             lambda: recompute(key, a, kw))
+                    except Exception:
+                        g.log.exception("stale_memoize: refreshing %s failed, "
+                                        "serving the stale value" % key)
+                else:
+                    g.stats.incr(stats_key + '.stale')
+
+            if res == NoneResult:
+                res = None
+
+            return res
+
+        return new_fn
+    return memoize_fn
+
 @memoize('test')
 def test(x, y):
     import time
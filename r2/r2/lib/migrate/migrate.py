@@ -139,7 +139,7 @@ def pushup_permacache(verbosity=1000):
     from pylons import g
     from r2.models import Link, Subreddit, Account
     from r2.lib.db.operators import desc
-    from r2.lib.comment_tree import comments_key, messages_key
+    from r2.lib.comment_tree import tree_key, tree_delta_key, messages_key
     from r2.lib.utils import fetch_things2, in_chunks
     from r2.lib.utils import last_modified_key
     from r2.lib.promote import promoted_memo_key
@@ -169,7 +169,8 @@ def pushup_permacache(verbosity=1000):
                           data=True,
                           )
         for link in fetch_things2(l_q, verbosity):
-            yield comments_key(link._id)
+            yield tree_key(link._id)
+            yield tree_delta_key(link._id)
             yield last_modified_key(link, 'comments')
 
         a_q = Account._query(Account.c._spam == (True, False),
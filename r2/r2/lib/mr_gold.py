@@ -39,7 +39,7 @@ from r2.lib.jsontemplates import make_fullname # what a strange place
                                                # for this function
 
 
-def time_listings(times = ('year','month','week','day','hour', 'all')):
+def time_listings_mapper(times = ('year','month','week','day','hour', 'all')):
     oldests = dict((t, epoch_seconds(timeago('1 %s' % t)))
                    for t in times if t != 'all')
     if 'all' in times:
@@ -72,8 +72,10 @@ def time_listings(times = ('year','month','week','day','hour', 'all')):
                         yield ('user-hot-%s-%d' % (tkey, author_id),
                                h, timestamp, fname)
 
+    return process
 
-    mr_tools.mr_map(process)
+def time_listings(times = ('year','month','week','day','hour', 'all')):
+    mr_tools.mr_map(time_listings_mapper(times))
 
 def store_keys(key, maxes):
     # we're building queries using queries.py, but we could make the
@@ -97,3 +99,11 @@ def write_permacache(fd = sys.stdin):
                                    post=store_keys,
                                    fd = fd)
 
+def time_listings_permacache(times = ('year','month','week','day','hour', 'all'),
+                             fd = sys.stdin, **kw):
+    """time_listings | sort | write_permacache, as one command"""
+    mr_tools.mr_run_post(time_listings_mapper(times),
+                         mr_tools.max_per_key_reducer(
+                             lambda x: map(float, x[:-1]), num=1000),
+                         store_keys, fd = fd, **kw)
+
@@ -1,2 +1,3 @@
 from r2.lib.mr_tools._mr_tools import *
 from r2.lib.mr_tools.mr_tools import *
+from r2.lib.mr_tools.records import *
@@ -1,6 +1,8 @@
 import sys
 from itertools import imap, groupby
 
+from r2.lib.mr_tools.records import read_records, write_record
+
 stdin = sys.stdin
 stderr = sys.stderr
 
@@ -57,6 +59,22 @@ def keyiter(stream=stdin):
     groups = groupby(lines, lambda x: x[0])
     return imap(valiter, groups)
 
+cpdef list _record_vals(tuple x):
+    return list(x[1:])
+
+cpdef _record_key(tuple x):
+    return x[0]
+
+def _record_valiter(grouper):
+    key, group = grouper
+    return key, imap(_record_vals, group)
+
+def record_keyiter(records):
+    """Like keyiter, but over an iterable of binary records (see
+       records.py) rather than lines of text"""
+    groups = groupby(records, _record_key)
+    return imap(_record_valiter, groups)
+
 def emit(vals):
     print '\t'.join(map(str, vals))
 
@@ -110,13 +128,25 @@ cdef class dataspec_r(object):
                                 msgs))
         return wrapped_fn_r
 
-cpdef mr_map(process, fd = stdin):
+cpdef mr_map(process, fd = stdin, binary = False):
+    if binary:
+        for vals in read_records(fd):
+            for res in process(list(vals)):
+                write_record(res)
+        return
+
     for line in fd:
         vals = line.strip('\n').split('\t')
         for res in process(vals):
             emit(res)
 
-cpdef mr_reduce(process, fd = stdin):
+cpdef mr_reduce(process, fd = stdin, binary = False):
+    if binary:
+        for key, vals in record_keyiter(read_records(fd)):
+            for res in process(key, vals):
+                write_record(res)
+        return
+
     for key, vals in keyiter(fd):
         for res in process(key, vals):
             emit(res)
@@ -148,8 +178,9 @@ cpdef mr_max(process, int idx = 0, int num = 10, emit = False, fd = stdin):
 
     return maxes
 
-cpdef _sbool(str x):
-    return x == 't'
+cpdef _sbool(x):
+    # binary records may already carry real booleans
+    return x is True or x == 't'
 
 def dataspec_m_rel(*fields):
     return dataspec_m(*((('rel_id', int),
@@ -170,7 +201,8 @@ def dataspec_m_thing(*fields):
                          ('timestamp', float))
                         + fields))
 
-def mr_reduce_max_per_key(sort_key, post = None, num = 10, fd = sys.stdin):
+def max_per_key_reducer(sort_key, post = None, num = 10):
+    """A reducer that keeps the top `num' values for each key"""
     def process(key, vals):
         cdef list maxes = []
 
@@ -186,7 +218,12 @@ def mr_reduce_max_per_key(sort_key, post = None, num = 10, fd = sys.stdin):
             # responsibility for emitting
             post(key, maxes)
             return []
-        return [ ([key] + item)
+        return [ ([key] + list(item))
                  for item in maxes ]
 
-    return mr_reduce(process, fd = fd)
+    return process
+
+def mr_reduce_max_per_key(sort_key, post = None, num = 10, fd = sys.stdin,
+                          binary = False):
+    return mr_reduce(max_per_key_reducer(sort_key, post = post, num = num),
+                     fd = fd, binary = binary)
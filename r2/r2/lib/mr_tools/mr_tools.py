@@ -1,10 +1,20 @@
+import os
 import sys
+import time
+import heapq
+import shutil
+import tempfile
 import multiprocessing
+from itertools import islice
+from collections import deque
+from zlib import crc32
 
 from r2.lib.mr_tools._mr_tools import mr_map, mr_reduce, format_dataspec
-from r2.lib.mr_tools._mr_tools import stdin, emit
+from r2.lib.mr_tools._mr_tools import stdin, emit, keyiter, status
+from r2.lib.mr_tools._mr_tools import record_keyiter
+from r2.lib.mr_tools.records import dump_record, write_record, read_records
 
-def join_things(fields, deleted=False, spam=True):
+def join_things_reducer(fields, deleted=False, spam=True):
     """A reducer that joins thing table dumps and data table dumps"""
     def process(thing_id, vals):
         data = {}
@@ -45,7 +55,11 @@ def join_things(fields, deleted=False, spam=True):
                     thing.deleted, thing.spam, thing.timestamp)
                    + tuple(data[field] for field in fields))
 
-    mr_reduce(process)
+    return process
+
+def join_things(fields, deleted=False, spam=True, binary=False):
+    mr_reduce(join_things_reducer(fields, deleted=deleted, spam=spam),
+              binary=binary)
 
 class Mapper(object):
     def __init__(self):
@@ -77,6 +91,209 @@ def mr_map_parallel(processor, fd = stdin,
         for subres in res:
             emit(subres)
 
+# mr_run: map, sort and reduce in one process tree, instead of piping
+# mr_map through sort(1) into mr_reduce.
+#
+# The input is read in chunks that are mapped by a pool of workers,
+# each of which partitions its output by the hash of the key, sorts
+# each partition in memory and spills it to a run file. Each partition
+# is then reduced by its own worker, which merges its runs. Every key
+# lands in exactly one partition, so the reducers see all of a key's
+# values together, as they would after sort(1); the order of the keys
+# across partitions is not preserved.
+#
+# Runs are always written as binary records (see records.py). With
+# binary=False the input and output are text and the mapped values are
+# turned into strings, so the processors see exactly what they would
+# in a text pipeline; with binary=True they keep their types.
+#
+# The processors are handed to the workers by fork()ing, not by
+# pickling, so closures (like those made by dataspec_m) are fine.
+
+_job = None
+
+def _partition(key, partitions):
+    return crc32(str(key)) % partitions
+
+def _write_run(tmpdir, partition, recs):
+    fd, path = tempfile.mkstemp(dir = tmpdir, prefix = 'run%d.' % partition)
+    f = os.fdopen(fd, 'wb')
+    try:
+        for rec in recs:
+            f.write(dump_record(rec))
+    finally:
+        f.close()
+    return path
+
+def _map_chunk(chunk):
+    mapper, partitions = _job['mapper'], _job['partitions']
+    binary = _job['binary']
+
+    parts = [[] for x in xrange(partitions)]
+    for vals in chunk:
+        out = [vals] if mapper is None else mapper(vals)
+        for res in out:
+            res = tuple(res) if binary else tuple(map(str, res))
+            parts[_partition(res[0], partitions)].append(res)
+
+    runs = []
+    for partition, part in enumerate(parts):
+        if part:
+            part.sort()
+            runs.append((partition, _write_run(_job['tmpdir'], partition,
+                                               part)))
+    return len(chunk), runs
+
+def _merge_runs(paths):
+    files = [open(path, 'rb') for path in paths]
+    return files, heapq.merge(*[read_records(f) for f in files])
+
+def _compact(partition, paths, max_fanin):
+    """Merge runs together until there are few enough to open at
+       once"""
+    while len(paths) > max_fanin:
+        merged = []
+        for i in xrange(0, len(paths), max_fanin):
+            group = paths[i:i + max_fanin]
+            if len(group) == 1:
+                merged.extend(group)
+                continue
+            files, recs = _merge_runs(group)
+            merged.append(_write_run(_job['tmpdir'], partition, recs))
+            for f, path in zip(files, group):
+                f.close()
+                os.unlink(path)
+        paths = merged
+    return paths
+
+def _reduce_partition(args):
+    partition, paths = args
+    reducer, binary = _job['reducer'], _job['binary']
+
+    paths = _compact(partition, paths, _job['max_fanin'])
+    files, recs = _merge_runs(paths)
+
+    out_path = os.path.join(_job['tmpdir'], 'out%d' % partition)
+    out = open(out_path, 'wb')
+    write = write_record if binary else emit
+    # the reducers emit() with print, so point stdout at our own file
+    # rather than interleaving with the other reducers
+    stdout, sys.stdout = sys.stdout, out
+    try:
+        if reducer is None:
+            for rec in recs:
+                write(rec)
+        else:
+            for key, vals in record_keyiter(recs):
+                for res in reducer(key, vals):
+                    write(res)
+    finally:
+        sys.stdout = stdout
+        out.close()
+        for f in files:
+            f.close()
+    return out_path
+
+def _read_chunks(fd, binary, chunk_size):
+    if binary:
+        it = read_records(fd)
+    else:
+        it = (line.rstrip('\n').split('\t') for line in fd)
+    return iter(lambda: list(islice(it, chunk_size)), [])
+
+def mr_run(mapper = None, reducer = None, fd = stdin, out = sys.stdout,
+           binary = False, workers = multiprocessing.cpu_count(),
+           partitions = None, chunk_size = 100000, max_fanin = 64,
+           tmpdir = None, verbose = True):
+    """Run a whole mapreduce job: mapper(vals) and reducer(key, vals)
+       are the same processors that mr_map and mr_reduce take. If
+       there's no mapper the input is passed straight through, and
+       with no reducer the sorted partitions are written out, so
+       mr_run(reducer = r) replaces `sort | mr_reduce(r)`, and
+       mr_run(m, r) replaces `mr_map(m) | sort | mr_reduce(r)`.
+       With binary=True the input and output are binary records."""
+    global _job
+
+    partitions = partitions or workers
+    tmpdir = tempfile.mkdtemp(prefix = 'mr_run.', dir = tmpdir)
+    _job = dict(mapper = mapper, reducer = reducer, binary = binary,
+                partitions = partitions, tmpdir = tmpdir,
+                max_fanin = max_fanin)
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        start = time.time()
+        runs = [[] for x in xrange(partitions)]
+        counts = dict(lines = 0, runs = 0)
+
+        def collect(result):
+            count, chunk_runs = result.get()
+            counts['lines'] += count
+            counts['runs'] += len(chunk_runs)
+            for partition, path in chunk_runs:
+                runs[partition].append(path)
+            if verbose:
+                elapsed = time.time() - start
+                status('mapped %(lines)d records (%(rate)d/s), %(runs)d runs',
+                       rate = counts['lines'] / elapsed if elapsed else 0,
+                       **counts)
+
+        # only read a couple of chunks ahead of the workers, so that
+        # we never hold much more than that in memory
+        pending = deque()
+        for chunk in _read_chunks(fd, binary, chunk_size):
+            pending.append(pool.apply_async(_map_chunk, (chunk,)))
+            if len(pending) >= workers * 2:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+        nlines = counts['lines']
+
+        map_elapsed = time.time() - start
+        todo = [(partition, paths) for partition, paths in enumerate(runs)
+                if paths]
+        done = 0
+        for out_path in pool.imap_unordered(_reduce_partition, todo):
+            f = open(out_path, 'rb')
+            try:
+                shutil.copyfileobj(f, out)
+            finally:
+                f.close()
+            os.unlink(out_path)
+            done += 1
+            if verbose:
+                status('reduced %(done)d/%(todo)d partitions',
+                       done = done, todo = len(todo))
+
+        if verbose:
+            status('%(lines)d records: map %(map).1fs, reduce %(reduce).1fs',
+                   lines = nlines, map = map_elapsed,
+                   reduce = time.time() - start - map_elapsed)
+    finally:
+        pool.terminate()
+        _job = None
+        shutil.rmtree(tmpdir, ignore_errors = True)
+
+def mr_run_post(mapper, reducer, post, fd = stdin, binary = False, **kw):
+    """Like mr_run, but rather than emitting the reduced values, call
+       post(key, vals) for each key in this process. This is for jobs
+       whose results are written to our caches or databases, whose
+       connections shouldn't be shared with fork()ed workers."""
+    out = tempfile.TemporaryFile(dir = kw.get('tmpdir'))
+    try:
+        mr_run(mapper, reducer, fd = fd, out = out, binary = binary, **kw)
+        out.seek(0)
+        groups = record_keyiter(read_records(out)) if binary else keyiter(out)
+        for key, vals in groups:
+            post(key, list(vals))
+    finally:
+        out.close()
+
+def mr_sort(fd = stdin, out = sys.stdout, **kw):
+    """An in-process replacement for sort(1) between mapreduce stages.
+       Groups records by key, but the keys aren't globally ordered."""
+    return mr_run(fd = fd, out = out, **kw)
+
 def test():
     from r2.lib.mr_tools._mr_tools import keyiter
 
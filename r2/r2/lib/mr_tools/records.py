@@ -0,0 +1,55 @@
+"""A binary record format for mr_tools pipelines.
+
+Each record is a tuple of plain values (str, unicode, int, long, float,
+bool, None), marshalled and prefixed with its length, so values keep
+their types between stages (no re-parsing of floats) and may contain
+tabs and newlines. The format is only meant for passing data between
+the stages of a job, not for storing it: marshal's format can change
+between Python versions.
+
+to_records() and to_text() adapt it to the tab-separated text that the
+database dumps and sort(1) deal in.
+"""
+import sys
+import marshal
+import struct
+
+_header = struct.Struct('<I')
+
+def dump_record(vals):
+    blob = marshal.dumps(tuple(vals))
+    return _header.pack(len(blob)) + blob
+
+def write_record(vals, out = None):
+    (out or sys.stdout).write(dump_record(vals))
+
+def read_records(fd = sys.stdin):
+    read = fd.read
+    while True:
+        header = read(_header.size)
+        if not header:
+            return
+        if len(header) < _header.size:
+            raise ValueError('truncated record header')
+        size, = _header.unpack(header)
+        blob = read(size)
+        if len(blob) < size:
+            raise ValueError('truncated record')
+        yield marshal.loads(blob)
+
+def to_records(types = (), fd = sys.stdin, out = sys.stdout):
+    """Convert tab-separated lines to records. `types' optionally maps
+       column positions to functions that convert the text values, e.g.
+       {3: int, 4: int, 7: float}"""
+    types = dict(types)
+    for line in fd:
+        vals = line.rstrip('\n').split('\t')
+        for i, fn in types.iteritems():
+            if i < len(vals):
+                vals[i] = fn(vals[i])
+        out.write(dump_record(vals))
+
+def to_text(fd = sys.stdin, out = sys.stdout):
+    """Convert records back to tab-separated lines"""
+    for vals in read_records(fd):
+        out.write('\t'.join(map(str, vals)) + '\n')
@@ -81,7 +81,7 @@ def join_links():
     mr_tools.join_things(('url', 'sr_id'))
 
 
-def time_listings(times = ('year','month','week','day','hour')):
+def time_listings_mapper(times = ('year','month','week','day','hour')):
     oldests = dict((t, epoch_seconds(timeago('1 %s' % t)))
                    for t in times)
 
@@ -114,7 +114,19 @@ def time_listings(times = ('year','month','week','day','hour')):
                         yield ('domain/controversial/%s/%s' % (tkey, domain),
                                contr, timestamp, fname)
 
-    mr_tools.mr_map(process)
+    return process
+
+def time_listings(times = ('year','month','week','day','hour')):
+    mr_tools.mr_map(time_listings_mapper(times))
+
+def _replace_time_listing(q, tuples):
+    # when the time listings are also kept up to date from the vote
+    # stream, this run is a reconciliation, and shouldn't throw away
+    # what's been added since the links were dumped
+    if q.can_insert_windowed():
+        q._reconcile(tuples)
+    else:
+        q._replace(tuples)
 
 def store_keys(key, maxes):
     # we're building queries using queries.py, but we could make the
@@ -149,13 +161,13 @@ def store_keys(key, maxes):
             sort = 'controversial'
 
         q = queries._get_links(sr_id, sort, time)
-        q._replace([tuple([item[-1]] + map(float, item[:-1]))
-                    for item in maxes])
+        _replace_time_listing(q, [tuple([item[-1]] + map(float, item[:-1]))
+                                  for item in maxes])
     elif key.startswith('domain/'):
         d_str, sort, time, domain = key.split('/')
         q = queries.get_domain_links(domain, sort, time)
-        q._replace([tuple([item[-1]] + map(float, item[:-1]))
-                    for item in maxes])
+        _replace_time_listing(q, [tuple([item[-1]] + map(float, item[:-1]))
+                                  for item in maxes])
 
 
     elif key.split('-')[0] in userrel_fns:
@@ -170,3 +182,29 @@ def write_permacache(fd = sys.stdin):
     mr_tools.mr_reduce_max_per_key(lambda x: map(float, x[:-1]), num=1000,
                                    post=store_keys,
                                    fd = fd)
+
+def time_listings_permacache(times = ('year','month','week','day','hour'),
+                             fd = sys.stdin, **kw):
+    """join_links | time_listings | sort | write_permacache, as one
+       command that takes the joined links and runs the map and reduce
+       on every core"""
+    mr_tools.mr_run_post(time_listings_mapper(times),
+                         mr_tools.max_per_key_reducer(
+                             lambda x: map(float, x[:-1]), num=1000),
+                         store_keys, fd = fd, **kw)
+
+def join_links_parallel(fd = sys.stdin, **kw):
+    """sort | join_links, in one command"""
+    mr_tools.mr_run(reducer = mr_tools.join_things_reducer(('url', 'sr_id')),
+                    fd = fd, **kw)
+
+def link_records(fd = sys.stdin):
+    """Convert joined links to binary records, parsing their numeric
+       fields once so that the later stages don't have to (run them
+       with binary=True)"""
+    mr_tools.to_records({0: int,   # thing_id
+                         2: int,   # ups
+                         3: int,   # downs
+                         6: float, # timestamp
+                         8: int},  # sr_id
+                        fd = fd)
@@ -1,13 +1,33 @@
-from pylons import g
-
-from r2.lib.memoize import memoize
 from r2.lib import _normalized_hot
 
 from r2.lib._normalized_hot import get_hot # pull this into our namespace
 
-@memoize('normalize_hot', time = g.page_cache_time)
-def normalized_hot_cached(sr_ids):
-    return _normalized_hot.normalized_hot_cached(sr_ids)
+class NormalizedHot(object):
+    """The interleaved hot lists of a set of subreddits. The per-
+       subreddit lists are cached individually and merged lazily, so
+       rendering a page only merges as far into them as it needs to."""
+    def __init__(self, sr_ids):
+        self.sr_ids = sr_ids
+        self._lists = None
+
+    def __repr__(self):
+        return '<NormalizedHot %r>' % (self.sr_ids,)
+
+    def __iter__(self):
+        if self._lists is None:
+            self._lists = _normalized_hot.get_hot_lists(self.sr_ids)
+        for nehot, nhot, fname in _normalized_hot.merge_hot(self._lists):
+            yield fname
+
+    def iter_after(self, after):
+        """An iterator over the fullnames following `after' (or all
+           of them if it's None)"""
+        it = iter(self)
+        if after:
+            for fname in it:
+                if fname == after:
+                    break
+        return it
 
 def l(li):
     if isinstance(li, list):
@@ -17,4 +37,4 @@ def l(li):
 
 def normalized_hot(sr_ids):
     sr_ids = l(sorted(sr_ids))
-    return normalized_hot_cached(sr_ids) if sr_ids else ()
+    return NormalizedHot(sr_ids) if sr_ids else ()
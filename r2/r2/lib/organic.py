@@ -20,13 +20,14 @@
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
 from r2.models import *
-from r2.lib.memoize import memoize
+from r2.lib.cache import sgm
 from r2.lib.normalized_hot import get_hot
 from r2.lib import count
 from r2.lib.utils import UniqueIterator, timeago
 
-from pylons import c
+from pylons import c, g
 
+import heapq
 import random
 from time import time
 
@@ -37,12 +38,34 @@ organic_max_length= 50
 def keep_fresh_links(item):
     return (c.user_is_loggedin and c.user._id == item.author_id) or item.fresh
 
-@memoize('cached_organic_links', time = organic_lifetime)
-def cached_organic_links(*sr_ids):
+def _sr_organic_links(sr_ids):
     sr_count = count.get_link_counts()
+    links = dict((sr_id, []) for sr_id in sr_ids)
+    for name, (link_count, sr_id) in sr_count.iteritems():
+        if sr_id in links:
+            links[sr_id].append((link_count, name))
+    for sr_links in links.itervalues():
+        sr_links.sort()
+    return links
+
+def sr_organic_links(sr_ids):
+    """The organic candidates of each subreddit, as lists of (count,
+       fullname) sorted by count. These are cached per subreddit rather
+       than per set of subscriptions, so that users share them"""
+    return sgm(g.cache, sr_ids, miss_fn = _sr_organic_links,
+               prefix = 'organic_sr_', time = organic_lifetime)
+
+def _organic_rng(sr_ids):
+    # the same subscriptions get the same choices for as long as the
+    # candidates are cached
+    return random.Random(hash((int(time() / organic_lifetime),)
+                              + tuple(sr_ids)))
+
+def cached_organic_links(*sr_ids):
+    sr_links = sr_organic_links(sr_ids)
     #only use links from reddits that you're subscribed to
-    link_names = filter(lambda n: sr_count[n][1] in sr_ids, sr_count.keys())
-    link_names.sort(key = lambda n: sr_count[n][0])
+    link_names = [name for link_count, name
+                  in heapq.merge(*sr_links.values())]
 
     if not link_names and g.debug:
         q = All.get_links('new', 'all')
@@ -51,14 +74,15 @@ def cached_organic_links(*sr_ids):
         g.log.debug('Used inorganic links')
 
     #potentially add an up and coming link
-    if random.choice((True, False)) and sr_ids:
-        sr = Subreddit._byID(random.choice(sr_ids))
+    rng = _organic_rng(sr_ids)
+    if rng.choice((True, False)) and sr_ids:
+        sr = Subreddit._byID(rng.choice(sr_ids))
         fnames = get_hot([sr])
         if fnames:
             if len(fnames) == 1:
                 new_item = fnames[0]
             else:
-                new_item = random.choice(fnames[1:4])
+                new_item = rng.choice(fnames[1:4])
             link_names.insert(0, new_item)
 
     return link_names
@@ -66,16 +90,12 @@ def cached_organic_links(*sr_ids):
 def organic_links(user):
     from r2.controllers.reddit_base import organic_pos
 
-    sr_ids = Subreddit.user_subreddits(user)
-    # make sure that these are sorted so the cache keys are constant
-    sr_ids.sort()
-
     # get the default subreddits if the user is not logged in
     user_id = None if isinstance(user, FakeAccount) else user
     sr_ids = Subreddit.user_subreddits(user, True)
 
-    # pass the cached function a sorted list so that we can guarantee
-    # cachability
+    # the up and coming link is chosen with a generator seeded from
+    # these, so sort them to keep the choice stable
     sr_ids.sort()
     return cached_organic_links(*sr_ids)[:organic_max_length]
 
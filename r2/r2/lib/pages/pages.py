@@ -49,6 +49,7 @@ from r2.lib.template_helpers import add_sr, get_domain
 from r2.lib.subreddit_search import popular_searches
 from r2.lib.scraper import get_media_embed
 from r2.lib.log import log_text
+from r2.lib.usage import percentiles
 from r2.lib.memoize import memoize
 from r2.lib.utils import trunc_string as _truncate
 
@@ -2246,6 +2247,9 @@ class AdminUsage(Templated):
                 key = lambda x:
                       self.actions[x].get(action_sorting_column, {"elapsed":0})["elapsed"])
 
+        # today's latency percentiles, in seconds
+        self.percentiles = percentiles(this_day, self.actions.keys())
+
         Templated.__init__(self)
 
 class Ads(Templated):
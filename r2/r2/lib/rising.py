@@ -19,52 +19,176 @@
 # All portions of the code written by CondeNet are Copyright (c) 2006-2010
 # CondeNet, Inc. All Rights Reserved.
 ################################################################################
-from pylons import g, c
-from r2.models.link import Link, Subreddit
-from r2.lib import utils
+from pylons import g
+from r2.models.link import Link
 from r2.lib import count
+from r2.lib.utils import timeago
+from r2.lib.db.sorts import epoch_seconds
+from r2.lib.memoize import memoize
 
 from datetime import datetime
+from heapq import heappush, heappushpop, merge
 
 cache = g.cache
 
+# Each subreddit's rising links are stored under their own key, as a
+# list of (score, fullname, ups, count, date) sorted best first and
+# capped at g.rising_size entries. Keeping the score's inputs around
+# lets update_rising rescore a list as votes come in without having to
+# reload all of its links. The best links across all subreddits are
+# written under rising_key by set_rising, or, with incremental_rising,
+# merged from the subreddits' lists when they're read.
+rising_prefix = 'rising_sr_'
+rising_key = 'rising'
+rising_sr_ids_key = 'rising_sr_ids'
+rising_maxcount_key = 'rising_maxcount'
+
+def rising_score(ups, count, date, now):
+    hours = int(max(now - date, 0) / 3600) + 1
+    return float(ups) / (max(count, 1) * hours)
+
+def _entry(link, count, now):
+    date = epoch_seconds(link._date)
+    return (rising_score(link._ups, count, date, now),
+            link._fullname, link._ups, count, date)
+
+def _push(heap, entry, size):
+    """keep the `size' best entries in the min-heap `heap'"""
+    if len(heap) < size:
+        heappush(heap, entry)
+    elif entry > heap[0]:
+        heappushpop(heap, entry)
+
+def _ranked(heap):
+    return sorted(heap, reverse=True)
+
+def _now():
+    return epoch_seconds(datetime.now(g.tz))
+
 def calc_rising():
+    """Returns the threshold count above which links are too popular to
+       be rising, and a dict of sr_id -> its ranked rising entries"""
     sr_count = count.get_link_counts()
     link_count = dict((k, v[0]) for k,v in sr_count.iteritems())
-    link_names = Link._by_fullname(sr_count.keys(), data=True)
+    links = Link._by_fullname(sr_count.keys(), data=True)
 
     #max is half the average of the top 10 counts
-    counts = link_count.values()
-    counts.sort(reverse=True)
+    counts = sorted(link_count.values(), reverse=True)
     maxcount = sum(counts[:10]) / 20
-    
-    #prune the list
-    rising = [(n, link_names[n].sr_id)
-              for n in link_names.keys() if link_count[n] < maxcount]
 
-    cur_time = datetime.now(g.tz)
+    now = _now()
+    size = g.rising_size
+    heaps = {}
+    for name, link in links.iteritems():
+        n = link_count[name]
+        #prune the list
+        if n < maxcount:
+            _push(heaps.setdefault(link.sr_id, []), _entry(link, n, now),
+                  size)
 
-    def score(pair):
-        name = pair[0]
-        link = link_names[name]
-        hours = (cur_time - link._date).seconds / 3600 + 1
-        return float(link._ups) / (max(link_count[name], 1) * hours)
+    return maxcount, dict((sr_id, _ranked(heap))
+                          for sr_id, heap in heaps.iteritems())
 
-    def r(x):
-        return 1 if x > 0 else -1 if x < 0 else 0
+def set_rising():
+    maxcount, rising = calc_rising()
 
-    rising.sort(lambda x, y: r(score(y) - score(x)))
-    return rising
+    best = []
+    for entries in rising.itervalues():
+        for entry in entries:
+            _push(best, entry, g.rising_size)
 
-def set_rising():
-    rising = calc_rising()
-    cache.set('rising', rising)
+    # subreddits that have nothing rising any more have to be emptied
+    for sr_id in cache.get(rising_sr_ids_key) or ():
+        rising.setdefault(sr_id, [])
+
+    cache.set_multi(rising, prefix = rising_prefix)
+    cache.set_multi({rising_key: _ranked(best),
+                     rising_sr_ids_key: [sr_id for sr_id, entries
+                                         in rising.iteritems() if entries],
+                     rising_maxcount_key: maxcount})
+
+def _rescore(entries, links, counts, maxcount, now):
+    oldest = epoch_seconds(timeago(count.count_period))
+    known = dict((entry[1], entry[3]) for entry in entries)
+    changed = dict((link._fullname, link) for link in links)
+    size = g.rising_size
+
+    heap = []
+    for score, name, ups, n, date in entries:
+        if name not in changed and date >= oldest:
+            _push(heap, (rising_score(ups, n, date, now), name, ups, n, date),
+                  size)
+
+    for name, link in changed.iteritems():
+        n = counts.get(name, known.get(name))
+        if (n is None or (maxcount is not None and n >= maxcount)
+            or link._spam or link._deleted
+            or epoch_seconds(link._date) < oldest):
+            continue
+        _push(heap, _entry(link, n, now), size)
+
+    return _ranked(heap)
+
+def update_rising(links, counts = None):
+    """Rescore `links' in the rising lists, e.g. after they've been
+       voted on. `counts' optionally maps their fullnames to new click
+       counts; links that aren't already rising and that have no count
+       are left out."""
+    links = [link for link in links if isinstance(link, Link)]
+    if not links:
+        return
+
+    counts = dict(counts or {})
+    maxcount = cache.get(rising_maxcount_key)
+    now = _now()
+
+    by_sr = {}
+    for link in links:
+        by_sr.setdefault(link.sr_id, []).append(link)
+
+    added = []
+    for sr_id, sr_links in by_sr.iteritems():
+        key = rising_prefix + str(sr_id)
+        with g.make_lock('lock_' + key):
+            entries = _rescore(cache.get(key) or [], sr_links, counts,
+                               maxcount, now)
+            cache.set(key, entries)
+        if entries:
+            added.append(sr_id)
+
+    # the overall list isn't touched here: every vote would serialise
+    # on its lock. Instead get_rising merges the subreddits' lists
+    # the list of subreddits with something rising almost always has
+    # these already, so only lock it when one has to be added
+    if added and not set(cache.get(rising_sr_ids_key) or ()).issuperset(added):
+        with g.make_lock('lock_' + rising_sr_ids_key):
+            sr_ids = set(cache.get(rising_sr_ids_key) or ())
+            if not sr_ids.issuperset(added):
+                cache.set(rising_sr_ids_key, list(sr_ids.union(added)))
+
+def _merge(lists, limit = None):
+    # each list is sorted best first, so merge them backwards
+    rising = list(merge(*[reversed(entries) for entries in lists]))
+    rising.reverse()
+    return rising[:limit] if limit is not None else rising
+
+@memoize('rising.merged', time = 60)
+def _merged_rising():
+    sr_ids = cache.get(rising_sr_ids_key) or ()
+    lists = cache.get_multi(sr_ids, prefix = rising_prefix).values()
+    return _merge(lists, g.rising_size)
 
 def get_rising(sr):
     #get the sr_ids
     sr_ids = sr.rising_srs()
-    rising = cache.get('rising') or ()
     if sr_ids:
-        return [p[0] for p in filter(lambda pair: pair[1] in sr_ids, rising)]
+        lists = cache.get_multi(sr_ids, prefix = rising_prefix).values()
+        rising = _merge(lists)
+    elif g.incremental_rising:
+        # with the subreddits' lists being kept up to date, the overall
+        # list is built from them, at most once a minute
+        rising = _merged_rising()
     else:
-        return [p[0] for p in rising]
+        rising = cache.get(rising_key) or ()
+
+    return [entry[1] for entry in rising]
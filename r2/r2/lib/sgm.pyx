@@ -1,15 +1,206 @@
+import threading
+from time import time as _now, sleep
+
+# cached in place of the keys that miss_fn couldn't find, when negative
+# caching is on, so that lookups of ids that don't exist don't all go
+# to the database
+NOT_FOUND = '__sgm_not_found__'
+
+# the keys that a thread in this process is loading with single_flight,
+# mapped to an Event that it sets when it's done
+_flights = {}
+_flights_lock = threading.Lock()
+
+cpdef bint is_not_found(val):
+    return type(val) is str and val == NOT_FOUND
+
+cdef _incr(stats, str key, long n):
+    if stats is not None and n:
+        stats.incr(key, n)
+
+def _lease_cache(cache):
+    # `add' on a chain doesn't tell us whether the shared cache at the
+    # end of it took the key, so leases go straight to that cache
+    while getattr(cache, 'caches', None):
+        cache = cache.caches[-1]
+    return cache
+
+def _calculate(cache, keys, miss_fn, str prefix, int time, int negative_time):
+    cdef dict calculated
+    cdef dict calculated_to_cache
+    cdef dict missing
+
+    calculated = miss_fn(keys)
+
+    calculated_to_cache = {}
+    for k, v in calculated.iteritems():
+        calculated_to_cache[str(k)] = v
+    if calculated_to_cache:
+        if time:
+            cache.set_multi(calculated_to_cache, prefix=prefix, time=time)
+        else:
+            cache.set_multi(calculated_to_cache, prefix=prefix)
+
+    if negative_time:
+        missing = {}
+        for k in keys:
+            if k not in calculated:
+                missing[str(k)] = NOT_FOUND
+        if missing:
+            cache.set_multi(missing, prefix=prefix, time=negative_time)
+
+    return calculated
+
+def _fetch(cache, keys, str prefix):
+    """Returns the cached values of `keys' and the set of keys that are
+       known not to exist"""
+    cdef dict s_keys = {}
+    cdef dict found = {}
+    cdef set not_found = set()
+
+    for key in keys:
+        s_keys[str(key)] = key
+    for k, v in cache.get_multi(s_keys.keys(), prefix=prefix).iteritems():
+        if is_not_found(v):
+            not_found.add(s_keys[k])
+        else:
+            found[s_keys[k]] = v
+    return found, not_found
+
+def _wait_for(cache, leaser, keys, str prefix, double timeout):
+    """Poll the cache for `keys' while another process loads them.
+       Returns what was found and the keys that are still missing,
+       which includes any whose lease was released without a value
+       being cached (there's no point waiting for those)"""
+    cdef dict found = {}
+    cdef list waiting = list(keys)
+    cdef list released = []
+    cdef double deadline = _now() + timeout
+    cdef str lease_prefix = 'sgm_lease_' + prefix
+
+    while waiting and _now() < deadline:
+        sleep(0.05)
+        # the leases are checked before the values, so that a key whose
+        # lease is gone and that still isn't cached really was given up
+        leased = leaser.get_multi([str(k) for k in waiting],
+                                  prefix=lease_prefix)
+        got, not_found = _fetch(cache, waiting, prefix)
+        found.update(got)
+        waiting = [k for k in waiting
+                   if k not in got and k not in not_found]
+        released.extend(k for k in waiting if str(k) not in leased)
+        waiting = [k for k in waiting if str(k) in leased]
+    return found, released + waiting
+
+def load_single_flight(cache, keys, miss_fn, str prefix='', int time=0,
+                       int negative_time=0, double lease_time=5,
+                       stats=None):
+    """Like the miss handling in sgm, but each key is only loaded by one
+       caller at a time. Threads in this process that want a key that
+       another thread is loading wait for it to finish, and processes
+       take a short lease on a key in memcache before loading it, so
+       that the others poll the cache for it instead"""
+    cdef list mine = []
+    cdef list theirs = []
+    cdef list elsewhere = []
+    cdef list leased = []
+    cdef list load = []
+    cdef list late
+    cdef dict flights = {}
+    cdef dict ret = {}
+
+    _flights_lock.acquire()
+    try:
+        for k in keys:
+            sk = prefix + str(k)
+            flight = _flights.get(sk)
+            if flight is None:
+                flight = _flights[sk] = flights[sk] = threading.Event()
+                mine.append(k)
+            else:
+                theirs.append((k, flight))
+    finally:
+        _flights_lock.release()
+
+    leaser = _lease_cache(cache)
+    try:
+        for k in mine:
+            lease_key = 'sgm_lease_' + prefix + str(k)
+            if leaser.add(lease_key, 1, time=max(int(lease_time), 1)):
+                leased.append(lease_key)
+                load.append(k)
+            else:
+                elsewhere.append(k)
+
+        if load:
+            ret.update(_calculate(cache, load, miss_fn, prefix, time,
+                                  negative_time))
+
+        if elsewhere:
+            found, late = _wait_for(cache, leaser, elsewhere, prefix,
+                                    lease_time)
+            ret.update(found)
+            _incr(stats, 'sgm.coalesced', len(elsewhere) - len(late))
+            if late:
+                # whoever held the lease took too long, or didn't
+                # cache anything (e.g. for ids that don't exist when
+                # negative caching is off)
+                _incr(stats, 'sgm.lease_timeout', len(late))
+                ret.update(_calculate(cache, late, miss_fn, prefix, time,
+                                      negative_time))
+    finally:
+        for lease_key in leased:
+            leaser.delete(lease_key)
+
+        _flights_lock.acquire()
+        try:
+            for sk, flight in flights.iteritems():
+                del _flights[sk]
+                flight.set()
+        finally:
+            _flights_lock.release()
+
+    if theirs:
+        for k, flight in theirs:
+            flight.wait(lease_time)
+        waited = [k for k, flight in theirs]
+        found, not_found = _fetch(cache, waited, prefix)
+        ret.update(found)
+        late = [k for k in waited if k not in found and k not in not_found]
+        _incr(stats, 'sgm.coalesced', len(waited) - len(late))
+        if late:
+            ret.update(_calculate(cache, late, miss_fn, prefix, time,
+                                  negative_time))
+
+    return ret
+
+def load_missing(cache, keys, miss_fn, str prefix='', int time=0,
+                 single_flight=False, int negative_time=0, stats=None):
+    """Load `keys' with miss_fn and cache the results"""
+    if single_flight:
+        return load_single_flight(cache, keys, miss_fn, prefix=prefix,
+                                  time=time, negative_time=negative_time,
+                                  stats=stats)
+    return _calculate(cache, keys, miss_fn, prefix, time, negative_time)
+
 # smart get multi:
 # For any keys not found in the cache, miss_fn() is run and the result is
 # stored in the cache. Then it returns everything, both the hits and misses.
-def sgm(cache, keys, miss_fn, str prefix='', int time=0, stale=False, found_fn=None, _update=False):
+# With single_flight, concurrent misses on the same keys are only
+# loaded once (see load_single_flight), and with negative_time the keys
+# that miss_fn doesn't return are remembered as missing for that many
+# seconds.
+def sgm(cache, keys, miss_fn, str prefix='', int time=0, stale=False, found_fn=None, _update=False,
+        single_flight=False, int negative_time=0, stats=None):
     cdef dict ret
     cdef dict s_keys
     cdef dict cached
     cdef dict calculated
-    cdef dict calculated_to_cache
     cdef set  still_need
+    cdef set  not_found
 
     ret = {}
+    not_found = set()
 
     # map the string versions of the keys to the real version. we only
     # need this to interprate the cache's response and turn it back
@@ -26,9 +217,13 @@ def sgm(cache, keys, miss_fn, str prefix='', int time=0, stale=False, found_fn=N
         else:
             cached = cache.get_multi(s_keys.keys(), prefix=prefix)
         for k, v in cached.iteritems():
-            ret[s_keys[k]] = v
+            if negative_time and is_not_found(v):
+                # we've recently looked for this one and it wasn't there
+                not_found.add(s_keys[k])
+            else:
+                ret[s_keys[k]] = v
 
-    still_need = set(s_keys.values()) - set(ret.keys())
+    still_need = set(s_keys.values()) - set(ret.keys()) - not_found
 
     if found_fn is not None:
         # give the caller an opportunity to reject some of the cache
@@ -41,12 +236,9 @@ def sgm(cache, keys, miss_fn, str prefix='', int time=0, stale=False, found_fn=N
         # if we didn't get all of the keys from the cache, go to the
         # miss_fn with the keys they asked for minus the ones that we
         # found
-        calculated = miss_fn(still_need)
+        calculated = load_missing(cache, still_need, miss_fn, prefix=prefix,
+                                  time=time, single_flight=single_flight,
+                                  negative_time=negative_time, stats=stats)
         ret.update(calculated)
 
-        calculated_to_cache = {}
-        for k, v in calculated.iteritems():
-            calculated_to_cache[str(k)] = v
-        cache.set_multi(calculated_to_cache, prefix=prefix)
-
     return ret
@@ -0,0 +1,155 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""Cheap, process-local counters and timers.
+
+These are kept in memory rather than sent anywhere so that they can be
+called from hot paths; `g.stats.dump()` (also triggered by SIGUSR2)
+writes a summary to stderr, and `snapshot()` returns it for anything
+that wants to ship it elsewhere.
+"""
+from __future__ import with_statement
+import sys
+import threading
+from time import time
+from datetime import datetime
+
+# upper bounds (in ms) of the timing histogram buckets
+timing_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500,
+                  1000, 2000, 5000, 10000, 30000)
+
+def bucket_index(ms):
+    """The index into a timing histogram of the bucket `ms' belongs in"""
+    for i, bound in enumerate(timing_buckets):
+        if ms <= bound:
+            return i
+    return len(timing_buckets)
+
+def bucket_percentile(buckets, p, max=None):
+    """The upper bound (in ms) of the bucket of a timing histogram that
+       the p-th percentile (0 < p <= 100) falls in. Values past the last
+       bound are reported as `max' if it's known"""
+    count = sum(buckets)
+    if not count:
+        return 0.
+    needed = count * p / 100.
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= needed:
+            if i < len(timing_buckets):
+                return timing_buckets[i]
+            break
+    return max if max is not None else timing_buckets[-1]
+
+class Timing(object):
+    """A count, total, max and bucketed histogram of elapsed times"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.buckets = [0] * (len(timing_buckets) + 1)
+
+    def add(self, elapsed):
+        ms = elapsed * 1000.
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.buckets[bucket_index(ms)] += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def percentile(self, p):
+        """The upper bound of the bucket that the p-th percentile
+           (0 < p <= 100) falls in, in ms"""
+        return bucket_percentile(self.buckets, p, self.max)
+
+    def __repr__(self):
+        return ('<Timing n=%d mean=%.1fms p50=%sms p99=%sms max=%.1fms>'
+                % (self.count, self.mean, self.percentile(50),
+                   self.percentile(99), self.max))
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.timings = {}
+            self.started = datetime.now()
+
+    def incr(self, key, delta=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + delta
+
+    def timing(self, key, elapsed):
+        """Record `elapsed' seconds against `key'"""
+        with self.lock:
+            t = self.timings.get(key)
+            if t is None:
+                t = self.timings[key] = Timing()
+            t.add(elapsed)
+
+    def timer(self, key):
+        return _Timer(self, key)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(counts = dict(self.counts),
+                        timings = dict((k, (t.count, t.mean,
+                                            t.percentile(50),
+                                            t.percentile(99), t.max))
+                                       for k, t in self.timings.iteritems()),
+                        since = self.started)
+
+    def dump(self, *a):
+        # this is the SIGUSR2 handler, which runs in the main thread
+        # between bytecodes, possibly while that thread is holding
+        # self.lock in incr or timing. So it mustn't take the lock:
+        # copying the dicts is atomic enough, and a Timing that's
+        # being added to is at worst a sample out of date
+        out = sys.stderr
+        counts, timings = dict(self.counts), dict(self.timings)
+        out.write('%(t)s Stats since %(d)s %(t)s\n'
+                  % dict(t='*'*15, d=self.started))
+        for key in sorted(counts):
+            out.write('\t%s: %d\n' % (key, counts[key]))
+        for key in sorted(timings):
+            out.write('\t%s: %r\n' % (key, timings[key]))
+
+class _Timer(object):
+    """Context manager that records how long its block took"""
+    def __init__(self, stats, key):
+        self.stats = stats
+        self.key = key
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.elapsed = time() - self.start
+        self.stats.timing(self.key, self.elapsed)
@@ -0,0 +1,144 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""Per-request counts of the calls we make to memcache, Cassandra and
+postgres.
+
+The backends call record() around each operation; when a request is
+being traced (see begin() and end()) that adds to its per-backend
+counts of calls, keys and time, and to a bounded list of the individual
+calls so that a slow request can be written out in full. When nothing is
+being traced record() is nearly free.
+"""
+import threading
+import random
+import logging
+from time import time
+
+# the most individual calls that we'll keep per request
+max_events = 2000
+
+_local = threading.local()
+
+class RequestTrace(object):
+    def __init__(self, name = ''):
+        self.name = name
+        self.start = time()
+        self.elapsed = None
+        # "backend.op" -> [calls, keys, seconds]
+        self.counts = {}
+        self.events = []
+        self.dropped = 0
+
+    def __repr__(self):
+        return '<RequestTrace %s %r>' % (self.name, self.summary())
+
+    def record(self, backend, op, nkeys, elapsed, detail = None):
+        name = backend + '.' + op
+        counts = self.counts.get(name)
+        if counts is None:
+            counts = self.counts[name] = [0, 0, 0.]
+        counts[0] += 1
+        counts[1] += nkeys
+        counts[2] += elapsed
+
+        if len(self.events) < max_events:
+            self.events.append((time() - self.start - elapsed,
+                                name, nkeys, elapsed, detail))
+        else:
+            self.dropped += 1
+
+    def summary(self):
+        """{"backend.op": (calls, keys, ms)}"""
+        return dict((name, (calls, keys, round(seconds * 1000., 1)))
+                    for name, (calls, keys, seconds)
+                    in self.counts.iteritems())
+
+    def backends(self):
+        """Total calls per backend, e.g. {'memcache': 12, 'sql': 3}"""
+        ret = {}
+        for name, (calls, keys, seconds) in self.counts.iteritems():
+            backend = name.split('.', 1)[0]
+            ret[backend] = ret.get(backend, 0) + calls
+        return ret
+
+    def format(self):
+        """The whole trace as text, slowest operations first in the
+           summary, then every call in order"""
+        lines = ['%s %.1fms %r' % (self.name, (self.elapsed or 0) * 1000.,
+                                   self.backends())]
+        summary = self.summary()
+        for name in sorted(summary, key = lambda n: -summary[n][2]):
+            calls, keys, ms = summary[name]
+            lines.append('  %-32s calls=%-5d keys=%-6d %.1fms'
+                         % (name, calls, keys, ms))
+        for offset, name, nkeys, elapsed, detail in self.events:
+            lines.append('    +%8.1fms %-32s %5d %7.1fms %s'
+                         % (offset * 1000., name, nkeys, elapsed * 1000.,
+                            detail if detail is not None else ''))
+        if self.dropped:
+            lines.append('    (%d more calls not shown)' % self.dropped)
+        return '\n'.join(lines)
+
+def begin(name = ''):
+    """Start tracing the calls made by this thread"""
+    trace = _local.trace = RequestTrace(name)
+    return trace
+
+def end():
+    """Stop tracing this thread, returning the finished trace (if
+       there was one)"""
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    if trace is not None:
+        trace.elapsed = time() - trace.start
+    return trace
+
+def current():
+    return getattr(_local, 'trace', None)
+
+def record(backend, op, nkeys, start, detail = None):
+    """Record a call to `backend' that started at `start'"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.record(backend, op, nkeys, time() - start, detail)
+
+def should_log(trace, slow_ms, sample_rate):
+    """Whether a finished trace is slow enough, and lucky enough, to be
+       written out in full"""
+    return (trace.elapsed * 1000. >= slow_ms
+            and (sample_rate >= 1.0 or random.random() < sample_rate))
+
+_log = None
+
+def log_trace(trace, path = None):
+    """Write a trace out in full, to the file at `path' if given"""
+    global _log
+    if _log is None:
+        log = logging.getLogger('r2.tracing')
+        log.setLevel(logging.INFO)
+        if path:
+            handler = logging.FileHandler(path)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            log.addHandler(handler)
+            log.propagate = False
+        _log = log
+    _log.info(trace.format())
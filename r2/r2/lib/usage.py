@@ -0,0 +1,163 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+"""Aggregation of the request timings that reddit_base sends to usage_q.
+
+A busy app sends one message per sampled request, and each message
+touches a count and an elapsed total in each of three bucket
+granularities. Rather than turning every message into six hardcache
+writes, a UsageAggregator sums them in memory per (bucket, action) and
+writes the totals out every `g.usage_flush_interval' seconds with a
+handful of batched statements.
+
+Alongside the sums it keeps a latency histogram per action per day
+(using the bucket bounds in r2.lib.stats) so that percentiles can be
+read back with `percentiles()'.
+"""
+from pylons import g
+from time import time as now
+import random as rand
+
+from r2.lib.utils import trunc_time
+from r2.lib.stats import timing_buckets, bucket_index, bucket_percentile
+
+def hund_from_start_and_end(start_time, end_time):
+    elapsed = end_time - start_time
+
+    hund_sec = int(elapsed.seconds * 100 +
+                   elapsed.microseconds / 10000)
+
+    if hund_sec == 0:
+        fraction = elapsed.microseconds / 10000.0
+        if rand.random() < fraction:
+            return 1
+        else:
+            return 0
+
+    return hund_sec
+
+def buckets(time):
+    time = time.astimezone(g.display_tz)
+
+    # Keep:
+    #   Daily buckets for eight days
+    #   1-hour buckets for 23 hours
+    #   5-min buckets for two hours
+    #
+    # (If the 1-hour bucket lasts more than a day, things can get confusing;
+    # at 12:30, the 12:xx column will have things from today at 12:20 and
+    # from yesterday at 12:40. This could be worked around, but the code
+    # over in pages.py is convoluted enough, so I'd rather not.)
+
+    return [
+             (86400 *  8, time.strftime("%Y/%m/%d_xx:xx")),
+             ( 3600 * 23, time.strftime("%Y/%m/%d_%H:xx")),
+             ( 3600 *  2, trunc_time(time,  5).strftime("%Y/%m/%d_%H:%M")),
+           ]
+
+def _hist_key(bucket, action, i):
+    return "%s-%s-%d" % (bucket, action, i)
+
+class UsageAggregator(object):
+    def __init__(self, flush_interval = None):
+        if flush_interval is None:
+            flush_interval = g.usage_flush_interval
+        self.flush_interval = flush_interval
+        self.reset()
+
+    def reset(self):
+        # exp_time -> {'bucket-action': n}
+        self.counts = {}
+        self.elapseds = {}
+        # exp_time -> {'bucket-action-i': n}
+        self.hists = {}
+        self.started = now()
+        self.added = 0
+
+    def add(self, action, start_time, end_time, sampling_rate = 1.0):
+        hund_sec = hund_from_start_and_end(start_time, end_time)
+
+        action = action.replace("-", "_")
+
+        fudged_count   = int(       1 / sampling_rate)
+        fudged_elapsed = int(hund_sec / sampling_rate)
+
+        for exp_time, bucket in buckets(end_time):
+            k = "%s-%s" % (bucket, action)
+            counts = self.counts.setdefault(exp_time, {})
+            counts[k] = counts.get(k, 0) + fudged_count
+            elapseds = self.elapseds.setdefault(exp_time, {})
+            elapseds[k] = elapseds.get(k, 0) + fudged_elapsed
+
+        # the histogram is only kept at the coarsest granularity, which
+        # is the first bucket
+        exp_time, bucket = buckets(end_time)[0]
+        k = _hist_key(bucket, action, bucket_index(hund_sec * 10))
+        hists = self.hists.setdefault(exp_time, {})
+        hists[k] = hists.get(k, 0) + fudged_count
+
+        self.added += 1
+
+    def due(self):
+        return now() - self.started >= self.flush_interval
+
+    def flush(self, verbose = False):
+        """Write everything accumulated so far to the hardcache"""
+        if verbose:
+            print "flushing %d messages" % self.added
+
+        for prefix, by_exp in (("profile_count-", self.counts),
+                               ("profile_elapsed-", self.elapseds),
+                               ("profile_hist-", self.hists)):
+            for exp_time, deltas in by_exp.iteritems():
+                if verbose:
+                    for k in sorted(deltas):
+                        print "%s%s += %d" % (prefix, k, deltas[k])
+                g.hardcache.accrue_multi(deltas, prefix = prefix,
+                                         time = exp_time)
+
+        self.reset()
+
+    def maybe_flush(self, verbose = False):
+        if self.due():
+            self.flush(verbose = verbose)
+            return True
+        return False
+
+def percentiles(bucket, actions, ps = (50, 90, 99)):
+    """For each of `actions', the requested percentiles (in seconds) of
+       its elapsed times over the daily `bucket' (as found in the keys
+       of `buckets()'). Returns {action: {p: seconds}}, leaving out any
+       action that has no histogram for that bucket"""
+    nbuckets = len(timing_buckets) + 1
+    keys = [ _hist_key(bucket, action, i)
+             for action in actions
+             for i in xrange(nbuckets) ]
+    found = g.hardcache.get_multi(keys, prefix = "profile_hist-")
+
+    res = {}
+    for action in actions:
+        hist = [ found.get(_hist_key(bucket, action, i)) or 0
+                 for i in xrange(nbuckets) ]
+        if any(hist):
+            res[action] = dict((p, bucket_percentile(hist, p) / 1000.)
+                               for p in ps)
+    return res
@@ -1,10 +1,15 @@
 from builder import Builder, MAX_RECURSION, empty_listing
 from r2.lib.wrapped import Wrapped
-from r2.lib.comment_tree import link_comments, link_comments_and_sort, tree_sort_fn, MAX_ITERATIONS
+from r2.lib.comment_tree import link_comments_and_sort, tree_sort_fn, MAX_ITERATIONS
 from r2.models.link import *
 from r2.lib.db import operators
 from r2.lib import utils
 
+def _children(tree, dict override, cid):
+    if cid in override:
+        return override[cid]
+    return tree.children(cid)
+
 class _CommentBuilder(Builder):
     def __init__(self, link, sort, comment = None, context = None,
                  load_more=True, continue_this_thread=True,
@@ -25,15 +30,14 @@ class _CommentBuilder(Builder):
 
     def get_items(self, num):
         from r2.lib.lock import TimeoutExpired
-        cdef list cid
-        cdef dict cid_tree
-        cdef dict depth
-        cdef dict num_children
-        cdef dict parents
         cdef dict sorter
+        # permalinks graft the focal comment's parents onto it, which
+        # we keep here rather than changing the shared tree
+        cdef dict children_override = {}
+        cdef dict num_children_override = {}
 
         r = link_comments_and_sort(self.link._id, self.sort.col)
-        cids, cid_tree, depth, num_children, parents, sorter = r
+        tree, sorter = r
 
         cdef dict debug_dict = dict(
             link = self.link,
@@ -47,7 +51,7 @@ class _CommentBuilder(Builder):
             lcs_rv = repr(r))
 
         if (not isinstance(self.comment, utils.iters)
-            and self.comment and not self.comment._id in depth):
+            and self.comment and not self.comment._id in tree):
             debug_dict["defocus_hack"] = "yes"
             g.log.error("Hack - self.comment (%d) not in depth. Defocusing..."
                         % self.comment._id)
@@ -67,32 +71,30 @@ class _CommentBuilder(Builder):
         if isinstance(self.comment, utils.iters):
             debug_dict["was_instance"] = "yes"
             for cm in self.comment:
-                # deleted comments will be removed from the cids list
-                if cm._id in cids:
+                # deleted comments will be removed from the tree
+                if cm._id in tree:
                     dont_collapse.append(cm._id)
                     candidates.append(cm._id)
             # if nothing but deleted comments, the candidate list might be empty
             if candidates:
-                pid = parents[candidates[0]]
+                pid = tree.parent(candidates[0])
                 if pid is not None:
                     ignored_parent_ids.append(pid)
-                    start_depth = depth[pid]
+                    start_depth = tree.depth(pid)
 
         # permalinks:
         elif self.comment:
             debug_dict["was_permalink"] = "yes"
-            # we are going to mess around with the cid_tree's contents
-            # so better copy it
-            cid_tree = cid_tree.copy()
             top = self.comment._id
             dont_collapse.append(top)
             #add parents for context
-            pid = parents[top]
+            pid = tree.parent(top)
             while self.context > 0 and pid is not None:
                 self.context -= 1
-                pid = parents[top]
-                cid_tree[pid] = [top]
-                num_children[pid] = num_children[top] + 1
+                pid = tree.parent(top)
+                children_override[pid] = [top]
+                num_children_override[pid] = (num_children_override.get(top)
+                                              or tree.num_children(top)) + 1
                 dont_collapse.append(pid)
                 # top will be appended to candidates, so stop updating
                 # it if hit the top of the thread
@@ -101,11 +103,11 @@ class _CommentBuilder(Builder):
             candidates.append(top)
             # the reference depth is that of the focal element
             if top is not None:
-                offset_depth = depth[top]
+                offset_depth = tree.depth(top)
         #else start with the root comments
         else:
             debug_dict["was_root"] = "yes"
-            candidates.extend(cid_tree.get(None, ()))
+            candidates.extend(tree.children(None))
 
         #find the comments
         cdef int num_have = 0
@@ -122,24 +124,25 @@ class _CommentBuilder(Builder):
         debug_dict["candidates_Before"] = repr(candidates)
         while num_have < num and candidates:
             to_add = candidates.pop(0)
-            if to_add not in cids:
+            if to_add not in tree:
                 continue
-            if (depth[to_add] - offset_depth) < self.max_depth + start_depth:
+            if (tree.depth(to_add) - offset_depth) < self.max_depth + start_depth:
                 #add children
-                if cid_tree.has_key(to_add):
-                    candidates.extend([x for x in cid_tree[to_add]
+                child_ids = _children(tree, children_override, to_add)
+                if child_ids:
+                    candidates.extend([x for x in child_ids
                                        if sorter.get(x) is not None])
                     candidates.sort(key = sorter.get, reverse = self.rev_sort)
                 items.append(to_add)
                 num_have += 1
             elif self.continue_this_thread:
                 #add the recursion limit
-                p_id = parents[to_add]
+                p_id = tree.parent(to_add)
                 if p_id is None:
                     fmt = ("tree problem: Wanted to add 'continue this " +
                            "thread' for %s, which has depth %d, but we " +
                            "don't know the parent")
-                    g.log.info(fmt % (to_add, depth[to_add]))
+                    g.log.info(fmt % (to_add, tree.depth(to_add)))
                 else:
                     w = Wrapped(MoreRecursion(self.link, 0, p_id))
                     w.children.append(to_add)
@@ -164,9 +167,10 @@ class _CommentBuilder(Builder):
 
         for cm in wrapped:
             # don't show spam with no children
-            if cm.deleted and not cid_tree.has_key(cm._id):
+            if cm.deleted and not _children(tree, children_override, cm._id):
                 continue
-            cm.num_children = num_children[cm._id]
+            cm.num_children = (num_children_override.get(cm._id)
+                               or tree.num_children(cm._id))
             if cm.collapsed and cm._id in dont_collapse:
                 cm.collapsed = False
             parent = cids.get(cm.parent_id)
@@ -179,7 +183,7 @@ class _CommentBuilder(Builder):
                 final.append(cm)
 
         debug_dict["final"] = [cm._id36 for cm in final]
-        debug_dict["depth"] = depth
+        debug_dict["depth"] = dict((cid, tree.depth(cid)) for cid in cids)
         debug_dict["extra"] = extra
 
         for p_id, morelink in extra.iteritems():
@@ -214,7 +218,7 @@ class _CommentBuilder(Builder):
             to_add = candidates.pop(0)
             direct_child = True
             #ignore top-level comments for now
-            p_id = parents[to_add]
+            p_id = tree.parent(to_add)
             #find the parent actually being displayed
             #direct_child is whether the comment is 'top-level'
             parentfinder_iteration_count = 0
@@ -222,13 +226,13 @@ class _CommentBuilder(Builder):
                 if parentfinder_iteration_count > MAX_ITERATIONS:
                     raise Exception("bad comment tree in link %s" %
                                     self.link._id36)
-                p_id = parents[p_id]
+                p_id = tree.parent(p_id)
                 direct_child = False
                 parentfinder_iteration_count += 1
 
             mc2 = more_comments.get(p_id)
             if not mc2:
-                mc2 = MoreChildren(self.link, depth.get(to_add,0) - offset_depth,
+                mc2 = MoreChildren(self.link, tree.depth(to_add, 0) - offset_depth,
                                    parent_id = p_id)
                 more_comments[p_id] = mc2
                 w_mc2 = Wrapped(mc2)
@@ -243,8 +247,7 @@ class _CommentBuilder(Builder):
                         parent.child.parent_name = parent._fullname
 
             #add more children
-            if cid_tree.has_key(to_add):
-                candidates.extend(cid_tree[to_add])
+            candidates.extend(_children(tree, children_override, to_add))
 
             if direct_child:
                 mc2.children.append(to_add)
@@ -35,10 +35,13 @@ from r2.lib.comment_tree import user_messages, subreddit_messages
 from r2.lib.wrapped import Wrapped
 from r2.lib import utils
 from r2.lib.db import operators
+from r2.lib.db.thing import byID_multi
+from r2.lib.dataloader import request_loader
 from r2.lib.filters import _force_unicode
 from copy import deepcopy
 
 import time
+from itertools import islice
 from admintools import compute_votes, admintools, ip_span
 
 EXTRA_FACTOR = 1.5
@@ -67,6 +70,13 @@ class Builder(object):
 
         aids = set(l.author_id for l in items if hasattr(l, 'author_id')
                    and l.author_id is not None)
+        srids = set(l.sr_id for l in items
+                    if getattr(l, 'sr_id', None) is not None)
+
+        # fetch the authors and subreddits in one trip to the cache;
+        # the lookups below will then find them in the local cache
+        byID_multi({Account: aids, Subreddit: srids},
+                   data=True, stale=self.stale)
 
         authors = {}
         cup_infos = {}
@@ -88,8 +98,18 @@ class Builder(object):
             can_ban_set = set(id for (id,sr) in subreddits.iteritems()
                               if sr.can_ban(user))
 
+        # fetch the likes and whatever add_props will want in one
+        # batched pass per source
+        loader = request_loader()
+        like_keys = [(user, item) for item in items] if user else []
+        loader.need('likes', like_keys)
+        for cls in set(item.__class__ for item in items):
+            if hasattr(cls, 'register_needs'):
+                cls.register_needs(c.user, items, loader)
+        loader.load_all()
+
         #get likes/dislikes
-        likes = queries.get_likes(user, items)
+        likes = loader.load('likes', like_keys)
         uid = user._id if user else None
 
         types = {}
@@ -407,10 +427,16 @@ class QueryBuilder(Builder):
 
 class IDBuilder(QueryBuilder):
     def init_query(self):
-        names = list(tup(self.query))
-
         after = self.after._fullname if self.after else None
 
+        if hasattr(self.query, 'iter_after') and not self.reverse:
+            # lazily merged listings can seek to `after' themselves,
+            # and we only pull as many names from them as we render
+            self.names = self.query.iter_after(after)
+            return
+
+        names = list(tup(self.query))
+
         self.names = self._get_after(names,
                                      after,
                                      self.reverse)
@@ -444,10 +470,14 @@ class IDBuilder(QueryBuilder):
                     last_item = None
                 slice_size = max(int(num_need * EXTRA_FACTOR), 1)
         else:
-            slice_size = len(names)
+            slice_size = None
             done = True
 
-        self.names, new_names = names[slice_size:], names[:slice_size]
+        if isinstance(names, (list, tuple)):
+            slice_size = len(names) if slice_size is None else slice_size
+            self.names, new_names = names[slice_size:], names[:slice_size]
+        else:
+            new_names = list(islice(names, slice_size))
         new_items = Thing._by_fullname(new_names, data = True, return_dict=False, stale=self.stale)
         return done, new_items
 
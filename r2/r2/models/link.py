@@ -35,6 +35,7 @@ from r2.lib.log import log_text
 from mako.filters import url_escape
 from r2.lib.strings import strings, Score
 from r2.lib.db import tdb_cassandra
+from r2.lib.dataloader import register_source, rel_source, request_loader
 
 from pylons import c, g, request
 from pylons.i18n import ungettext, _
@@ -308,6 +309,18 @@ class Link(Thing, Printable):
             return False
         return True
     
+    @classmethod
+    def _savehide_keys(cls, user, items):
+        return [(user._id36, item._id36) for item in items
+                if not SaveHide._can_skip_lookup(user, item)]
+
+    @classmethod
+    def register_needs(cls, user, items, loader):
+        if c.user_is_loggedin:
+            keys = cls._savehide_keys(user, items)
+            loader.need('saved', keys)
+            loader.need('hidden', keys)
+
     @classmethod
     def add_props(cls, user, wrapped):
         from r2.lib.pages import make_link_child
@@ -329,13 +342,12 @@ class Link(Thing, Printable):
         site = c.site
 
         if user_is_loggedin:
-            saved_lu = []
-            for item in wrapped:
-                if not SaveHide._can_skip_lookup(user, item):
-                    saved_lu.append(item._id36)
-
-            saved  = CassandraSave._fast_query(user._id36, saved_lu)
-            hidden = CassandraHide._fast_query(user._id36, saved_lu)
+            # these were normally registered by register_needs and
+            # have already been fetched with the rest of the listing's
+            keys = cls._savehide_keys(user, wrapped)
+            loader = request_loader()
+            saved  = loader.load('saved', keys)
+            hidden = loader.load('hidden', keys)
 
             clicked = {}
         else:
@@ -1218,6 +1230,9 @@ class CassandraHide(SimpleRelation):
     def _unhide(cls, *a, **kw):
         return cls._uncreate(*a, **kw)
 
+register_source('saved', rel_source(CassandraSave))
+register_source('hidden', rel_source(CassandraHide))
+
 class CassandraClick(SimpleRelation):
     _use_db = True
     _cf_name = 'Click'
@@ -23,6 +23,7 @@ from r2.models import *
 from r2.lib.utils import fetch_things2
 from pylons import g
 from r2.lib.db import queries
+from r2.lib import amqp
 
 
 import string
@@ -93,7 +94,7 @@ def populate(num_srs = 10, num_users = 1000, num_links = 100, num_comments = 20,
            v = Vote.vote(user, l, random.randint(0, 100) <= like, '127.0.0.1')
            queries.new_vote(v)
 
-    queries.worker.join()
+    amqp.join()
 
 
 def by_url_cache():
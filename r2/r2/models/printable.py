@@ -45,6 +45,13 @@ class Printable(object):
                         'timesince', 'votehash'
                         ])
 
+    @classmethod
+    def register_needs(cls, user, items, loader):
+        """Tell the DataLoader about the lookups that add_props will
+           make for these items, so they're batched with everyone
+           else's"""
+        pass
+
     @classmethod
     def add_props(cls, user, wrapped):
         from r2.lib.wrapped import CachedVariable
@@ -29,7 +29,7 @@ from account import Account
 from printable import Printable
 from r2.lib.db.userrel import UserRel
 from r2.lib.db.operators import lower, or_, and_, desc, asc
-from r2.lib.memoize import memoize
+from r2.lib.memoize import memoize, stale_memoize
 from r2.lib.utils import tup, interleave_lists, last_modified_multi, flatten
 from r2.lib.utils import timeago
 from r2.lib.cache import sgm
@@ -675,7 +675,7 @@ class FriendsSR(FakeSubreddit):
     title = 'friends'
 
     @classmethod
-    @memoize("get_important_friends", 5*60)
+    @stale_memoize("get_important_friends", 5*60, time = 60*60)
     def get_important_friends(cls, user_id, max_lookup = 500, limit = 100):
         a = Account._byID(user_id, data = True)
         # friends are returned chronologically by date, so pick the end of the list
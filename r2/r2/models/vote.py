@@ -30,7 +30,8 @@ from link import Link, Comment
 from pylons import g
 from datetime import datetime, timedelta
 
-__all__ = ['Vote', 'CassandraLinkVote', 'CassandraCommentVote', 'score_changes']
+__all__ = ['Vote', 'VoteBatch', 'VoteBatchError', 'CassandraLinkVote',
+           'CassandraCommentVote', 'score_changes']
 
 def score_changes(amount, old_amount):
     uc = dc = 0
@@ -43,6 +44,98 @@ def score_changes(amount, old_amount):
     elif oa < 0 and a > 0: dc = oa; uc = a
     return uc, dc
 
+class VoteBatchError(Exception): pass
+
+class VoteBatch(object):
+    """Collects the side-effects of a number of votes (score changes,
+       karma changes, subreddit vote counts and search updates) so
+       that they can be applied with one increment per thing and per
+       author rather than one per vote"""
+    def __init__(self):
+        # (fullname, new_valid_thing, old_valid_thing) -> [thing, ups, downs]
+        self.scores = {}
+        # (author_id, kind, sr_id) -> [sr, amount]
+        self.karma = {}
+        self.sr_counts = []
+        # fullname -> thing
+        self.changed = {}
+
+    def add_score(self, obj, up_change, down_change,
+                  new_valid_thing, old_valid_thing):
+        key = (obj._fullname, new_valid_thing, old_valid_thing)
+        score = self.scores.setdefault(key, [obj, 0, 0])
+        score[1] += up_change
+        score[2] += down_change
+
+    def add_karma(self, author_id, kind, sr, amount):
+        karma = self.karma.setdefault((author_id, kind, sr._id), [sr, 0])
+        karma[1] += amount
+
+    def add_sr_count(self, sr):
+        self.sr_counts.append(sr)
+
+    def add_changed(self, thing):
+        self.changed[thing._fullname] = thing
+
+    def __len__(self):
+        return (len(self.scores) + len(self.karma) + len(self.sr_counts)
+                + len(self.changed))
+
+    def flush(self):
+        """Apply the collected changes. Each one is removed from the
+           batch as soon as it's applied and a failure doesn't stop
+           the others, so if anything fails (which raises a
+           VoteBatchError once the rest have been tried) calling flush
+           again retries only what's left."""
+        from admintools import update_score
+        from r2.lib.count import incr_sr_count
+        from r2.lib.db import queries
+
+        failed = []
+        def attempt(fn, *a):
+            try:
+                fn(*a)
+                return True
+            except Exception:
+                g.log.exception("VoteBatch: %s%r failed" % (fn.__name__, a))
+                failed.append(fn)
+                return False
+
+        for key, (obj, ups, downs) in self.scores.items():
+            fullname, new_valid, old_valid = key
+            if (not (ups or downs)
+                or attempt(update_score, obj, ups, downs,
+                           new_valid, old_valid)):
+                del self.scores[key]
+
+        if self.karma:
+            author_ids = set(author_id for (author_id, kind, sr_id)
+                             in self.karma.iterkeys())
+            authors = {}
+            def load_authors():
+                authors.update(Account._byID(author_ids, data=True,
+                                             return_dict=True))
+            attempt(load_authors)
+            for key, (sr, amount) in self.karma.items():
+                author_id, kind, sr_id = key
+                if not amount:
+                    del self.karma[key]
+                elif author_id in authors:
+                    if attempt(authors[author_id].incr_karma,
+                               kind, sr, amount):
+                        del self.karma[key]
+
+        self.sr_counts = [sr for sr in self.sr_counts
+                          if not attempt(incr_sr_count, sr)]
+
+        if self.changed and attempt(queries.changed,
+                                    self.changed.values(), True):
+            self.changed = {}
+
+        if failed:
+            raise VoteBatchError("%d vote changes failed, %d left in batch"
+                                 % (len(failed), len(self)))
+
 class CassandraVote(tdb_cassandra.Relation):
     _use_db = False
 
@@ -167,10 +260,12 @@ class Vote(MultiRelation('vote',
     _defaults = {'organic': False}
 
     @classmethod
-    def vote(cls, sub, obj, dir, ip, organic = False, cheater = False):
-        from admintools import valid_user, valid_thing, update_score
-        from r2.lib.count import incr_sr_count
-        from r2.lib.db import queries
+    def vote(cls, sub, obj, dir, ip, organic = False, cheater = False,
+             batch = None):
+        """Record a vote. If a VoteBatch is passed in, the score,
+           karma and search updates are added to it for the caller to
+           flush rather than being applied immediately"""
+        from admintools import valid_user, valid_thing
 
         sr = obj.subreddit_slow
         kind = obj.__class__.__name__.lower()
@@ -218,26 +313,32 @@ class Vote(MultiRelation('vote',
 
         up_change, down_change = score_changes(amount, oldamount)
 
+        flush = batch is None
+        if flush:
+            batch = VoteBatch()
+
         if not (is_new and obj.author_id == sub._id and amount == 1):
             # we don't do this if it's the author's initial automatic
             # vote, because we checked it in with _ups == 1
-            update_score(obj, up_change, down_change,
-                         v.valid_thing, old_valid_thing)
+            batch.add_score(obj, up_change, down_change,
+                            v.valid_thing, old_valid_thing)
 
         if v.valid_user:
-            author = Account._byID(obj.author_id, data=True)
-            author.incr_karma(kind, sr, up_change - down_change)
+            batch.add_karma(obj.author_id, kind, sr, up_change - down_change)
 
         #update the sr's valid vote count
         if is_new and v.valid_thing and kind == 'link':
             if sub._id != obj.author_id:
-                incr_sr_count(sr)
+                batch.add_sr_count(sr)
 
         # now write it out to Cassandra. We'll write it out to both
         # this way for a while
         CassandraVote._copy_from(v)
 
-        queries.changed(v._thing2, True)
+        batch.add_changed(v._thing2)
+
+        if flush:
+            batch.flush()
 
         return v
 
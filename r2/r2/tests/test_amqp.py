@@ -0,0 +1,106 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+import socket
+from Queue import Queue
+
+from pylons import c
+from pylons.util import ContextObj
+
+from r2.lib import amqp
+
+class _Message(object):
+    def __init__(self, tag):
+        self.delivery_tag = tag
+        self.properties = {}
+
+class _Transport(object):
+    def __init__(self, sock):
+        self.sock = sock
+        # what amqplib's TCPTransport has read from the socket but not
+        # yet turned into frames, one character per message here
+        self._read_buffer = ''
+
+class _Connection(object):
+    def __init__(self, transport):
+        self.transport = transport
+        self.method_reader = type('MethodReader', (object,),
+                                  dict(queue = Queue()))()
+
+class _Channel(object):
+    """Enough of an amqplib channel for consume_batches, whose broker
+       sends everything in one go. The socket is never readable: all
+       of the messages were taken off it by the first read."""
+    def __init__(self, sock, messages):
+        self.connection = _Connection(_Transport(sock))
+        self.pending = messages
+        self.method_queue = []
+        self.callbacks = {}
+        self.acked = []
+        self.is_open = True
+        self.tag = 0
+
+    def basic_qos(self, *a):
+        pass
+
+    def basic_consume(self, queue, callback, no_ack):
+        self.callbacks[queue] = callback
+
+    def wait(self):
+        transport = self.connection.transport
+        if not transport._read_buffer:
+            # the single read of the whole burst
+            transport._read_buffer, self.pending = 'x' * self.pending, 0
+        transport._read_buffer = transport._read_buffer[1:]
+        self.tag += 1
+        for callback in self.callbacks.values():
+            callback(_Message(self.tag))
+
+    def basic_ack(self, tag, multiple = False):
+        self.acked.append(tag)
+
+    def close(self):
+        self.is_open = False
+
+def test_consume_buffered_burst():
+    a, b = socket.socketpair()
+    chan = _Channel(a, 5)
+    batches = []
+    def callback(items, chan):
+        batches.append([item.delivery_tag for item in items])
+        chan.callbacks.clear()
+
+    get_channel = amqp.connection_manager.get_channel
+    amqp.connection_manager.get_channel = lambda *a, **kw: chan
+    c._push_object(ContextObj())
+    try:
+        amqp.consume_batches('q', callback, limit = 10, max_wait = 0.5,
+                             verbose = False)
+    finally:
+        c._pop_object()
+        amqp.connection_manager.get_channel = get_channel
+        a.close()
+        b.close()
+
+    # the messages that were already read come out as one batch,
+    # rather than one per max_wait
+    assert batches == [[1, 2, 3, 4, 5]]
+    assert chan.acked == [5]
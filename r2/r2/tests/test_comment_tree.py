@@ -0,0 +1,184 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from r2.lib import comment_tree
+from r2.lib.comment_tree import (CommentTree, MAX_DELTA_SIZE, tree_key,
+                                 tree_delta_key, add_comments_nolock)
+
+#             1
+#           /   \
+#          2     3     5
+#          |
+#          4
+pairs = [(1, None), (2, 1), (3, 1), (4, 2), (5, None)]
+
+def _check(tree):
+    assert sorted(tree.cids()) == [1, 2, 3, 4, 5]
+    assert len(tree) == 5
+    assert tree.children(None) == [1, 5]
+    assert tree.children(1) == [2, 3]
+    assert tree.children(4) == []
+    assert tree.parent(4) == 2
+    assert tree.parent(1) is None
+    assert [tree.depth(x) for x in (1, 2, 3, 4, 5)] == [0, 1, 1, 2, 0]
+    assert tree.depth(99, 'missing') == 'missing'
+    assert [tree.num_children(x) for x in (1, 2, 3, 4, 5)] == [3, 1, 0, 0, 0]
+
+def test_build():
+    tree = CommentTree()
+    assert tree.add_many(pairs) == pairs
+    _check(tree)
+
+    # already there
+    assert not tree.add(4, 2)
+    assert tree.add_many([(4, 2), (6, 5)]) == [(6, 5)]
+
+    # no such parent
+    try:
+        tree.add(7, 99)
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("added a comment with a missing parent")
+
+def test_from_pairs():
+    # any order will do, and orphans are dropped
+    tree = CommentTree.from_pairs(list(reversed(pairs)) + [(8, 99)])
+    assert sorted(tree.cids()) == [1, 2, 3, 4, 5]
+    assert 8 not in tree
+    assert sorted(tree.children(1)) == [2, 3]
+    assert tree.num_children(1) == 3
+
+def test_empty():
+    tree = CommentTree()
+    assert tree.cids() == []
+    assert tree.children(None) == []
+    again = CommentTree.from_string(tree.to_string())
+    assert again.cids() == []
+    assert again.first_root == CommentTree.ROOT
+    assert again.to_legacy() == ([], {}, {}, {})
+
+def test_roundtrip():
+    tree = CommentTree()
+    tree.add_many(pairs)
+    _check(CommentTree.from_string(tree.to_string()))
+
+    # removed comments stay removed
+    assert tree.remove(3)
+    again = CommentTree.from_string(tree.to_string())
+    assert 3 not in again
+    assert again.cids() == [1, 2, 4, 5]
+    assert again.children(1) == [2]
+    assert again.add(3, 1)
+
+def test_bad_string():
+    s = CommentTree.from_pairs(pairs).to_string()
+    for bad in (s[:-1], s + 'x', 'XX' + s[2:]):
+        try:
+            CommentTree.from_string(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("loaded a bad comment tree")
+
+def test_remove():
+    tree = CommentTree.from_pairs(pairs)
+    # only comments without children can be removed
+    assert not tree.remove(1)
+    assert not tree.remove(99)
+    assert tree.remove(5)
+    assert tree.remove(4)
+    assert tree.children(None) == [1]
+    assert tree.children(2) == []
+    assert not tree.has_children(2)
+    # the descendant counts are left alone
+    assert tree.num_children(1) == 3
+    assert not tree.remove(4)
+
+def test_legacy():
+    cids = [1, 2, 3, 4, 5]
+    legacy = (cids,
+              {None: [1, 5], 1: [2, 3], 2: [4]},
+              {1: 0, 2: 1, 3: 1, 4: 2, 5: 0},
+              {1: 3, 2: 1, 3: 0, 4: 0, 5: 0})
+    tree = CommentTree.from_legacy(legacy[0], legacy[1])
+    _check(tree)
+
+    ret_cids, ret_tree, ret_depth, ret_num_children = tree.to_legacy()
+    assert sorted(ret_cids) == cids
+    assert dict((k, sorted(v)) for k, v in ret_tree.iteritems()) == legacy[1]
+    assert ret_depth == legacy[2]
+    assert ret_num_children == legacy[3]
+
+class _Comment(object):
+    def __init__(self, cid, parent_id):
+        self._id = cid
+        self.parent_id = parent_id
+
+class _Cache(dict):
+    def get_multi(self, keys):
+        return dict((k, self[k]) for k in keys if k in self)
+
+    def set(self, key, val):
+        self[key] = val
+
+class _Globals(object):
+    def __init__(self):
+        self.permacache = _Cache()
+
+def test_delta_folding():
+    link_id = 1
+    fake_g = _Globals()
+    cache = fake_g.permacache
+    real_g, comment_tree.g = comment_tree.g, fake_g
+    try:
+        comment_tree._set_tree(link_id, CommentTree.from_pairs([(1, None)]))
+        stored = cache[tree_key(link_id)]
+
+        # comments go to the delta, not the stored tree
+        for cid in xrange(2, MAX_DELTA_SIZE + 1):
+            add_comments_nolock(link_id, [_Comment(cid, 1)])
+            assert cache[tree_key(link_id)] == stored
+        assert len(cache[tree_delta_key(link_id)]) == MAX_DELTA_SIZE - 1
+
+        # which is applied when the tree is loaded
+        tree, delta = comment_tree._get_tree_and_delta(link_id)
+        assert len(tree) == MAX_DELTA_SIZE
+        assert tree.num_children(1) == MAX_DELTA_SIZE - 1
+
+        # comments already in the tree don't grow the delta
+        add_comments_nolock(link_id, [_Comment(2, 1)])
+        assert len(cache[tree_delta_key(link_id)]) == MAX_DELTA_SIZE - 1
+
+        # the comment that fills the delta folds it into the tree
+        add_comments_nolock(link_id, [_Comment(MAX_DELTA_SIZE + 1, 2)])
+        assert cache[tree_delta_key(link_id)] == []
+        tree = CommentTree.from_string(cache[tree_key(link_id)])
+        assert len(tree) == MAX_DELTA_SIZE + 1
+        assert tree.parent(MAX_DELTA_SIZE + 1) == 2
+        assert tree.depth(MAX_DELTA_SIZE + 1) == 2
+        assert tree.num_children(1) == MAX_DELTA_SIZE
+
+        # and the next one starts a new delta
+        add_comments_nolock(link_id, [_Comment(MAX_DELTA_SIZE + 2, None)])
+        assert cache[tree_delta_key(link_id)] == [(MAX_DELTA_SIZE + 2, None)]
+    finally:
+        comment_tree.g = real_g
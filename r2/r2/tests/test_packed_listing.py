@@ -0,0 +1,181 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from r2.lib.db.packed_listing import PackedListing, is_packed
+
+def _listing(tuples, ncols=2):
+    return PackedListing.from_tuples(tuples, ncols)
+
+def _roundtrip(listing):
+    return PackedListing.from_string(listing.tostring())
+
+def test_empty_listing():
+    listing = PackedListing(2)
+    assert len(listing) == 0
+    assert list(listing) == []
+    assert listing.bisect((1.0, 1.0)) == 0
+    assert listing.index('t3_1') == -1
+
+    s = listing.tostring()
+    assert is_packed(s)
+    again = PackedListing.from_string(s)
+    assert len(again) == 0
+    assert again.ncols == 2
+
+    assert len(PackedListing.load(None, 2)) == 0
+    assert len(PackedListing.load([], 2)) == 0
+
+def test_roundtrip():
+    tuples = [('t3_zz', 10.5, 1000.0),
+              ('t1_a', 3.0, 900.0),
+              ('t3_1', -2.25, 800.0)]
+    listing = _roundtrip(_listing(tuples))
+    assert list(listing) == tuples
+    assert listing[0] == tuples[0]
+    assert listing[-1] == tuples[-1]
+    assert listing[1:] == tuples[1:]
+    assert list(listing.fullnames()) == [t[0] for t in tuples]
+    assert listing.index('t1_a') == 1
+    assert listing.index('t3_a') == -1
+    assert listing.index('t5_1') == -1
+
+def test_not_packed():
+    assert not is_packed(None)
+    assert not is_packed([('t3_1', 1.0)])
+    try:
+        PackedListing.from_string('XX')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("unpacked a non-listing")
+
+def test_corrupt():
+    s = _listing([('t3_1', 1.0, 2.0)]).tostring()
+    for bad in (s[:-1], s + 'x'):
+        try:
+            PackedListing.from_string(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("unpacked a corrupt listing")
+
+def test_unpackable():
+    for t in (('nounderscore', 1.0, 1.0),
+              ('t3_!!', 1.0, 1.0),
+              ('t3_1', 'hot', 1.0),
+              ('t3_1', 1.0)):
+        try:
+            _listing([t])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("packed %r" % (t,))
+
+def test_bisect_ties():
+    listing = _listing([('t3_1', 5.0, 1.0),
+                        ('t3_2', 3.0, 1.0),
+                        ('t3_3', 3.0, 1.0),
+                        ('t3_4', 1.0, 1.0)])
+    # equal keys go after the existing ones, like a stable descending
+    # sort of the legacy tuples
+    assert listing.bisect((3.0, 1.0)) == 3
+    assert listing.bisect((5.0, 1.0)) == 1
+    assert listing.bisect((6.0, 1.0)) == 0
+    assert listing.bisect((3.0, 2.0)) == 1
+    assert listing.bisect((0.0, 1.0)) == 4
+
+    listing.insert([('t3_5', 3.0, 1.0)])
+    assert [t[0] for t in listing] == ['t3_1', 't3_2', 't3_3', 't3_5', 't3_4']
+
+def test_insert_replaces():
+    listing = _listing([('t3_1', 5.0, 1.0), ('t3_2', 3.0, 1.0)])
+    assert listing.insert([('t3_2', 7.0, 1.0)])
+    assert list(listing) == [('t3_2', 7.0, 1.0), ('t3_1', 5.0, 1.0)]
+
+def test_insert_at_limit():
+    listing = _listing([('t3_1', 5.0, 1.0),
+                        ('t3_2', 3.0, 1.0),
+                        ('t3_3', 1.0, 1.0)])
+
+    # too small to make it in, and nothing changes
+    before = listing.tostring()
+    assert not listing.insert([('t3_4', 0.5, 1.0)], limit=3)
+    assert listing.tostring() == before
+
+    # bumps the last item off the end
+    assert listing.insert([('t3_4', 4.0, 1.0)], limit=3)
+    assert [t[0] for t in listing] == ['t3_1', 't3_4', 't3_2']
+
+    # ties with the last item sort after it, so fall off
+    assert listing.insert([('t3_5', 3.0, 1.0)], limit=3)
+    assert [t[0] for t in listing] == ['t3_1', 't3_4', 't3_2']
+
+    # several at once, some of them replacing existing items
+    listing.insert([('t3_2', 9.0, 1.0), ('t3_6', 8.0, 1.0)], limit=3)
+    assert [t[0] for t in listing] == ['t3_2', 't3_6', 't3_1']
+    assert len(_roundtrip(listing)) == 3
+
+def test_delete():
+    listing = _listing([('t3_1', 5.0, 1.0),
+                        ('t3_2', 3.0, 1.0),
+                        ('t3_3', 1.0, 1.0)])
+    assert not listing.delete(['t3_9', 't5_1', 'garbage'])
+    assert listing.delete(['t3_3'])
+    assert [t[0] for t in listing] == ['t3_1', 't3_2']
+
+    # deleting from a full listing makes room for another insert
+    assert listing.insert([('t3_4', 0.5, 1.0)], limit=3)
+    assert [t[0] for t in listing] == ['t3_1', 't3_2', 't3_4']
+
+    assert listing.delete(['t3_1', 't3_2', 't3_4'])
+    assert len(listing) == 0
+    assert list(_roundtrip(listing)) == []
+
+def test_legacy_migration():
+    legacy = [('t3_c', 10.0, 300.0),
+              ('t3_b', 10.0, 200.0),
+              ('t1_a', 2.0, 100.0)]
+    listing = PackedListing.load(legacy, 2)
+    assert list(listing) == legacy
+
+    packed = listing.tostring()
+    assert is_packed(packed)
+    assert list(PackedListing.load(packed, 2)) == legacy
+
+    # a migrated listing can be written to like any other
+    listing.insert([('t3_d', 10.0, 250.0)])
+    assert [t[0] for t in listing] == ['t3_c', 't3_d', 't3_b', 't1_a']
+
+def test_merge():
+    a = _listing([('t3_1', 5.0, 1.0), ('t3_3', 1.0, 1.0)])
+    b = _listing([('t1_2', 3.0, 1.0), ('t3_4', 0.5, 1.0)])
+    a.merge(b, limit=3)
+    assert list(a) == [('t3_1', 5.0, 1.0),
+                       ('t1_2', 3.0, 1.0),
+                       ('t3_3', 1.0, 1.0)]
+    assert list(_roundtrip(a)) == list(a)
+
+    try:
+        a.merge(PackedListing(1))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("merged listings with different sorts")
@@ -0,0 +1,84 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is Reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of the
+# Original Code is CondeNet, Inc.
+#
+# All portions of the code written by CondeNet are Copyright (c) 2006-2010
+# CondeNet, Inc. All Rights Reserved.
+################################################################################
+from StringIO import StringIO
+
+from r2.lib.mr_tools.records import (dump_record, write_record, read_records,
+                                     to_records, to_text)
+
+def _read(s):
+    return list(read_records(StringIO(s)))
+
+def test_roundtrip():
+    records = [(),
+               ('t3_1', 1, 2L**40, -1.5, True, None),
+               (u'\u2603', 'tab\there', 'new\nline', ''),
+               ('x' * 100000,)]
+    out = StringIO()
+    for r in records:
+        write_record(r, out)
+    assert _read(out.getvalue()) == records
+
+    # types survive the trip
+    r, = _read(dump_record([1, 1.0, '1', u'1']))
+    assert map(type, r) == [int, float, str, unicode]
+
+def test_empty_stream():
+    assert _read('') == []
+
+def _assert_truncated(s):
+    try:
+        _read(s)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("read a truncated record")
+
+def test_truncated():
+    first, second = dump_record(('a', 1)), dump_record(('b', 2))
+    s = first + second
+
+    # every cut that isn't on a record boundary is noticed, whether it
+    # falls in the length prefix or in the record itself
+    for cut in xrange(1, len(second)):
+        _assert_truncated(s[:len(first) + cut])
+
+    # the records before the damage are still returned
+    records = read_records(StringIO(s[:-1]))
+    assert records.next() == ('a', 1)
+    _assert_truncated(s[:-1])
+
+def test_text():
+    text = 'a\t1\t2.5\nb\t\t-3\n'
+    records = StringIO()
+    to_records({1: int, 2: float}, StringIO('a\t1\t2.5\n'), records)
+    to_records((), StringIO('b\t\t-3\n'), records)
+    assert _read(records.getvalue()) == [('a', 1, 2.5), ('b', '', '-3')]
+
+    records.seek(0)
+    out = StringIO()
+    to_text(records, out)
+    assert out.getvalue() == text
+
+    # converters for columns a line doesn't have are skipped
+    records = StringIO()
+    to_records({5: int}, StringIO('a\tb\n'), records)
+    assert _read(records.getvalue()) == [('a', 'b')]
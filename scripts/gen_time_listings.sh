@@ -44,11 +44,14 @@ psql -F"\t" -A -t -d newreddit -U $USER -h $LINKDBHOST \
                     and t.date > now() - interval '1 $INTERVAL'
                   ) to '$DNAME'"
 
-cat $FNAME $DNAME | sort -T. -S200m | \
-    paster --plugin=r2 run $INI r2/lib/mr_top.py -c "join_links()" | \
-    paster --plugin=r2 run $INI r2/lib/mr_top.py -c "time_listings($LISTINGS)" | \
-    sort -T. -S200m | \
-    paster --plugin=r2 run $INI r2/lib/mr_top.py -c "write_permacache()"
+# join_links_parallel and time_listings_permacache do their own
+# (partitioned, multi-process) sorting, so there's no sort(1) here.
+# The joined links are passed on as binary records, so that their
+# numbers are only parsed once
+cat $FNAME $DNAME | \
+    paster --plugin=r2 run $INI r2/lib/mr_top.py -c "join_links_parallel()" | \
+    paster --plugin=r2 run $INI r2/lib/mr_top.py -c "link_records()" | \
+    paster --plugin=r2 run $INI r2/lib/mr_top.py -c "time_listings_permacache($LISTINGS, binary=True)"
 
 
 rm $FNAME $DNAME
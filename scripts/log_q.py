@@ -1,9 +1,10 @@
 #! /usr/bin/python
 
 from r2.lib import amqp, emailer
+from r2.lib.errorlog import add_timestamps, limited_append
+from r2.lib import errorlog
 from pylons import g
 from datetime import datetime
-from md5 import md5
 from random import shuffle, choice
 
 import pickle
@@ -23,7 +24,12 @@ def randword():
 
 q = 'log_q'
 
-def run(streamfile=None, verbose=False):
+def run(streamfile=None, verbose=False, aggregate=False, limit=1000,
+        flush_interval=60):
+    """With `aggregate', exceptions are counted per fingerprint in
+       memory and written out every `flush_interval' seconds (or when
+       the queue runs dry) rather than one at a time, so that a flood
+       of errors can't put the consumer behind"""
     if streamfile:
         stream_fp = open(streamfile, "a")
     else:
@@ -36,71 +42,10 @@ def run(streamfile=None, verbose=False):
         if important:
             print msg
 
-    def add_timestamps (d):
-        d['hms'] = d['time'].strftime("%H:%M:%S")
-
-        d['occ'] = "<%s:%s, pid=%-5s, %s>" % (d['host'], d['port'], d['pid'],
-                                      d['time'].strftime("%Y-%m-%d %H:%M:%S"))
-
-    def limited_append(l, item):
-        if len(l) >= 25:
-            l.pop(12)
-        l.append(item)
-
     def log_exception(d, daystring):
-        exc_desc = d['exception_desc']
-        exc_type = d['exception_type']
-
-        exc_str = "%s: %s" % (exc_type, exc_desc)
-
         add_timestamps(d)
 
-        tb = []
-
-        key_material = exc_type
-        pretty_lines = []
-
-        make_lock_seen = False
-        flaky_db_seen = False
-        cassandra_seen = False
-
-        for tpl in d['traceback']:
-            tb.append(tpl)
-            filename, lineno, funcname, text = tpl
-            if text is None:
-                pass
-            elif (text.startswith("with g.make_lock(") or
-                  text.startswith("with make_lock(")):
-                make_lock_seen = True
-            elif (text.startswith("(ProgrammingError) server closed the connection")):
-                flaky_db_seen = True
-            if '/cassandra/' in filename.lower():
-                cassandra_seen = True
-            if '/pycassa/' in filename.lower():
-                cassandra_seen = True
-            key_material += "%s %s " % (filename, funcname)
-            pretty_lines.append ("%s:%s: %s()" % (filename, lineno, funcname))
-            pretty_lines.append ("    %s" % text)
-
-        if exc_desc.startswith("QueuePool limit of size"):
-            fingerprint = "QueuePool_overflow"
-        elif exc_desc.startswith("error 2 from memcached_get: HOSTNAME "):
-            fingerprint = "memcache_suckitude"
-        elif exc_type == "TimeoutExpired" and make_lock_seen:
-            fingerprint = "make_lock_timeout"
-        elif exc_desc.startswith("(OperationalError) FATAL: the database " +
-                                 "system is in recovery mode"):
-            fingerprint = "recovering_db"
-        elif exc_desc.startswith("(OperationalError) could not connect " +
-                                 "to server"):
-            fingerprint = "unconnectable_db"
-        elif exc_desc.startswith("(OperationalError) server closed the " +
-                                 "connection unexpectedly"):
-            fingerprint = "flaky_db_op"
-        elif cassandra_seen:
-            fingerprint = "something's wrong with cassandra"
-        else:
-            fingerprint = md5(key_material).hexdigest()
+        fingerprint = errorlog.fingerprint(d)
 
         nickname_key = "error_nickname-" + fingerprint
         status_key = "error_status-" + fingerprint
@@ -109,14 +54,7 @@ def run(streamfile=None, verbose=False):
 
         if nickname is None:
             nickname = '"%s" Exception' % randword().capitalize()
-            news = ("A new kind of thing just happened! " +
-                    "I'm going to call it a %s\n\n" % nickname)
-
-            news += "Where and when: %s\n\n" % d['occ']
-            news += "Traceback:\n"
-            news += "\n".join(pretty_lines)
-            news += exc_str
-            news += "\n"
+            news = errorlog.new_exception_news(nickname, d)
 
             emailer.nerds_email(news, "Exception Watcher")
 
@@ -125,8 +63,7 @@ def run(streamfile=None, verbose=False):
 
         if g.hardcache.get(status_key) == "fixed":
             g.hardcache.set(status_key, "new", 86400)
-            news = "This was marked as fixed: %s\n" % nickname
-            news += "But it just occurred, so I'm marking it new again."
+            news = errorlog.fixed_exception_news(nickname)
             emailer.nerds_email(news, "Exception Watcher")
 
         err_key = "-".join(["error", daystring, fingerprint])
@@ -134,7 +71,8 @@ def run(streamfile=None, verbose=False):
         existing = g.hardcache.get(err_key)
 
         if not existing:
-            existing = dict(exception=exc_str, traceback=tb, occurrences=[])
+            existing = dict(exception=errorlog.exception_str(d),
+                            traceback=d['traceback'], occurrences=[])
 
         existing.setdefault('times_seen', 0)
         existing['times_seen'] += 1
@@ -181,6 +119,11 @@ def run(streamfile=None, verbose=False):
         limited_append(occurrences, d2)
         g.hardcache.set(occ_key, occurrences, 86400 * 7)
 
+    if aggregate:
+        aggregator = errorlog.ExceptionAggregator(
+            randword, streamlog=lambda msg: streamlog(msg, verbose),
+            flush_interval=flush_interval)
+
     def myfunc(msg):
         daystring = datetime.now(g.display_tz).strftime("%Y/%m/%d")
 
@@ -192,6 +135,11 @@ def run(streamfile=None, verbose=False):
 
         if not 'type' in d:
             streamlog ("wtf is %r" % d, True)
+        elif d['type'] == 'exception' and aggregate:
+            try:
+                aggregator.add(d)
+            except Exception as e:
+                print "Error in aggregator.add(): %r" % e
         elif d['type'] == 'exception':
             try:
                 log_exception(d, daystring)
@@ -205,5 +153,23 @@ def run(streamfile=None, verbose=False):
         else:
             streamlog ("wtf is %r" % d['type'], True)
 
-    amqp.consume_items(q, myfunc, verbose=verbose)
+    def flush():
+        try:
+            aggregator.flush()
+        except Exception as e:
+            print "Error in aggregator.flush(): %r" % e
+            aggregator.reset()
+
+    def batchfunc(msgs, chan):
+        for msg in msgs:
+            myfunc(msg)
+
+        if len(msgs) < limit / 2 or aggregator.due():
+            flush()
+
+    if aggregate:
+        amqp.handle_items(q, batchfunc, limit=limit, drain=False,
+                          verbose=verbose)
+    else:
+        amqp.consume_items(q, myfunc, verbose=verbose)
 